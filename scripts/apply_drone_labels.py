@@ -13,6 +13,8 @@ from rasterio.enums import Resampling
 import pandas as pd
 from glob import glob
 
+from rgb_stretch import band_histogram, percentiles_from_histogram
+
 
 DATE_PATTERN = r"\d{4}_\d{2}_\d{2}"
 
@@ -66,17 +68,21 @@ def percentile_stretch_global(rgb_array, lower_pct=2, upper_pct=98):
             "Expected uint8 or uint16."
         )
 
-    # Compute percentiles over entire image (all bands together)
-    p_low, p_high = np.percentile(rgb_array, (lower_pct, upper_pct))
+    # Compute percentiles over entire image (all bands together) from its
+    # integer histogram; same values as np.percentile, without the sort
+    p_low, p_high = percentiles_from_histogram(
+        band_histogram(rgb_array), (lower_pct, upper_pct), dtype=rgb_array.dtype
+    )
 
-    # Rescale intensities
+    # Rescale intensities once per possible value, then look pixels up
+    levels = np.arange(np.iinfo(rgb_array.dtype).max + 1, dtype=rgb_array.dtype)
     stretched = exposure.rescale_intensity(
-        rgb_array,
+        levels,
         in_range=(p_low, p_high),
         out_range=(0, 255)
     )
 
-    return stretched.astype(np.uint8)
+    return stretched.astype(np.uint8)[rgb_array]
 
 
 def load_label(labelfile, mode='both'):
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 import json
 import logging
+import multiprocessing
 import os
 import re
 import click
@@ -12,15 +13,19 @@ import imageio.v3 as iio
 from pathlib import Path
 from skimage import color
 from skimage import exposure
-from skimage.measure import label as label_components
 from rasterio.enums import Resampling
-from scipy.ndimage import median_filter
+from scipy.ndimage import label as label_components
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
 from affine import Affine
 from arosics import COREG
 from geoarray import GeoArray
 
+from drone_cache import DroneMosaicCache
+from phase_coreg import phase_coreg_info
+from rgb_stretch import band_histogram, percentiles_from_histogram, stretch_band
+
 log = logging.getLogger(__name__)
 
 DATE_PATTERN = r"\d{4}_\d{2}_\d{2}"
@@ -75,17 +80,21 @@ def percentile_stretch_global(rgb_array, lower_pct=2, upper_pct=98):
             "Expected uint8 or uint16."
         )
 
-    # Compute percentiles over entire image (all bands together)
-    p_low, p_high = np.percentile(rgb_array, (lower_pct, upper_pct))
+    # Compute percentiles over entire image (all bands together) from its
+    # integer histogram; same values as np.percentile, without the sort
+    p_low, p_high = percentiles_from_histogram(
+        band_histogram(rgb_array), (lower_pct, upper_pct), dtype=rgb_array.dtype
+    )
 
-    # Rescale intensities
+    # Rescale intensities once per possible value, then look pixels up
+    levels = np.arange(np.iinfo(rgb_array.dtype).max + 1, dtype=rgb_array.dtype)
     stretched = exposure.rescale_intensity(
-        rgb_array,
+        levels,
         in_range=(p_low, p_high),
         out_range=(0, 255)
     )
 
-    return stretched.astype(np.uint8)
+    return stretched.astype(np.uint8)[rgb_array]
 
 
 def load_label(labelfile, mode='both'):
@@ -122,7 +131,25 @@ def load_as_geoarray(filepath):
     return GeoArray(arr, geotransform=transform.to_gdal(), projection=projection)
 
 
-def compute_coreg_shift(dronefile, planetfile, planet_match_band=1):
+def compute_coreg_shift(dronefile, planetfile, planet_match_band=1,
+                        phase_corr=True):
+    """(x_shift, y_shift, success, method) of the Planet scene against the
+    drone mosaic; method is coreg_info['method'] of the estimator used."""
+    # Phase correlation on the matching window first; the full AROSICS
+    # COREG only runs when it is not confident or fails.
+    if phase_corr:
+        try:
+            info = phase_coreg_info(
+                dronefile, planetfile, r_b4match=1, s_b4match=planet_match_band,
+                ws=(200, 200), max_shift=10,
+            )
+        except Exception as e:
+            log.warning("Phase correlation failed for %s: %s", planetfile, e)
+            info = None
+        if info is not None:
+            shift = info['corrected_shifts_map']
+            return shift['x'], shift['y'], True, info['method']
+
     drone_ga = load_as_geoarray(dronefile)
     planet_ga = load_as_geoarray(planetfile)
 
@@ -142,15 +169,15 @@ def compute_coreg_shift(dronefile, planetfile, planet_match_band=1):
         )
         coreg.calculate_spatial_shifts()
     except Exception:
-        return 0.0, 0.0, False
+        return 0.0, 0.0, False, 'arosics'
 
-    info = coreg.coreg_info
+    info = dict(coreg.coreg_info, method='arosics')
     success = bool(info.get('success', False))
     shift = info.get('corrected_shifts_map', {})
     x_shift = shift.get('x', 0.0)
     y_shift = shift.get('y', 0.0)
 
-    return x_shift, y_shift, success
+    return x_shift, y_shift, success, info['method']
 
 
 def find_drone(labelfile, dronedir):
@@ -196,14 +223,16 @@ def reproject_ocm_to_grid(ocm_path, pimg):
 
 
 def crown_filter_by_ocm(conf_resampled, ocm_rep):
+    """Crown mask (uint8 0/255) keeping only crowns whose every pixel is
+    clear in the OCM; crowns are 8-connected components of conf > 0.5."""
     clear_pixels = (ocm_rep.values == 0)
 
     binary = (conf_resampled.values > 0.5)
-    labeled = label_components(binary)
-    for comp_id in range(1, labeled.max() + 1):
-        comp_mask = (labeled == comp_id)
-        if not clear_pixels[comp_mask].all():
-            binary[comp_mask] = False
+    labeled, n_components = label_components(binary, structure=np.ones((3, 3)))
+    # Count non-clear pixels per component in one pass; label 0 is background
+    cloudy = np.bincount(labeled[~clear_pixels], minlength=n_components + 1) > 0
+    cloudy[0] = False
+    binary &= ~cloudy[labeled]
 
     return (binary.astype(np.uint8) * 255)
 
@@ -221,23 +250,12 @@ def render_rgb_from_4band(pimg, clear_mask, lower_pct=2.0, upper_pct=98.0):
     if arr.shape[0] < 4:
         raise ValueError(f"Expected 4-band Planet imagery, got {arr.shape[0]} bands")
 
-    red = arr[2].astype(np.float32)
-    green = arr[1].astype(np.float32)
-    blue = arr[0].astype(np.float32)
-
-    height, width = red.shape
+    height, width = arr.shape[1:]
     out = np.zeros((height, width, 3), dtype=np.uint8)
-    for i, b in enumerate((red, green, blue)):
+    for i, b in enumerate((arr[2], arr[1], arr[0])):
         not_nodata = np.ones_like(b, dtype=bool) if nodata is None else (b != nodata)
-        clear_valid = clear_mask & not_nodata
-        if not clear_valid.any():
-            continue
-        lo, hi = np.percentile(b[clear_valid], (lower_pct, upper_pct))
-        if hi <= lo:
-            continue
-        scaled = np.clip((b - lo) * (255.0 / (hi - lo)), 0, 255)
-        scaled = np.where(not_nodata, scaled, 0)
-        out[..., i] = scaled.astype(np.uint8)
+        out[..., i] = stretch_band(b, clear_mask & not_nodata, not_nodata,
+                                   (lower_pct, upper_pct))
 
     return out
 
@@ -248,6 +266,49 @@ def _round_sig(x, sig=5):
     return float(f"{float(x):.{sig}g}")
 
 
+def _median3(a, b, c):
+    return np.maximum(np.minimum(a, b), np.minimum(np.maximum(a, b), c))
+
+
+def median3x3(stack):
+    """3x3 median of each band of a (bands, H, W) stack; same values as
+    scipy.ndimage.median_filter(band, size=3) (reflect borders).
+
+    Each vertical triple is sorted once, then the median is
+    med3(max of lows, med3 of mids, min of highs) over three adjacent
+    columns: a min/max network on whole arrays instead of a per-pixel
+    selection."""
+    padded = np.pad(stack, ((0, 0), (1, 1), (1, 1)), mode='symmetric')
+    top, mid, bot = padded[:, :-2], padded[:, 1:-1], padded[:, 2:]
+    lo = np.minimum(top, mid)
+    hi = np.maximum(top, mid)
+    md = np.minimum(hi, bot)
+    hi = np.maximum(hi, bot)
+    md, lo = np.maximum(lo, md), np.minimum(lo, md)
+
+    left, centre, right = slice(None, -2), slice(1, -1), slice(2, None)
+    max_lo = np.maximum(np.maximum(lo[..., left], lo[..., centre]), lo[..., right])
+    min_hi = np.minimum(np.minimum(hi[..., left], hi[..., centre]), hi[..., right])
+    med_md = _median3(md[..., left], md[..., centre], md[..., right])
+    return _median3(max_lo, med_md, min_hi)
+
+
+def _integer_median_mad(residual):
+    """Per-row median and median absolute deviation of integer residuals,
+    as float32 like np.median on the float32 residuals (exact: the middle
+    values are integers or half-integers far below 2**24)."""
+    med = np.empty(len(residual), dtype=np.float32)
+    mad = np.empty(len(residual), dtype=np.float32)
+    for b, row in enumerate(residual):
+        low = int(row.min())
+        med[b] = percentiles_from_histogram(np.bincount(row - low), (50.0,))[0] + low
+        # Twice the absolute deviation is an integer even for a half-integer
+        # median
+        twice_dev = np.abs(2 * row - int(2 * med[b]))
+        mad[b] = percentiles_from_histogram(np.bincount(twice_dev), (50.0,))[0] / 2
+    return med, mad
+
+
 def compute_noise_metrics(pimg, clear_mask, min_pixels=200):
     """Per-scene image-quality metrics computed on a 4-band Planet DataArray
     (B, G, R, NIR), restricted to clear OCM pixels.
@@ -263,15 +324,18 @@ def compute_noise_metrics(pimg, clear_mask, min_pixels=200):
       sigma via 1.4826 * MAD of (band - 3x3 median(band)). The 3x3 median
       preserves crown edges, so the residual is closer to pure noise.
       Inter-channel correlation is computed on raw clear-pixel band values
-      (the rainbow-noise failure mode breaks band correlation directly)."""
+      (the rainbow-noise failure mode breaks band correlation directly).
+
+    All bands are processed together: one median filter over the stack,
+    medians along the pixel axis, and one covariance matrix for every band
+    pair. Works for any band count (8-band inputs give 28 pairs)."""
     nodata = pimg.rio.nodata
     arr = pimg.values  # (bands, H, W)
     n_bands = arr.shape[0]
 
     valid = clear_mask.copy() if clear_mask is not None else np.ones(arr.shape[1:], dtype=bool)
     if nodata is not None:
-        for b in range(n_bands):
-            valid &= (arr[b] != nodata)
+        valid &= (arr != nodata).all(axis=0)
 
     none_result = {
         'noise_mad_sigma': None,
@@ -283,36 +347,43 @@ def compute_noise_metrics(pimg, clear_mask, min_pixels=200):
     if int(valid.sum()) < min_pixels:
         return none_result
 
+    if np.issubdtype(arr.dtype, np.integer):
+        # Integer residuals: filter in the band dtype and take median and MAD
+        # from histograms, exactly as np.median would on the float32 values
+        clear = arr[:, valid]                              # (bands, n_clear)
+        residual = clear.astype(np.int32) - median3x3(arr)[:, valid]
+        med, mad = _integer_median_mad(residual)
+        bands = clear.astype(np.float32)
+    else:
+        bands = arr[:, valid].astype(np.float32)
+        residual = bands - median3x3(arr.astype(np.float32))[:, valid]
+        med = np.median(residual, axis=1)
+        mad = np.median(np.abs(residual - med[:, None]), axis=1)
+
+    # Per-band scalars keep the original float32 arithmetic (and 1-D
+    # summation order for the mean), so the rounded JSON values do not move
     sigmas = []
     cvs = []
-    flat_clear = []
     for b in range(n_bands):
-        band = arr[b].astype(np.float32)
-        smoothed = median_filter(band, size=3)
-        residual = band - smoothed
-        r = residual[valid]
-        med = np.median(r)
-        mad = np.median(np.abs(r - med))
-        sigma = float(1.4826 * mad)
-
-        signal_mean = float(np.mean(band[valid]))
-        cv = sigma / signal_mean if signal_mean > 0 else float('nan')
+        sigma = float(1.4826 * mad[b])
+        signal_mean = float(np.mean(bands[b]))
         sigmas.append(sigma)
-        cvs.append(cv)
-        flat_clear.append(band[valid])
+        cvs.append(sigma / signal_mean if signal_mean > 0 else float('nan'))
 
     finite_cvs = [c for c in cvs if np.isfinite(c)]
     cv_mean = float(np.mean(finite_cvs)) if finite_cvs else float('nan')
 
-    pair_corrs = []
-    for i in range(n_bands):
-        for j in range(i + 1, n_bands):
-            xi, xj = flat_clear[i], flat_clear[j]
-            if xi.std() == 0 or xj.std() == 0:
-                continue
-            pair_corrs.append(float(np.corrcoef(xi, xj)[0, 1]))
-
-    if pair_corrs:
+    # Pearson r for every band pair from a single covariance matrix; bands
+    # that are constant over the clear pixels are left out of the mean.
+    centred = bands.astype(np.float64)
+    centred -= centred.mean(axis=1, keepdims=True)
+    cov = centred @ centred.T
+    std = np.sqrt(np.diag(cov))
+    i, j = np.triu_indices(n_bands, k=1)
+    pairs = (std[i] > 0) & (std[j] > 0)
+    pair_corrs = np.clip(cov[i, j][pairs] / (std[i] * std[j])[pairs], -1, 1)
+
+    if pair_corrs.size:
         corr_mean = float(np.mean(pair_corrs))
         decorr = 1.0 - corr_mean
     else:
@@ -354,6 +425,13 @@ def apply_shift_to_label(label_da, x_shift, y_shift):
     return shifted
 
 
+def drone_png_res(planet_res_m, resize, drone_scale):
+    # Nominal rather than the exact resized pixel size, which varies with
+    # each scene's shape, so every scene shares one cached mosaic.
+    res = planet_res_m / resize if resize else planet_res_m
+    return res / drone_scale
+
+
 def generate_drone_png(dronefile, pimg, x_shift_m, y_shift_m, drone_scale, outputpath):
     drone_da = rxr.open_rasterio(dronefile)
     drone_shifted = apply_shift_to_label(drone_da, x_shift_m, y_shift_m)
@@ -394,10 +472,23 @@ def generate_ocm_png(ocm_path, pimg, outputpath):
     iio.imwrite(outputpath, rgba)
 
 
-def create_mask(dronedir, labelfile, planetfile, planetdir, outputdir, resize, mode, maskdir=None, drone_scale=None, bands=3):
+def create_mask(dronedir, labelfile, planetfile, planetdir, outputdir, resize, mode, maskdir=None, drone_scale=None, bands=3, drone_cache=None, arosics_only=False):
 
     dronefile = find_drone(labelfile, dronedir)
 
+    with rasterio.open(planetfile) as src:
+        planet_crs = src.crs
+        planet_res_m = src.res[0]
+    with rasterio.open(dronefile) as src:
+        drone_res_m = src.res[0]
+
+    # Coregister against the mosaic pre-averaged to Planet resolution rather
+    # than the full orthomosaic; both COREG and the phase correlation resample
+    # the drone image to the Planet grid anyway.
+    coreg_dronefile = dronefile
+    if drone_cache is not None:
+        coreg_dronefile = drone_cache.get(dronefile, planet_crs, planet_res_m)
+
     clear_fraction = None
     if maskdir is not None:
         ocm_path = find_ocm_mask(planetfile, planetdir, maskdir)
@@ -406,19 +497,16 @@ def create_mask(dronedir, labelfile, planetfile, planetdir, outputdir, resize, m
 
     # Red is band 1 in 3-band RGB chips and band 3 in 4-band (B,G,R,NIR) chips.
     planet_match_band = 3 if bands == 4 else 1
-    x_shift, y_shift, coreg_ok = compute_coreg_shift(
-        dronefile, planetfile, planet_match_band=planet_match_band,
+    x_shift, y_shift, coreg_ok, coreg_method = compute_coreg_shift(
+        coreg_dronefile, planetfile, planet_match_band=planet_match_band,
+        phase_corr=not arosics_only,
     )
 
-    with rasterio.open(planetfile) as src:
-        planet_res_m = src.res[0]
-    with rasterio.open(dronefile) as src:
-        drone_res_m = src.res[0]
-
     record = {
         'scene': Path(planetfile).stem,
         'label': Path(labelfile).name,
         'coreg_ok': coreg_ok,
+        'coreg_method': coreg_method,
         'clear_fraction': clear_fraction,
         'drone_file': str(Path(dronefile).resolve()),
         'x_shift_m': x_shift,
@@ -481,8 +569,12 @@ def create_mask(dronedir, labelfile, planetfile, planetdir, outputdir, resize, m
     iio.imwrite(outputdir / f"{basename}.mask.png", mask_array)
 
     if drone_scale is not None:
+        png_dronefile = dronefile
+        if drone_cache is not None:
+            png_dronefile = drone_cache.get(
+                dronefile, planet_crs, drone_png_res(planet_res_m, resize, drone_scale))
         generate_drone_png(
-            dronefile, pimg, x_shift, y_shift, drone_scale,
+            png_dronefile, pimg, x_shift, y_shift, drone_scale,
             outputdir / f"{basename}.drone.png",
         )
 
@@ -492,21 +584,86 @@ def create_mask(dronedir, labelfile, planetfile, planetdir, outputdir, resize, m
     return record
 
 
-def process_label(dronedir, labelfile, planet_df, planetdir, outputdir, timewindow, resize, mode, maskdir=None, drone_scale=None, bands=3):
+def matching_planetfiles(labelfile, planet_df, timewindow):
     label_date = pd.to_datetime(
         get_cls_date(labelfile),
         format="%Y_%m_%d",
     )
 
     date_mask = (planet_df["date"] - label_date).abs() <= pd.Timedelta(days=timewindow)
-    planetfiles = planet_df.loc[date_mask]["path"]
+    return planet_df.loc[date_mask]["path"].tolist()
+
 
+def process_label(dronedir, labelfile, planet_df, planetdir, outputdir, timewindow, resize, mode, maskdir=None, drone_scale=None, bands=3, drone_cache=None, arosics_only=False):
     return [
-        create_mask(dronedir, labelfile, planetfile, planetdir, outputdir, resize, mode, maskdir, drone_scale, bands)
-        for planetfile in planetfiles.tolist()
+        create_mask(dronedir, labelfile, planetfile, planetdir, outputdir, resize, mode, maskdir, drone_scale, bands, drone_cache, arosics_only)
+        for planetfile in matching_planetfiles(labelfile, planet_df, timewindow)
     ]
 
 
+# -- scene-parallel mode ------------------------------------------------------
+
+_worker = {}
+
+
+def _init_worker(gdal_cache_mb, kwargs):
+    # Workers are spawned, so this runs before the process touches any
+    # dataset: GDAL sizes its block cache once, on first use, and N workers
+    # each defaulting to 5% of RAM adds up.
+    os.environ['GDAL_CACHEMAX'] = str(gdal_cache_mb)
+    _worker['kwargs'] = kwargs
+
+
+def _create_mask_task(task):
+    labelfile, planetfile = task
+    return create_mask(labelfile=labelfile, planetfile=planetfile,
+                       **_worker['kwargs'])
+
+
+def _warm_drone_cache(job):
+    drone_cache, dronefile, crs, res = job
+    drone_cache.get(dronefile, crs, res)
+    return drone_cache.misses
+
+
+def drone_cache_jobs(tasks, dronedir, resize, drone_scale, drone_cache):
+    """One (cache, dronefile, crs, res) job per cached mosaic the tasks need,
+    so workers do not resample the same mosaic concurrently."""
+    jobs = {}
+    for labelfile, planetfile in tasks:
+        dronefile = find_drone(labelfile, dronedir)
+        with rasterio.open(planetfile) as src:
+            crs, res = src.crs, src.res[0]
+        resolutions = [res]
+        if drone_scale is not None:
+            resolutions.append(drone_png_res(res, resize, drone_scale))
+        for r in resolutions:
+            path = drone_cache.path(dronefile, crs, r)
+            jobs.setdefault(path, (drone_cache, dronefile, crs, r))
+    return list(jobs.values())
+
+
+def run_parallel(tasks, workers, gdal_cache_mb, drone_cache, **kwargs):
+    """create_mask over (labelfile, planetfile) tasks on a process pool;
+    records come back in task order."""
+    kwargs['drone_cache'] = drone_cache
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(gdal_cache_mb, kwargs),
+                             mp_context=multiprocessing.get_context('spawn')) as pool:
+        if drone_cache is not None:
+            warm = drone_cache_jobs(tasks, kwargs['dronedir'], kwargs['resize'],
+                                    kwargs['drone_scale'], drone_cache)
+            built = sum(tqdm(pool.map(_warm_drone_cache, warm),
+                             'Resampling drone mosaics', total=len(warm)))
+            drone_cache.misses += built
+            drone_cache.hits += len(warm) - built
+        return list(tqdm(
+            pool.map(_create_mask_task, tasks,
+                     chunksize=max(1, len(tasks) // (8 * workers))),
+            'Applying labels', total=len(tasks),
+        ))
+
+
 def filter_files(planetfiles, filterdir):
     if filterdir is None:
         return planetfiles
@@ -540,9 +697,26 @@ def filter_files(planetfiles, filterdir):
               help='3 = RGB chips from *rgb.tif (default); 4 = RGB+NIR chips '
                    'from *4band.tif, written as a 4-band uint16 GeoTIFF plus '
                    'an RGB QA PNG.')
-def main(labelfiles, dronedir, planetdir, outputdir, timewindow, resize, filterdir, mode, maskdir, drone_scale, bands):
+@click.option('--drone-cache', 'drone_cache_dir', default=None, type=click.Path(),
+              help='Directory for drone mosaics resampled to Planet '
+                   'resolution (default: OUTPUTDIR/drone_cache).')
+@click.option('--no-drone-cache', is_flag=True,
+              help='Read the full-resolution drone mosaic for every scene.')
+@click.option('-w', '--workers', default=1, type=click.IntRange(min=1),
+              show_default=True,
+              help='Processes for (label, scene) pairs; 1 runs serially.')
+@click.option('--gdal-cache-mb', default=256, type=click.IntRange(min=16),
+              show_default=True, help='GDAL block cache per worker process.')
+@click.option('--arosics-only', is_flag=True,
+              help='Skip the phase-correlation fast path.')
+def main(labelfiles, dronedir, planetdir, outputdir, timewindow, resize, filterdir, mode, maskdir, drone_scale, bands, drone_cache_dir, no_drone_cache, workers, gdal_cache_mb, arosics_only):
     logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
 
+    drone_cache = None
+    if not no_drone_cache:
+        drone_cache = DroneMosaicCache(
+            drone_cache_dir or Path(outputdir) / 'drone_cache')
+
     planet_glob = '*4band.tif' if bands == 4 else '*rgb.tif'
     planetfiles = list(Path(planetdir).rglob(planet_glob))
     planetfiles = filter_files(planetfiles, filterdir)
@@ -555,13 +729,29 @@ def main(labelfiles, dronedir, planetdir, outputdir, timewindow, resize, filterd
         format="%Y%m%d",
     )
 
-    all_records = []
-    for labelfile in tqdm(labelfiles):
-        records = process_label(
-            dronedir, labelfile, planet_df, planetdir,
-            outputdir, timewindow, resize, mode, maskdir, drone_scale, bands,
+    if workers == 1:
+        all_records = []
+        for labelfile in tqdm(labelfiles):
+            records = process_label(
+                dronedir, labelfile, planet_df, planetdir,
+                outputdir, timewindow, resize, mode, maskdir, drone_scale, bands,
+                drone_cache, arosics_only,
+            )
+            all_records.extend(records)
+    else:
+        # Same (label, scene) order as the serial loop, so coreg_log.json
+        # is identical whichever mode wrote it.
+        tasks = [
+            (labelfile, planetfile)
+            for labelfile in labelfiles
+            for planetfile in matching_planetfiles(labelfile, planet_df, timewindow)
+        ]
+        all_records = run_parallel(
+            tasks, workers, gdal_cache_mb, drone_cache,
+            dronedir=dronedir, planetdir=planetdir, outputdir=outputdir,
+            resize=resize, mode=mode, maskdir=maskdir,
+            drone_scale=drone_scale, bands=bands, arosics_only=arosics_only,
         )
-        all_records.extend(records)
 
     if all_records:
         out_path = Path(outputdir) / 'coreg_log.json'
@@ -574,6 +764,10 @@ def main(labelfiles, dronedir, planetdir, outputdir, timewindow, resize, filterd
             len(all_records), len(all_records) - n_failed, n_failed, out_path,
         )
 
+    if drone_cache is not None:
+        log.info("Drone cache: %d reused, %d built in %s",
+                 drone_cache.hits, drone_cache.misses, drone_cache.cachedir)
+
 
 if __name__ == '__main__':
     main()
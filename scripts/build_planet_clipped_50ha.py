@@ -12,25 +12,43 @@ Outputs under `<output-root>/`:
     rgb/<YYYY>/<scene_id>_rgb.tif       uint8 3-band RGB
     inventory.csv                       per-scene source + status
     missing_at_planet.csv               scenes Planet has but we don't (API)
+    manifest.sqlite                     rebuild manifest (rebuild_manifest.py)
+    discovery_index.json                cached source-tree listings
+    inventory.partial.csv               streamed inventory of an unfinished run
+
+Each output is rebuilt only when missing or stale: the manifest records the
+content hash of its source raster and the clip region / stretch parameters it
+was built with. `--dry-run` reports how many outputs would be rebuilt.
+
+Source discovery goes through a directory-listing cache that is refreshed
+incrementally from directory stats (`--rescan` lists everything again), and scenes are clipped in a pool of
+`--workers` processes. Inventory rows are streamed to inventory.partial.csv as
+scenes finish, so an interrupted run resumes where it stopped; the sorted
+inventory.csv replaces it once the run completes.
 """
 import asyncio
 import csv
+import json
 import os
 import re
 import sys
+import time
 from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from functools import lru_cache
 from datetime import date, datetime
 from pathlib import Path
 
 import click
-import numpy as np
-import rasterio
-from rasterio.mask import mask as rio_mask
+import shapely.wkt
 from rasterio.warp import transform_geom
-from shapely.geometry import box, mapping, shape
+from shapely.geometry import mapping, shape
 from tqdm import tqdm
 
 sys.path.insert(0, str(Path(__file__).resolve().parent))
+from clip_planet_image import RegionClipper  # noqa: E402
+from rebuild_manifest import DEFAULT_MANIFEST_NAME, RebuildManifest  # noqa: E402
+from rgb_stretch import render_rgb_file  # noqa: E402
 from util import load_config  # noqa: E402
 
 SCENE_RE = re.compile(r'(\d{8}_\d{6}(?:_\d{1,3})?_[0-9a-f]{4})')
@@ -52,56 +70,133 @@ def _has_4band(p: Path) -> bool:
         and 'ndvi' not in p.name.lower() and '_sr' not in p.name.lower()
 
 
-def discover_csdap(csdap_root: Path):
+# A listing taken less than this long after its directory's mtime may have
+# missed entries added within the same mtime tick (2 s on exFAT, 1 s on some
+# NFS/SMB mounts), so it is not trusted on the next run.
+RACY_LISTING_NS = 2_000_000_000
+
+
+def _dir_signature(st: os.stat_result) -> list[int]:
+    return [st.st_mtime_ns, st.st_ctime_ns, st.st_ino, st.st_nlink]
+
+
+class DiscoveryIndex:
+    """Persistent directory-listing cache keyed on each directory's stat.
+
+    Adding or removing an entry bumps the mtime and ctime of its parent
+    directory, so a listing is reused for as long as the directory's mtime,
+    ctime, inode and link count are unchanged. A rerun over an unchanged tree
+    then costs one stat() per directory rather than a full listing of every
+    PSScene dir on the network volume. Listings taken within RACY_LISTING_NS
+    of the mtime are always redone, since volumes with coarse timestamps can
+    add an entry without changing them. Unreadable directories list as empty,
+    with a warning, and are not cached.
+    """
+
+    def __init__(self, path: Path | None, *, load: bool = True):
+        self.path = path
+        self.dirs: dict[str, dict] = {}
+        self.hits = self.misses = 0
+        if load and path is not None and path.is_file():
+            try:
+                with open(path) as f:
+                    self.dirs = json.load(f)
+            except (OSError, ValueError):
+                self.dirs = {}
+
+    def listdir(self, d: Path) -> list[tuple[str, bool]]:
+        """Return [(name, is_dir), ...] for `d`, or [] if it isn't a directory."""
+        key = str(d)
+        try:
+            signature = _dir_signature(os.stat(key))
+        except OSError:
+            self.dirs.pop(key, None)
+            return []
+        cached = self.dirs.get(key)
+        if (cached is not None and cached.get('stat') == signature
+                and cached['listed_ns'] - signature[0] >= RACY_LISTING_NS):
+            self.hits += 1
+            return [tuple(e) for e in cached['entries']]
+        self.misses += 1
+        listed_ns = time.time_ns()
+        try:
+            with os.scandir(key) as it:
+                entries = sorted((e.name, e.is_dir()) for e in it)
+        except NotADirectoryError:
+            return []
+        except PermissionError as e:
+            print(f'Warning: cannot list {key} ({e}); treating it as empty',
+                  file=sys.stderr)
+            self.dirs.pop(key, None)
+            return []
+        self.dirs[key] = {'stat': signature, 'listed_ns': listed_ns,
+                          'entries': entries}
+        return entries
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        tmp = self.path.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.dirs, f)
+        os.replace(tmp, self.path)
+
+
+def _find_dirs_named(index: DiscoveryIndex, root: Path, name: str):
+    """Equivalent of `root.rglob(name)` restricted to dirs, via the index."""
+    for entry, is_dir in index.listdir(root):
+        if not is_dir:
+            continue
+        child = root / entry
+        if entry == name:
+            yield child
+        yield from _find_dirs_named(index, child, name)
+
+
+def discover_csdap(csdap_root: Path, index: DiscoveryIndex | None = None):
     """Yield (scene_id, four_band_path|None, udm2_path|None) per CSDAP scene."""
+    index = index or DiscoveryIndex(None)
     planet_dir = csdap_root / 'planet'
-    if not planet_dir.is_dir():
-        return
-    for scene_dir in planet_dir.iterdir():
-        if not scene_dir.is_dir() or not scene_dir.name.startswith('PSScene-'):
+    for name, is_dir in index.listdir(planet_dir):
+        if not is_dir or not name.startswith('PSScene-'):
             continue
-        scene_id = scene_dir.name[len('PSScene-'):]
+        scene_dir = planet_dir / name
+        scene_id = name[len('PSScene-'):]
 
         four_band = None
         fb_dir = scene_dir / 'assets' / CSDAP_FOURBAND_SUBDIR
-        if fb_dir.is_dir():
-            for p in fb_dir.iterdir():
-                if p.name.endswith('_3B_AnalyticMS.tif') and _has_4band(p):
-                    four_band = p
-                    break
+        for fname, _ in index.listdir(fb_dir):
+            p = fb_dir / fname
+            if fname.endswith('_3B_AnalyticMS.tif') and _has_4band(p):
+                four_band = p
+                break
 
         udm2 = None
         u_dir = scene_dir / 'assets' / CSDAP_UDM2_SUBDIR
-        if u_dir.is_dir():
-            for p in u_dir.iterdir():
-                if p.name.endswith('_3B_udm2.tif'):
-                    udm2 = p
-                    break
+        for fname, _ in index.listdir(u_dir):
+            if fname.endswith('_3B_udm2.tif'):
+                udm2 = u_dir / fname
+                break
 
         if four_band or udm2:
             yield scene_id, four_band, udm2
 
 
-def discover_planet_direct(planet_root: Path):
+def discover_planet_direct(planet_root: Path, index: DiscoveryIndex | None = None):
     """Yield (scene_id, four_band_path|None, udm2_path|None) per Planet-direct
     order root. Walks every PSScene/ subdir under each order dir."""
-    if not planet_root.is_dir():
-        return
+    index = index or DiscoveryIndex(None)
     order_roots = [
-        d for d in planet_root.iterdir()
-        if d.is_dir() and any(
-            pat.match(d.name) for pat in PLANET_ORDER_DIR_PATTERNS)
+        planet_root / name for name, is_dir in index.listdir(planet_root)
+        if is_dir and any(pat.match(name) for pat in PLANET_ORDER_DIR_PATTERNS)
     ]
 
     # scene_id -> (4band, udm2)
     by_scene: dict[str, list[Path | None]] = defaultdict(lambda: [None, None])
 
     for root in order_roots:
-        for ps_dir in root.rglob('PSScene'):
-            if not ps_dir.is_dir():
-                continue
-            for f in ps_dir.iterdir():
-                name = f.name
+        for ps_dir in _find_dirs_named(index, root, 'PSScene'):
+            for name, _ in index.listdir(ps_dir):
                 m = SCENE_RE.match(name)
                 if not m:
                     continue
@@ -111,22 +206,23 @@ def discover_planet_direct(planet_root: Path):
                     continue
                 if name.endswith('_3B_AnalyticMS_clip.tif'):
                     if by_scene[sid][0] is None:
-                        by_scene[sid][0] = f
+                        by_scene[sid][0] = ps_dir / name
                 elif name.endswith('_3B_udm2_clip.tif'):
                     if by_scene[sid][1] is None:
-                        by_scene[sid][1] = f
+                        by_scene[sid][1] = ps_dir / name
 
     for sid, (fb, ud) in by_scene.items():
         if fb or ud:
             yield sid, fb, ud
 
 
-def choose_sources(csdap_root: Path, planet_root: Path):
+def choose_sources(csdap_root: Path, planet_root: Path,
+                   index: DiscoveryIndex | None = None):
     """Combine CSDAP and Planet-direct discoveries into one dict keyed by
     scene_id. CSDAP wins for both 4-band and UDM2; Planet-direct fills gaps."""
     chosen: dict[str, dict] = {}
 
-    for sid, fb, ud in discover_csdap(csdap_root):
+    for sid, fb, ud in discover_csdap(csdap_root, index):
         chosen[sid] = {
             'scene_id': sid,
             'four_band_src': str(fb) if fb else '',
@@ -135,7 +231,7 @@ def choose_sources(csdap_root: Path, planet_root: Path):
             'udm2_origin': 'csdap' if ud else '',
         }
 
-    for sid, fb, ud in discover_planet_direct(planet_root):
+    for sid, fb, ud in discover_planet_direct(planet_root, index):
         rec = chosen.setdefault(sid, {
             'scene_id': sid, 'four_band_src': '', 'udm2_src': '',
             'four_band_origin': '', 'udm2_origin': '',
@@ -164,88 +260,95 @@ def _filter_by_date(records: dict, start: date | None, end: date | None):
     return out
 
 
+@lru_cache(maxsize=4)
+def _clipper(region_wkt: str) -> RegionClipper:
+    # One clipper per region per process, so each worker rasterizes the
+    # 50ha window once per source grid rather than once per scene.
+    return RegionClipper(shapely.wkt.loads(region_wkt))
+
+
 def _clip_to(region, src_path: Path, out_path: Path) -> str:
     """Clip a single raster to `region`. Returns a status string."""
-    with rasterio.open(src_path) as data:
-        if not box(*data.bounds).intersects(region):
-            return 'no_intersection'
-        try:
-            out_img, out_trans = rio_mask(
-                data, shapes=[region], crop=True)
-        except ValueError:
-            return 'no_intersection'
-        if data.nodata is not None and np.all(out_img == data.nodata):
-            return 'nodata'
-        meta = data.meta.copy()
-        meta.update({
-            'transform': out_trans,
-            'height': out_img.shape[1],
-            'width': out_img.shape[2],
-            'driver': 'GTiff',
-        })
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    with rasterio.open(out_path, 'w', **meta) as out:
-        out.write(out_img)
-    return 'ok'
+    return _clipper(region.wkt).clip(src_path, out_path)
 
 
 def _render_rgb(four_band_path: Path, out_path: Path) -> str:
     """Per-band 2/98 percentile stretch on the clipped 4-band. Planet
     AnalyticMS band order is [Blue, Green, Red, NIR] (1,2,3,4). Output as
-    [Red, Green, Blue]."""
-    with rasterio.open(four_band_path) as src:
-        nodata = src.nodata
-        if src.count < 4:
-            return 'error'
-        red = src.read(3).astype(np.float32)
-        green = src.read(2).astype(np.float32)
-        blue = src.read(1).astype(np.float32)
-        validity = src.dataset_mask() > 0
-        crs = src.crs
-        transform = src.transform
-        height, width = red.shape
-
-    bands = (red, green, blue)
-    out = np.zeros((3, height, width), dtype=np.uint8)
-    for i, b in enumerate(bands):
-        valid = validity.copy()
-        if nodata is not None:
-            valid &= b != nodata
-        if not valid.any():
-            continue
-        lo, hi = np.percentile(b[valid], (2.0, 98.0))
-        if hi <= lo:
-            continue
-        scaled = np.clip((b - lo) * (255.0 / (hi - lo)), 0, 255)
-        scaled = np.where(valid, scaled, 0)
-        out[i] = scaled.astype(np.uint8)
-
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    with rasterio.open(
-        out_path, 'w', driver='GTiff', dtype='uint8', count=3,
-        height=height, width=width, crs=crs, transform=transform,
-        photometric='RGB',
-    ) as dst:
-        dst.write(out)
-    return 'ok'
-
-
-def process_scene(rec: dict, region, output_root: Path, force: bool) -> str:
-    sid = rec['scene_id']
+    [Red, Green, Blue]. Percentiles come from uint16 histograms, block by
+    block (see rgb_stretch.py)."""
+    return render_rgb_file(four_band_path, out_path, RGB_PARAMS['percentiles'])
+
+
+# Parameters, besides input content, that determine each output's pixels.
+# Bump the *_version keys when the corresponding code path changes.
+RGB_PARAMS = {'rgb_version': 1, 'percentiles': [2.0, 98.0]}
+OUTPUT_KINDS = ('four_band', 'udm2', 'rgb')
+
+
+def clip_params(region) -> dict:
+    return {'clip_version': 1, 'region': region.wkt}
+
+
+def scene_outputs(sid: str, output_root: Path) -> dict[str, Path]:
     year = sid[:4]
-    out_4 = output_root / '4band' / year / f'{sid}_4band.tif'
-    out_u = output_root / 'udm2' / year / f'{sid}_udm2.tif'
-    out_r = output_root / 'rgb' / year / f'{sid}_rgb.tif'
+    return {
+        'four_band': output_root / '4band' / year / f'{sid}_4band.tif',
+        'udm2': output_root / 'udm2' / year / f'{sid}_udm2.tif',
+        'rgb': output_root / 'rgb' / year / f'{sid}_rgb.tif',
+    }
+
+
+def output_inputs(rec: dict, outs: dict[str, Path]) -> dict[str, dict]:
+    """Manifest input roles for each output kind."""
+    return {
+        'four_band': {'src': Path(rec['four_band_src'])},
+        'udm2': {'src': Path(rec['udm2_src'])},
+        'rgb': {'four_band': outs['four_band']},
+    }
+
+
+def output_params(kind: str, region_params: dict) -> dict:
+    return RGB_PARAMS if kind == 'rgb' else region_params
+
+
+def plan_scene(rec: dict, output_root: Path, manifest, region_params: dict,
+               force: bool) -> set[str]:
+    """Return the output kinds of this scene that are missing or stale."""
+    outs = scene_outputs(rec['scene_id'], output_root)
+    inputs = output_inputs(rec, outs)
+    build = set()
+    for kind, src_key in (('four_band', 'four_band_src'), ('udm2', 'udm2_src')):
+        if rec[src_key] and (force or manifest.is_stale(
+                outs[kind], inputs[kind], region_params)):
+            build.add(kind)
+    # RGB depends on the clipped 4-band, so a new 4-band forces a new RGB.
+    if rec['four_band_src'] and (
+            force or 'four_band' in build
+            or manifest.is_stale(outs['rgb'], inputs['rgb'], RGB_PARAMS)):
+        build.add('rgb')
+    return build
+
+
+def process_scene(rec: dict, region, output_root: Path,
+                  build: set[str]) -> tuple[str, list[str]]:
+    """Clip / render the output kinds in `build`.
+
+    Returns (status, built) where built lists the kinds that were written
+    successfully and should be recorded in the manifest.
+    """
+    outs = scene_outputs(rec['scene_id'], output_root)
+    out_4, out_u, out_r = outs['four_band'], outs['udm2'], outs['rgb']
 
     have_all = all(p.exists() and p.stat().st_size > 0
                    for p in (out_4, out_u, out_r))
-    if have_all and not force:
-        return 'skipped_existing'
+    if have_all and not build:
+        return 'skipped_existing', []
 
     # 4-band first; RGB depends on it.
     status_4 = 'missing_src'
     if rec['four_band_src']:
-        if force or not (out_4.exists() and out_4.stat().st_size > 0):
+        if 'four_band' in build:
             status_4 = _clip_to(region, Path(rec['four_band_src']), out_4)
         else:
             status_4 = 'ok'
@@ -253,28 +356,37 @@ def process_scene(rec: dict, region, output_root: Path, force: bool) -> str:
         # Don't make RGB without a clipped 4-band
         out_r_status = 'skipped'
     else:
-        if force or not (out_r.exists() and out_r.stat().st_size > 0):
+        if 'rgb' in build:
             out_r_status = _render_rgb(out_4, out_r)
         else:
             out_r_status = 'ok'
 
     status_u = 'missing_src'
     if rec['udm2_src']:
-        if force or not (out_u.exists() and out_u.stat().st_size > 0):
+        if 'udm2' in build:
             status_u = _clip_to(region, Path(rec['udm2_src']), out_u)
         else:
             status_u = 'ok'
 
+    statuses = dict(zip(OUTPUT_KINDS, (status_4, status_u, out_r_status)))
+    built = [k for k in OUTPUT_KINDS if k in build and statuses[k] == 'ok']
+
     # Aggregate: any non-ok status surfaces; else 'ok'.
-    statuses = [status_4, status_u, out_r_status]
-    if all(s == 'ok' for s in statuses):
-        return 'ok'
-    if any(s == 'no_intersection' for s in statuses):
-        return 'no_intersection'
-    if any(s == 'nodata' for s in statuses):
-        return 'nodata'
-    return ';'.join(f'{k}={v}' for k, v in
-                    zip(('four_band', 'udm2', 'rgb'), statuses))
+    if all(s == 'ok' for s in statuses.values()):
+        return 'ok', built
+    if any(s == 'no_intersection' for s in statuses.values()):
+        return 'no_intersection', built
+    if any(s == 'nodata' for s in statuses.values()):
+        return 'nodata', built
+    return ';'.join(f'{k}={v}' for k, v in statuses.items()), built
+
+
+def record_built(manifest, rec: dict, output_root: Path, built: list[str],
+                 region_params: dict) -> None:
+    outs = scene_outputs(rec['scene_id'], output_root)
+    inputs = output_inputs(rec, outs)
+    for kind in built:
+        manifest.record(outs[kind], inputs[kind], output_params(kind, region_params))
 
 
 # ---------- Planet API missing-files report ----------
@@ -369,6 +481,12 @@ def planet_api_missing_report(region, search_config, start: date, end: date,
 TERMINAL_NEGATIVE_STATUSES = {'no_intersection', 'nodata'}
 
 
+INVENTORY_FIELDS = ['scene_id', 'four_band_origin', 'udm2_origin',
+                    'four_band_src', 'udm2_src', 'status']
+DISCOVERY_INDEX_NAME = 'discovery_index.json'
+PARTIAL_INVENTORY_NAME = 'inventory.partial.csv'
+
+
 def _load_prior_inventory(output_root: Path) -> dict[str, dict]:
     """Return prior inventory.csv keyed by scene_id, or {} if absent."""
     inv_csv = output_root / 'inventory.csv'
@@ -378,6 +496,35 @@ def _load_prior_inventory(output_root: Path) -> dict[str, dict]:
         return {row['scene_id']: row for row in csv.DictReader(f)}
 
 
+def _load_partial_inventory(partial_csv: Path) -> dict[str, dict]:
+    """Rows streamed by an interrupted run, keyed by scene_id.
+
+    Errored rows are dropped so those scenes are retried.
+    """
+    if not partial_csv.is_file():
+        return {}
+    with open(partial_csv, newline='') as f:
+        return {row['scene_id']: row for row in csv.DictReader(f)
+                if row.get('status') and not row['status'].startswith('error')}
+
+
+def _inventory_row(rec: dict, status: str) -> dict:
+    return {
+        'scene_id': rec['scene_id'],
+        'four_band_origin': rec['four_band_origin'],
+        'udm2_origin': rec['udm2_origin'],
+        'four_band_src': rec['four_band_src'],
+        'udm2_src': rec['udm2_src'],
+        'status': status,
+    }
+
+
+def _same_sources(row: dict | None, rec: dict) -> bool:
+    return (row is not None
+            and row.get('four_band_src', '') == rec['four_band_src']
+            and row.get('udm2_src', '') == rec['udm2_src'])
+
+
 def _parse_date(s):
     return datetime.strptime(s, '%Y-%m-%d').date()
 
@@ -405,11 +552,19 @@ def _parse_date(s):
 @click.option('--no-api-check', is_flag=True,
               help='Skip the Planet API missing-files report.')
 @click.option('--force', is_flag=True,
-              help='Re-clip and re-render even if outputs already exist.')
+              help='Re-clip and re-render even if outputs are up to date.')
+@click.option('--dry-run', is_flag=True,
+              help='Report how many outputs are missing or stale, then exit.')
 @click.option('--limit', type=int, default=0,
               help='Process only the first N scenes (for smoke tests).')
+@click.option('--workers', type=click.IntRange(min=1),
+              default=max(1, (os.cpu_count() or 2) - 1), show_default=True,
+              help='Clipping processes; 1 runs in this process.')
+@click.option('--rescan', is_flag=True,
+              help='Ignore the cached discovery index and list every dir.')
 def main(clip_config, search_config, output_root, csdap_root, planet_root,
-         start_date, end_date, no_api_check, force, limit):
+         start_date, end_date, no_api_check, force, dry_run, limit, workers,
+         rescan):
     clip_cfg = load_config(clip_config)
     search_cfg = load_config(search_config)
     region = shape(clip_cfg['region'])
@@ -418,9 +573,14 @@ def main(clip_config, search_config, output_root, csdap_root, planet_root,
     end = (_parse_date(end_date) if end_date
            else date.today())
 
+    output_root.mkdir(parents=True, exist_ok=True)
+
     # Source inventory
     print('Discovering local sources...')
-    records = choose_sources(csdap_root, planet_root)
+    index = DiscoveryIndex(output_root / DISCOVERY_INDEX_NAME, load=not rescan)
+    records = choose_sources(csdap_root, planet_root, index)
+    index.save()
+    print(f'  {index.hits} cached / {index.misses} rescanned directories.')
     records = _filter_by_date(records, start, end)
     print(f'  {len(records)} unique scene IDs in [{start}, {end}].')
 
@@ -428,54 +588,124 @@ def main(clip_config, search_config, output_root, csdap_root, planet_root,
     if limit:
         items = items[:limit]
 
-    output_root.mkdir(parents=True, exist_ok=True)
+    region_params = clip_params(region)
+    manifest = RebuildManifest(output_root / DEFAULT_MANIFEST_NAME,
+                               dry_run=dry_run)
+
+    if dry_run:
+        by_kind = dict.fromkeys(OUTPUT_KINDS, 0)
+        n_scenes = 0
+        for rec in tqdm(items, desc='Checking'):
+            build = plan_scene(rec, output_root, manifest, region_params, force)
+            n_scenes += bool(build)
+            for kind in build:
+                by_kind[kind] += 1
+        manifest.close()
+        print(f'Dry run: {n_scenes} of {len(items)} scenes would be rebuilt '
+              f'(4band: {by_kind["four_band"]}, udm2: {by_kind["udm2"]}, '
+              f'rgb: {by_kind["rgb"]}).')
+        return
 
     prior = _load_prior_inventory(output_root) if not force else {}
-    skipped_negatives = 0
+    partial_csv = output_root / PARTIAL_INVENTORY_NAME
+    resumed = _load_partial_inventory(partial_csv) if not force else {}
+    if resumed:
+        print(f'Resuming: {len(resumed)} scenes already done in an '
+              'interrupted run.')
+    skipped_negatives = n_resumed = 0
 
     inv_rows = []
-    for rec in tqdm(items, desc='Clipping'):
-        sid = rec['scene_id']
-        prev = prior.get(sid)
-        if (prev
-                and prev.get('status') in TERMINAL_NEGATIVE_STATUSES
-                and prev.get('four_band_src', '') == rec['four_band_src']
-                and prev.get('udm2_src', '') == rec['udm2_src']):
-            # Same source, previously confirmed empty inside 50ha polygon.
-            inv_rows.append({
-                'scene_id': sid,
-                'four_band_origin': rec['four_band_origin'],
-                'udm2_origin': rec['udm2_origin'],
-                'four_band_src': rec['four_band_src'],
-                'udm2_src': rec['udm2_src'],
-                'status': prev['status'],
-            })
-            skipped_negatives += 1
-            continue
+    with open(partial_csv, 'w', newline='') as pf:
+        partial = csv.DictWriter(pf, fieldnames=INVENTORY_FIELDS)
+        partial.writeheader()
+
+        def emit(row: dict) -> None:
+            inv_rows.append(row)
+            partial.writerow(row)
+            pf.flush()
+
+        def finish(fut) -> None:
+            rec = running.pop(fut)
+            try:
+                status, built = fut.result()
+                record_built(manifest, rec, output_root, built, region_params)
+            except Exception as e:  # noqa: BLE001
+                status = f'error:{type(e).__name__}:{e}'
+            emit(_inventory_row(rec, status))
+            pbar.update(1)
+
+        # Carry the interrupted run's rows over first, so they survive even
+        # if this run is interrupted too.
+        todo = []
+        for rec in items:
+            if _same_sources(resumed.get(rec['scene_id']), rec):
+                emit(_inventory_row(rec, resumed[rec['scene_id']]['status']))
+                n_resumed += 1
+            else:
+                todo.append(rec)
+
+        pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        running: dict = {}  # future -> rec
+        pbar = tqdm(total=len(todo), desc='Clipping')
         try:
-            status = process_scene(rec, region, output_root, force)
-        except Exception as e:  # noqa: BLE001
-            status = f'error:{type(e).__name__}:{e}'
-        inv_rows.append({
-            'scene_id': sid,
-            'four_band_origin': rec['four_band_origin'],
-            'udm2_origin': rec['udm2_origin'],
-            'four_band_src': rec['four_band_src'],
-            'udm2_src': rec['udm2_src'],
-            'status': status,
-        })
+            for rec in todo:
+                sid = rec['scene_id']
+                prev = prior.get(sid)
+                if (_same_sources(prev, rec)
+                        and prev.get('status') in TERMINAL_NEGATIVE_STATUSES):
+                    # Same source, previously confirmed empty inside 50ha polygon.
+                    emit(_inventory_row(rec, prev['status']))
+                    skipped_negatives += 1
+                    pbar.update(1)
+                    continue
+                try:
+                    build = plan_scene(rec, output_root, manifest,
+                                       region_params, force)
+                except Exception as e:  # noqa: BLE001
+                    emit(_inventory_row(rec, f'error:{type(e).__name__}:{e}'))
+                    pbar.update(1)
+                    continue
 
+                if pool is None:
+                    try:
+                        status, built = process_scene(
+                            rec, region, output_root, build)
+                        record_built(manifest, rec, output_root, built,
+                                     region_params)
+                    except Exception as e:  # noqa: BLE001
+                        status = f'error:{type(e).__name__}:{e}'
+                    emit(_inventory_row(rec, status))
+                    pbar.update(1)
+                    continue
+
+                fut = pool.submit(process_scene, rec, region, output_root, build)
+                running[fut] = rec
+                # Planning (manifest hashing) overlaps with clipping; keep a
+                # bounded backlog so results stream out as they finish.
+                while len(running) >= 4 * workers:
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for fut in done:
+                        finish(fut)
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    finish(fut)
+        finally:
+            pbar.close()
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+            manifest.close()
     if skipped_negatives:
         print(f'Skipped {skipped_negatives} scenes with prior terminal '
               'negative status (no_intersection / nodata, unchanged source).')
 
+    inv_rows.sort(key=lambda r: r['scene_id'])
     inv_csv = output_root / 'inventory.csv'
     with open(inv_csv, 'w', newline='') as f:
-        w = csv.DictWriter(f, fieldnames=[
-            'scene_id', 'four_band_origin', 'udm2_origin',
-            'four_band_src', 'udm2_src', 'status'])
+        w = csv.DictWriter(f, fieldnames=INVENTORY_FIELDS)
         w.writeheader()
         w.writerows(inv_rows)
+    partial_csv.unlink()
     print(f'Wrote {inv_csv}')
 
     # Locally accounted-for scene IDs: those with an OK 4-band clip on
@@ -1,21 +1,13 @@
 #!/usr/bin/env python
 import os
 import click
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 from glob import glob
 from pathlib import Path
 from werkzeug.security import safe_join
 
-from calculate_ndvi import ndvi
-
-
-def find_metadata(image):
-    base, ext = os.path.splitext(image)
-    parts = base.split('_')
-    assert parts[-1] == 'clip'
-    new = '_'.join(parts[:-1]) + '_metadata_clip.xml'
-    assert os.path.exists(new)
-    return new
+from calculate_ndvi import SCALED_DTYPES, CoefficientCache, find_metadata, ndvi
 
 
 def get_outputfile(image):
@@ -23,21 +15,48 @@ def get_outputfile(image):
     return base + '_ndvi' + ext
 
 
+def _ndvi_job(job):
+    inputfile, outputfile, dtype, coeffs = job
+    return ndvi(inputfile, None, outputfile, dtype, coeffs)
+
+
 @click.command()
 @click.argument('inputdir', type=click.Path(
     path_type=Path, exists=True
 ))
-def main(inputdir):
+@click.option('--coefficients', default=None, type=click.Path(path_type=Path),
+              help='Parquet reflectance coefficient table, read and extended in place.')
+@click.option('--table-only', is_flag=True,
+              help='Only fill --coefficients (for NDVI computed on read); write no rasters.')
+@click.option('--dtype', type=click.Choice(['float32', *SCALED_DTYPES]), default='float32',
+              show_default=True, help='NDVI raster type; integer types are scaled (calculate_ndvi.py).')
+@click.option('--workers', type=click.IntRange(min=1),
+              default=os.cpu_count() or 1, show_default=True)
+def main(inputdir, coefficients, table_only, dtype, workers):
+
+    if table_only and coefficients is None:
+        raise click.UsageError('--table-only needs --coefficients')
 
     inputfiles = glob(safe_join(inputdir, '*MS_clip.tif'))
 
+    # Coefficients are parsed here, once per scene (or read from the table),
+    # so the workers only do raster I/O
+    cache = CoefficientCache(coefficients)
     jobs = [
-        (f, find_metadata(f), get_outputfile(f))
-        for f in inputfiles
+        (f, get_outputfile(f), dtype, cache.get(find_metadata(f)))
+        for f in tqdm(inputfiles, 'Reading coefficients')
     ]
+    cache.save()
+
+    if table_only:
+        print(f'{len(cache)} scenes in {coefficients}')
+        return
 
-    for job in tqdm(jobs, 'Calculating NDVI'):
-        ndvi(*job)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        list(tqdm(
+            pool.map(_ndvi_job, jobs, chunksize=max(1, len(jobs) // (8 * workers))),
+            'Calculating NDVI', total=len(jobs),
+        ))
 
 
 if __name__ == '__main__':
@@ -1,10 +1,27 @@
 #!/usr/bin/env python
+import os
 import click
 import rasterio
 import numpy as np
+import pandas as pd
 from pathlib import Path
 from xml.dom import minidom
 
+# Reflectance coefficients kept per scene (Planet AnalyticMS band numbers)
+BANDS = (1, 2, 3, 4)
+RED, NIR = 3, 4
+
+# Scaled integer NDVI: value = round((ndvi - offset) / NDVI_SCALE), nodata
+# where either input band is nodata. The scale and offset are written to the
+# band metadata so GDAL-aware readers (and read_ndvi) undo them. float32 NDVI
+# keeps the scene's nodata value, so only pixels whose NDVI equals it (with
+# Planet's nodata of 0: both bands 0) read as masked there.
+NDVI_SCALE = 1e-4
+SCALED_DTYPES = {
+    'int16': {'offset': 0.0, 'nodata': -32768},
+    'uint16': {'offset': -1.0, 'nodata': 65535},
+}
+
 
 def get_coeff(metadata_file):
     """
@@ -27,6 +44,147 @@ def get_coeff(metadata_file):
     return coeffs
 
 
+def find_metadata(image):
+    base, ext = os.path.splitext(image)
+    parts = base.split('_')
+    if parts[-1] != 'clip':
+        raise ValueError(f'Not a clipped Planet scene: {image}')
+    new = '_'.join(parts[:-1]) + '_metadata_clip.xml'
+    if not os.path.exists(new):
+        raise FileNotFoundError(f'No metadata for {image}: {new}')
+    return new
+
+
+class CoefficientCache:
+    """
+    Reflectance coefficients by metadata filename, kept in a Parquet table
+    (metadata, coeff_1 .. coeff_4; one row per scene) so every XML file is
+    parsed once. Keyed by basename, so the table stays valid when the data
+    volume is mounted elsewhere.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._coeffs = {}
+        self._dirty = False
+        if path is not None and os.path.exists(path):
+            df = pd.read_parquet(path)
+            for row in df.itertuples(index=False):
+                self._coeffs[row.metadata] = {
+                    b: float(getattr(row, f'coeff_{b}')) for b in BANDS
+                    if pd.notna(getattr(row, f'coeff_{b}'))
+                }
+
+    def __len__(self):
+        return len(self._coeffs)
+
+    def __contains__(self, metadata_file):
+        return os.path.basename(metadata_file) in self._coeffs
+
+    def get(self, metadata_file):
+        """Coefficients {band: value} of a scene, parsed on the first request."""
+        name = os.path.basename(metadata_file)
+        if name not in self._coeffs:
+            self._coeffs[name] = get_coeff(metadata_file)
+            self._dirty = True
+        return self._coeffs[name]
+
+    def save(self):
+        """Write the table if coefficients were added since it was read."""
+        if self.path is None or not self._dirty:
+            return
+        df = pd.DataFrame({
+            'metadata': list(self._coeffs),
+            **{f'coeff_{b}': [c.get(b, np.nan) for c in self._coeffs.values()] for b in BANDS},
+        })
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, self.path)
+        self._dirty = False
+
+
+def ndvi_from_bands(red, nir, coeffs):
+    """NDVI (float64) of raw red and NIR DNs scaled to TOA reflectance."""
+    band_red = (red * coeffs[RED]).astype(float)
+    band_nir = (nir * coeffs[NIR]).astype(float)
+
+    # Handle division by zero
+    total = band_nir + band_red
+    total[total == 0] = 1e-9
+
+    return (band_nir - band_red) / total
+
+
+def _check_bands(src):
+    assert src.descriptions[2] == 'red'
+    assert src.descriptions[3] == 'nir'
+
+
+class NDVIReader:
+    """
+    NDVI of a Planet AnalyticMS scene computed on read, only over the
+    requested window. Reads like the single-band float32 raster ndvi()
+    would write (transform, width, height, nodata, read(1, window=...)),
+    so the red and NIR bands are read once and nothing is stored.
+    Masked reads mask the same pixels as that raster: those whose NDVI
+    equals the scene's nodata value.
+    """
+
+    def __init__(self, inputfile, coeffs):
+        self.src = rasterio.open(inputfile)
+        _check_bands(self.src)
+        self.coeffs = coeffs
+        self.name = self.src.name
+        self.crs = self.src.crs
+        self.transform = self.src.transform
+        self.width = self.src.width
+        self.height = self.src.height
+        self.shape = self.src.shape
+        self.nodata = self.src.nodata
+        self.count = 1
+        self.dtypes = ('float32',)
+        self.scales = (1.0,)
+        self.offsets = (0.0,)
+
+    def read(self, indexes=1, window=None, masked=False):
+        if indexes not in (1, [1]):
+            raise IndexError(f'NDVI has a single band, not {indexes}')
+        red, nir = self.src.read([RED, NIR], window=window)
+        ndvi = ndvi_from_bands(red, nir, self.coeffs).astype(np.float32)
+        if masked:
+            invalid = np.zeros(ndvi.shape, dtype=bool)
+            if self.nodata is not None:
+                invalid = ndvi == np.float32(self.nodata)
+            ndvi = np.ma.masked_array(ndvi, mask=invalid)
+        return ndvi[np.newaxis] if isinstance(indexes, list) else ndvi
+
+    def close(self):
+        self.src.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_ndvi(inputfile, metafile=None, cache=None):
+    """NDVIReader of an AnalyticMS scene; coefficients from `cache` if given."""
+    metafile = metafile or find_metadata(str(inputfile))
+    coeffs = cache.get(metafile) if cache is not None else get_coeff(metafile)
+    return NDVIReader(inputfile, coeffs)
+
+
+def read_ndvi(src, window=None):
+    """
+    NDVI values (float64, NaN at nodata) of a window of an NDVI raster of any
+    dtype ndvi() writes, or of an NDVIReader.
+    """
+    data = src.read(1, window=window, masked=True)
+    values = data.astype(float) * src.scales[0] + src.offsets[0]
+    return np.ma.filled(values, np.nan)
+
+
 @click.command()
 @click.argument('inputfile', type=click.Path(
     path_type=Path, exists=True
@@ -37,36 +195,48 @@ def get_coeff(metadata_file):
 @click.argument('outputfile', type=click.Path(
     path_type=Path, exists=False
 ))
-def main(inputfile, metafile, outputfile):
-    ndvi(inputfile, metafile, outputfile)
+@click.option('--dtype', type=click.Choice(['float32', *SCALED_DTYPES]), default='float32',
+              show_default=True, help=f'Scaled integers store round(NDVI / {NDVI_SCALE}), '
+                                      'shifted by +1 for uint16.')
+def main(inputfile, metafile, outputfile, dtype):
+    ndvi(inputfile, metafile, outputfile, dtype)
 
 
-def ndvi(inputfile, metafile, outputfile):
+def ndvi(inputfile, metafile, outputfile, dtype='float32', coeffs=None):
 
-    coeffs = get_coeff(metafile)
+    if coeffs is None:
+        coeffs = get_coeff(metafile)
 
     with rasterio.open(inputfile) as src:
-        assert src.descriptions[2] == 'red'
-        assert src.descriptions[3] == 'nir'
-        band_red = (src.read(3) * coeffs[3]).astype(float)
-        band_nir = (src.read(4) * coeffs[4]).astype(float)
+        _check_bands(src)
+        red = src.read(RED)
+        nir = src.read(NIR)
+        nodata = src.nodata
 
         out_meta = src.meta.copy()
 
+    ndvi = ndvi_from_bands(red, nir, coeffs)
+
     out_meta.update({
-        'dtype': rasterio.float32,
+        'dtype': dtype,
         'count': 1,
     })
 
-    # Handle division by zero
-    total = band_nir + band_red
-    total[total == 0] = 1e-9
+    if dtype == 'float32':
+        with rasterio.open(outputfile, 'w', **out_meta) as out:
+            out.write_band(1, ndvi.astype(rasterio.float32))
+        return True
 
-    # Calculate NDVI
-    ndvi = (band_nir - band_red) / total
+    scaled = SCALED_DTYPES[dtype]
+    values = np.round((ndvi - scaled['offset']) / NDVI_SCALE).astype(dtype)
+    if nodata is not None:
+        values[(red == nodata) | (nir == nodata)] = scaled['nodata']
+    out_meta['nodata'] = scaled['nodata']
 
     with rasterio.open(outputfile, 'w', **out_meta) as out:
-        out.write_band(1, ndvi.astype(rasterio.float32))
+        out.write_band(1, values)
+        out.scales = (NDVI_SCALE,)
+        out.offsets = (scaled['offset'],)
 
     return True
 
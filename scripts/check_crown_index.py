@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Checks of the date handling in crown_index.py.
+
+image_date() must find the flight date in drone filenames and no date in
+Planet scene names, and build_index() must index a dated crown map on
+synthetic drone and Planet grids so that drone grids get the crowns of
+their flight and Planet grids get every crown.
+
+    python scripts/check_crown_index.py
+"""
+import sys
+import tempfile
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from shapely.geometry import Point
+
+from crown_index import build_index, image_date
+
+FAIL = "\033[31mFAIL\033[0m"
+OK   = "\033[32mOK\033[0m"
+
+# Filenames as they come out of the Planet orders and the drone pipeline
+FILENAMES = {
+    '20230101_150000_12_2451_3B_AnalyticMS_clip.tif': '',
+    '20230101_150000_12_2451_3B_AnalyticMS_clip_rgb.tif': '',
+    '20230101_150000_12_2451_3B_AnalyticMS_clip_ndvi.tif': '',
+    '20230101_150000_12_2451_3B_udm2_clip.tif': '',
+    '20190105_153012_1034_3B_AnalyticMS_clip.tif': '',
+    '20191230_151559_0f4e_3B_AnalyticMS_clip_rgb.tif': '',
+    '20210308_152233_29_2262_3B_udm2.tif': '',
+    'BCI_50ha_2021_01_27_local_classifications.tif': '2021_01_27',
+    'BCI_50ha_2022_03_30_local_classifications.tif': '2022_03_30',
+    'BCI_ava_2020_08_01_orthomosaic.tif': '2020_08_01',
+    'BCI_50ha_2018_04_04_orthomosaic_local.tif': '2018_04_04',
+}
+
+
+def assert_ok(condition, message):
+    if not condition:
+        print(f"{FAIL}: {message}")
+        sys.exit(1)
+    print(f"{OK}: {message}")
+
+
+def write_raster(path, origin):
+    with rasterio.open(path, 'w', driver='GTiff', width=100, height=100, count=1,
+                       dtype='uint8', crs='EPSG:32617',
+                       transform=from_origin(*origin, 1, 1)) as dst:
+        dst.write(np.zeros((1, 100, 100), np.uint8))
+
+
+def main():
+    for name, expected in FILENAMES.items():
+        assert_ok(image_date(name) == expected,
+                  f"image_date({name!r}) == {expected!r} (got {image_date(name)!r})")
+
+    # Two flights of the same three crowns
+    crowns = gpd.GeoDataFrame(
+        {'tag': ['1', '2', '3'] * 2,
+         'date': ['2021_01_27'] * 3 + ['2022_03_30'] * 3},
+        geometry=[Point(625000 + 20 * i, 1011000 - 20 * i).buffer(5) for i in range(3)] * 2,
+        crs='EPSG:32617',
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        drone = Path(tmp, 'BCI_50ha_2021_01_27_local_classifications.tif')
+        planet = Path(tmp, '20230101_150000_12_2451_3B_AnalyticMS_clip_rgb.tif')
+        write_raster(drone, (624990, 1011010))
+        write_raster(planet, (624980, 1011020))
+        index = build_index(crowns, [drone, planet])
+
+    by_grid = index.groupby('grid')['date'].apply(set)
+    assert_ok(len(by_grid) == 2, f"{len(by_grid)} grids indexed")
+    assert_ok(sorted(map(sorted, by_grid)) == [['2021_01_27'], ['2021_01_27', '2022_03_30']],
+              "drone grid has its flight, Planet grid every date")
+    print(f"\n{OK}: All crown index checks passed.")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,25 @@
 #!/usr/bin/env python
 import os
 import click
+from concurrent.futures import ProcessPoolExecutor
 from tqdm import tqdm
 from pathlib import Path
 from werkzeug.security import safe_join
 
-from clip_planet_image import clip
+from clip_planet_image import clipper_for_config
+
+_worker_config = None
+
+
+def _init_worker(configfile):
+    global _worker_config
+    _worker_config = configfile
+
+
+def _clip_job(job):
+    inputfile, outputfile = job
+    return clipper_for_config(_worker_config).clip(inputfile, outputfile)
+
 
 @click.command()
 @click.argument('inputfiles', nargs=-1,
@@ -18,15 +32,27 @@ from clip_planet_image import clip
 @click.argument('outputdir', type=click.Path(
     path_type=Path, exists=True
 ))
-def main(inputfiles, configfile, outputdir):
+@click.option('--workers', type=click.IntRange(min=1),
+              default=os.cpu_count() or 1, show_default=True,
+              help='Clipping processes; each keeps its own per-grid window cache.')
+def main(inputfiles, configfile, outputdir, workers):
 
     jobs = [
-        (f, configfile, safe_join(outputdir, os.path.basename(f)))
+        (f, safe_join(outputdir, os.path.basename(f)))
         for f in inputfiles
     ]
 
-    for job in tqdm(jobs, 'Clipping images'):
-        clip(*job)
+    # Clipping the small AOI is dominated by the window read, so batch the
+    # file list over a process pool rather than walking it serially.
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(configfile,)) as pool:
+        statuses = list(tqdm(
+            pool.map(_clip_job, jobs, chunksize=max(1, len(jobs) // (8 * workers))),
+            'Clipping images', total=len(jobs),
+        ))
+
+    n_ok = statuses.count('ok')
+    print(f'{n_ok} clipped, {len(statuses) - n_ok} outside AOI or nodata')
 
 
 if __name__ == '__main__':
@@ -1,59 +1,139 @@
 #!/usr/bin/env python
+from collections import OrderedDict
+from functools import lru_cache
+
 import click
 import rasterio
-from rasterio.mask import mask
+from rasterio.mask import raster_geometry_mask
 import numpy as np
 from pathlib import Path
 from shapely.geometry import shape, box
 
 from util import load_config
 
+# Grids whose window and mask RegionClipper keeps (least recently used dropped)
+GRID_CACHE_SIZE = 32
 
-@click.command()
-@click.argument('inputfile', type=click.Path(
-    path_type=Path, exists=True
-))
-@click.argument('configfile', type=click.Path(
-    path_type=Path, exists=True
-))
-@click.argument('outputfile', type=click.Path(
-    path_type=Path, exists=False
-))
-def main(inputfile, configfile, outputfile):
-    clip(inputfile, configfile, outputfile)
 
+class RegionClipper:
+    """Clip rasters to one AOI polygon, reading only the AOI window.
 
-def clip(inputfile, configfile, outputfile):
+    Produces the same pixels as `rasterio.mask.mask(data, [region],
+    crop=True, **mask_kwargs)`, but the window, window transform and polygon
+    mask depend only on the raster grid (CRS, transform, size). They are
+    reused while the grid recurs (rasters already on a common grid, or the
+    same scene clipped again); raw PSScene assets rarely share a grid, so
+    only the last GRID_CACHE_SIZE grids are kept.
+    """
 
-    config = load_config(configfile)
-    region = shape(config['region'])
-    mask_kwargs = config.get('mask_kwargs', {})
+    def __init__(self, region, all_touched=False, invert=False, nodata=None,
+                 filled=True, pad=False, pad_width=0.5, indexes=None):
+        self.region = region
+        self.all_touched = all_touched
+        self.invert = invert
+        self.nodata = nodata
+        self.filled = filled
+        self.pad = pad
+        self.pad_width = pad_width
+        self.indexes = indexes
+        self._grids = OrderedDict()
 
-    with rasterio.open(inputfile) as data:
-        bounds = box(*data.bounds)
-        if not bounds.intersects(region):
-            return False
+    @classmethod
+    def from_config(cls, configfile):
+        config = load_config(configfile)
+        return cls(shape(config['region']), **config.get('mask_kwargs', {}))
 
+    def _grid(self, data):
+        """(shape_mask, transform, window) for this grid, or None if the AOI
+        misses it."""
+        key = (data.crs.to_wkt() if data.crs else None, tuple(data.transform),
+               data.width, data.height)
+        if key in self._grids:
+            self._grids.move_to_end(key)
         else:
-            out_img, out_trans = mask(
-                data, shapes=[region], crop=True, **mask_kwargs
-            )
-            if np.all(out_img == data.nodata):
-                return False
+            grid = None
+            if box(*data.bounds).intersects(self.region):
+                try:
+                    grid = raster_geometry_mask(
+                        data, [self.region], all_touched=self.all_touched,
+                        invert=self.invert, crop=True, pad=self.pad,
+                        pad_width=self.pad_width,
+                    )
+                except ValueError:
+                    # Bounding boxes touch but the polygon has no pixels here
+                    grid = None
+            self._grids[key] = grid
+            if len(self._grids) > GRID_CACHE_SIZE:
+                self._grids.popitem(last=False)
+        return self._grids[key]
 
-        out_meta = data.meta.copy()
+    def read(self, data):
+        """Return (out_img, out_transform) for an open dataset, or None."""
+        grid = self._grid(data)
+        if grid is None:
+            return None
+        shape_mask, transform, window = grid
+        nodata = self.nodata
+        if nodata is None:
+            nodata = data.nodata if data.nodata is not None else 0
+
+        out_img = data.read(window=window, masked=True, indexes=self.indexes)
+        out_img.mask = out_img.mask | shape_mask
+        if self.filled:
+            out_img = out_img.filled(nodata)
+        return out_img, transform
+
+    def clip(self, inputfile, outputfile):
+        """Clip one file. Returns 'ok', 'no_intersection' or 'nodata'."""
+        with rasterio.open(inputfile) as data:
+            result = self.read(data)
+            if result is None:
+                return 'no_intersection'
+            out_img, out_trans = result
+            if data.nodata is not None and np.all(out_img == data.nodata):
+                return 'nodata'
+
+            out_meta = data.meta.copy()
 
         out_meta.update({
             'transform': out_trans,
-            'height': out_img.shape[1],
-            'width': out_img.shape[2],
+            'height': out_img.shape[-2],
+            'width': out_img.shape[-1],
             'driver': 'GTiff',
         })
+        if out_img.ndim == 2:
+            out_img = out_img[np.newaxis]
+        out_meta['count'] = out_img.shape[0]
 
+        Path(outputfile).parent.mkdir(parents=True, exist_ok=True)
         with rasterio.open(outputfile, 'w', **out_meta) as out:
             out.write(out_img)
+        return 'ok'
+
 
-    return True
+@lru_cache(maxsize=8)
+def clipper_for_config(configfile):
+    """One RegionClipper per config file, so the YAML is parsed once."""
+    return RegionClipper.from_config(configfile)
+
+
+@click.command()
+@click.argument('inputfile', type=click.Path(
+    path_type=Path, exists=True
+))
+@click.argument('configfile', type=click.Path(
+    path_type=Path, exists=True
+))
+@click.argument('outputfile', type=click.Path(
+    path_type=Path, exists=False
+))
+def main(inputfile, configfile, outputfile):
+    clip(inputfile, configfile, outputfile)
+
+
+def clip(inputfile, configfile, outputfile):
+    return clipper_for_config(Path(configfile)).clip(
+        inputfile, outputfile) == 'ok'
 
 
 if __name__ == '__main__':
@@ -4,7 +4,21 @@
 Walks --input-dir for `*_4band.tif` files and writes a parallel tree of 5-band
 uint8 GeoTIFFs under --output-dir. Each output contains the argmax class label
 in band 1 and the per-class softmax confidences (scaled to 0-255) in bands 2-5.
-Existing outputs are skipped unless --force is given.
+Masks are only rebuilt when missing or stale: a rebuild manifest
+(`<output-dir>/manifest.sqlite`, see rebuild_manifest.py) records the input
+content hash, OCM version, band order and pipeline parameters of every mask.
+--dry-run reports how many would be rebuilt; --force rebuilds everything.
+
+With --workers N the per-scene work is pipelined: N CPU worker processes
+prepare model inputs and write outputs while this process keeps the inference
+device busy, with up to --prefetch scenes prepared ahead. Per-stage busy time
+and throughput are reported at the end of every run.
+
+With --scene-batch N, the model patches of up to N small scenes (at most 512
+px on a side at the 10 m model grid, e.g. the 50ha and AVA clips) run through
+the model in shared forward passes instead of one call per scene. The patches
+and their blending are those of the per-scene path, so the masks are the same;
+this needs the pinned omnicloudmask version (see OCM_BATCH_VERSION).
 
 Class encoding (band 1):
     0=Clear, 1=Thick Cloud, 2=Thin Cloud, 3=Cloud Shadow, 255=NoData
@@ -18,11 +32,13 @@ The model runs at 10 m and the output is nearest-neighbor upsampled to the nativ
 ~3 m grid; mask edge precision is therefore ~10 m even on the 3 m grid.
 
 Required dependency (install into the `flower` conda env before running):
-    pip install 'omnicloudmask>=1,<2'
+    pip install 'omnicloudmask==1.7.1'
 
 Typical usage:
     python scripts/cloud_mask_planet.py
     python scripts/cloud_mask_planet.py --force
+    python scripts/cloud_mask_planet.py --workers 6 --prefetch 8
+    python scripts/cloud_mask_planet.py --workers 4 --scene-batch 32
     python scripts/cloud_mask_planet.py \\
         --input-dir /Volumes/Earth03/flower/planet_clipped/4band \\
         --output-dir /Volumes/Earth03/flower/planet_clipped/ocm
@@ -31,24 +47,31 @@ from __future__ import annotations
 
 import logging
 import math
-import shutil
+import multiprocessing
 import sys
-import tempfile
+import time
 import warnings
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from dataclasses import dataclass
 from datetime import datetime, timezone
 from pathlib import Path
+from typing import Callable
 
 import click
 import numpy as np
 import rasterio as rio
 from rasterio.enums import Resampling
-from rasterio.transform import Affine
+from rasterio.io import MemoryFile
+from rasterio.transform import Affine, array_bounds
 from rasterio.warp import calculate_default_transform, reproject
 from tqdm import tqdm
 
 import omnicloudmask as ocm
 
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from rebuild_manifest import DEFAULT_MANIFEST_NAME, RebuildManifest  # noqa: E402
+
 log = logging.getLogger("cloud_mask_planet")
 
 # ---------------------------------------------------------------------------
@@ -74,6 +97,10 @@ DEFAULT_OUTPUT_DIR = Path("/Volumes/Earth03/flower/planet_clipped/ocm")
 DEFAULT_GLOB = "*_4band.tif"
 DEVICE_CHOICES = ["auto", "cpu", "cuda", "mps"]
 
+# Bump when a change to this script alters the pixels it writes, so the
+# rebuild manifest marks every existing mask stale.
+PIPELINE_VERSION = 2
+
 
 # ---------------------------------------------------------------------------
 # Device resolution
@@ -112,20 +139,27 @@ def _resolve_device(pref: str = "auto", batch_size: int = 4, dtype: str = "bf16"
 
 # ---------------------------------------------------------------------------
 # Input handling: band detection, UTM reprojection, saturation
+#
+# Everything below works on in-memory (bands, H, W) arrays paired with a
+# rasterio profile, so a scene is decoded from disk once and encoded once.
 
 
-def detect_band_order(path: Path) -> list[int]:
-    with rio.open(path) as src:
-        n = src.count
+def _band_order_for_count(n: int, label: Path | str) -> list[int]:
     if n < 4:
-        raise ValueError(f"{path}: need at least 4 bands, got {n}")
+        raise ValueError(f"{label}: need at least 4 bands, got {n}")
     if n == 4:
         return list(PLANETSCOPE_4BAND_ORDER)
     if n == 8:
         log.warning("%s: 8-band SuperDove detected; using band_order=%s",
-                    path, PLANETSCOPE_8BAND_ORDER)
+                    label, PLANETSCOPE_8BAND_ORDER)
         return list(PLANETSCOPE_8BAND_ORDER)
-    raise ValueError(f"{path}: unsupported band count {n}; expected 4 or 8")
+    raise ValueError(f"{label}: unsupported band count {n}; expected 4 or 8")
+
+
+def detect_band_order(path: Path) -> list[int]:
+    with rio.open(path) as src:
+        n = src.count
+    return _band_order_for_count(n, path)
 
 
 def _utm_epsg_from_lonlat(lon: float, lat: float) -> int:
@@ -133,39 +167,47 @@ def _utm_epsg_from_lonlat(lon: float, lat: float) -> int:
     return (32600 if lat >= 0 else 32700) + zone
 
 
-def ensure_utm(path: Path, tmp_dir: Path) -> Path:
-    """Reproject to local UTM if input is geographic; pass through otherwise."""
+def read_scene(path: Path) -> tuple[np.ndarray, dict]:
+    """Read all bands of a scene into memory. Returns (array, profile)."""
     with rio.open(path) as src:
-        if src.crs is not None and not src.crs.is_geographic:
-            return path
-        if src.crs is None:
-            raise ValueError(f"{path}: missing CRS")
-        b = src.bounds
-        lon = 0.5 * (b.left + b.right)
-        lat = 0.5 * (b.bottom + b.top)
-        dst_epsg = _utm_epsg_from_lonlat(lon, lat)
-        dst_crs = rio.crs.CRS.from_epsg(dst_epsg)
-        transform, width, height = calculate_default_transform(
-            src.crs, dst_crs, src.width, src.height, *src.bounds
-        )
-        profile = src.profile.copy()
-        profile.update(crs=dst_crs, transform=transform, width=width, height=height)
-        tmp_dir.mkdir(parents=True, exist_ok=True)
-        out_path = tmp_dir / f"{path.stem}_utm.tif"
-        with rio.open(out_path, "w", **profile) as dst:
-            for i in range(1, src.count + 1):
-                reproject(
-                    source=rio.band(src, i),
-                    destination=rio.band(dst, i),
-                    src_transform=src.transform,
-                    src_crs=src.crs,
-                    dst_transform=transform,
-                    dst_crs=dst_crs,
-                    resampling=Resampling.bilinear,
-                )
-        log.warning("%s: reprojected from %s to EPSG:%d -> %s",
-                    path, src.crs, dst_epsg, out_path)
-        return out_path
+        return src.read(), src.profile.copy()
+
+
+def ensure_utm(arr: np.ndarray, profile: dict, *,
+               label: Path | str = "") -> tuple[np.ndarray, dict]:
+    """Reproject to local UTM if input is geographic; pass through otherwise."""
+    crs = profile.get("crs")
+    if crs is None:
+        raise ValueError(f"{label}: missing CRS")
+    if not crs.is_geographic:
+        return arr, profile
+    left, bottom, right, top = array_bounds(
+        profile["height"], profile["width"], profile["transform"])
+    lon = 0.5 * (left + right)
+    lat = 0.5 * (bottom + top)
+    dst_epsg = _utm_epsg_from_lonlat(lon, lat)
+    dst_crs = rio.crs.CRS.from_epsg(dst_epsg)
+    transform, width, height = calculate_default_transform(
+        crs, dst_crs, profile["width"], profile["height"], left, bottom, right, top
+    )
+    nodata = profile.get("nodata")
+    out = np.full((arr.shape[0], height, width),
+                  nodata if nodata is not None else 0, dtype=arr.dtype)
+    reproject(
+        source=arr,
+        destination=out,
+        src_transform=profile["transform"],
+        src_crs=crs,
+        src_nodata=nodata,
+        dst_transform=transform,
+        dst_crs=dst_crs,
+        dst_nodata=nodata,
+        resampling=Resampling.bilinear,
+    )
+    out_profile = dict(profile)
+    out_profile.update(crs=dst_crs, transform=transform, width=width, height=height)
+    log.warning("%s: reprojected from %s to EPSG:%d in memory", label, crs, dst_epsg)
+    return out, out_profile
 
 
 def zero_saturated(arr: np.ndarray, dtype: np.dtype | str) -> np.ndarray:
@@ -189,51 +231,59 @@ def zero_saturated(arr: np.ndarray, dtype: np.dtype | str) -> np.ndarray:
     return out
 
 
-def _write_temp_like(src_path: Path, arr: np.ndarray, out_path: Path) -> Path:
-    with rio.open(src_path) as src:
-        profile = src.profile.copy()
-    profile.update(compress="lzw")
-    for k in ("photometric", "interleave", "blockxsize", "blockysize", "tiled"):
-        profile.pop(k, None)
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    with rio.open(out_path, "w", **profile) as dst:
-        dst.write(arr)
-    return out_path
-
+def _load_model_input(arr: np.ndarray, profile: dict, band_order: list[int],
+                      resample_res: float | None) -> np.ndarray:
+    """In-memory equivalent of `ocm.load_multiband`.
 
-def _saturate_zero_to_temp(path: Path, tmp_dir: Path) -> Path:
-    with rio.open(path) as src:
-        arr = src.read()
-        dtype = src.dtypes[0]
-    cleaned = zero_saturated(arr, dtype)
-    return _write_temp_like(path, cleaned, tmp_dir / f"{path.stem}_sat0.tif")
+    The array is staged in an uncompressed GDAL MemoryFile so the decimated
+    bilinear read goes through exactly the same GDAL code path as
+    load_multiband does on a file on disk.
+    """
+    with MemoryFile() as mem:
+        with mem.open(driver="GTiff", count=arr.shape[0], height=arr.shape[1],
+                      width=arr.shape[2], dtype=arr.dtype, crs=profile["crs"],
+                      transform=profile["transform"],
+                      nodata=profile.get("nodata")) as dst:
+            dst.write(arr)
+        with mem.open() as src:
+            if resample_res:
+                scale_y = src.res[0] / resample_res
+                scale_x = src.res[1] / resample_res
+            else:
+                scale_y = scale_x = 1
+            return src.read(
+                band_order,
+                out_shape=(len(band_order), int(src.height * scale_y),
+                           int(src.width * scale_x)),
+                resampling=Resampling.bilinear,
+            )
 
 
 # ---------------------------------------------------------------------------
 # Nodata overlay (apply input nodata to model output grid)
 
 
-def _build_validity_overlay(source_path: Path, mask_profile: dict) -> np.ndarray:
+def _build_validity_overlay(arr: np.ndarray, profile: dict, mask_profile: dict) -> np.ndarray:
     """Return uint8 (H, W) with 1=valid, 0=invalid in the model-output grid.
 
     Conservative: any source-band nodata at any contributing pixel forces
     invalid via Resampling.min.
     """
-    with rio.open(source_path) as src:
-        src_nodata = src.nodata if src.nodata is not None else 0
-        bands = src.read()
-        valid_native = (bands != src_nodata).all(axis=0).astype("uint8")
-        out_valid = np.zeros((mask_profile["height"], mask_profile["width"]),
-                             dtype="uint8")
-        reproject(
-            source=valid_native,
-            destination=out_valid,
-            src_transform=src.transform,
-            src_crs=src.crs,
-            dst_transform=mask_profile["transform"],
-            dst_crs=mask_profile["crs"],
-            resampling=Resampling.min,
-        )
+    src_nodata = profile.get("nodata")
+    if src_nodata is None:
+        src_nodata = 0
+    valid_native = (arr != src_nodata).all(axis=0).astype("uint8")
+    out_valid = np.zeros((mask_profile["height"], mask_profile["width"]),
+                         dtype="uint8")
+    reproject(
+        source=valid_native,
+        destination=out_valid,
+        src_transform=profile["transform"],
+        src_crs=profile["crs"],
+        dst_transform=mask_profile["transform"],
+        dst_crs=mask_profile["crs"],
+        resampling=Resampling.min,
+    )
     return out_valid
 
 
@@ -287,6 +337,127 @@ def _predict_with_retry(arr: np.ndarray, cfg: DeviceConfig) -> tuple[np.ndarray,
         raise
 
 
+# ---------------------------------------------------------------------------
+# Cross-scene batched inference (--scene-batch N)
+#
+# Small AOI clips (50ha, AVA margin) are only ~100-300 px at 10 m, so each
+# predict_from_array call runs a single, mostly empty model batch and pays the
+# per-call setup again. Instead, every scene is cut into exactly the patches
+# predict_from_array would cut it into (same patch size/overlap adjustment,
+# same nodata-edge shifts, same per-patch normalization), the patches of all
+# scenes go through the OCM ensemble in shared forward passes, and each scene
+# is blended back with OCM's gradient weights, softmax + 0.001 clip and nodata
+# mask. This reuses OCM helpers that are not part of its public API, so it
+# only runs with the pinned OCM_BATCH_VERSION (environment.yml); any other
+# version falls back to per-scene predict_from_array.
+# scripts/check_ocm_scene_batch.py checks both paths give identical masks.
+
+OCM_BATCH_VERSION = "1.7.1"
+OCM_PATCH_SIZE = 1000     # predict_from_array defaults, as _predict_with_retry uses them
+OCM_PATCH_OVERLAP = 300
+BATCH_MIN_SIDE = 32       # OCM's hard minimum patch size
+BATCH_MAX_SIDE = 512      # larger scenes keep the tiled predict_from_array path
+
+
+def _fits_one_patch(rgn: np.ndarray) -> bool:
+    return BATCH_MIN_SIDE <= min(rgn.shape[1:]) and max(rgn.shape[1:]) <= BATCH_MAX_SIDE
+
+
+def _scene_batch_supported() -> bool:
+    return getattr(ocm, "__version__", None) == OCM_BATCH_VERSION
+
+
+def _predict_batch(arrays: list[np.ndarray], cfg: DeviceConfig) -> list[np.ndarray]:
+    """Return (4, H, W) softmax confidences for each (3, H, W) input array,
+    as predict_from_array(export_confidence=True) returns them."""
+    import torch
+    from omnicloudmask.cloud_mask import check_patch_size, collect_models
+    from omnicloudmask.model_utils import create_gradient_mask, get_torch_dtype
+    from omnicloudmask.raster_utils import get_patch, make_patch_indexes, mask_prediction
+
+    device = torch.device(cfg.device)
+    dtype = get_torch_dtype(cfg.dtype)
+    # Weights are lru-cached inside OCM, so this is cheap after the first call.
+    models = collect_models(custom_models=None, inference_device=device,
+                            inference_dtype=dtype, source="hugging_face")
+
+    # Per-scene patch layout, as coordinator() / run_models_on_array() build it
+    trackers = []
+    groups: dict[tuple[int, int], list] = {}
+    for s, arr in enumerate(arrays):
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")  # patch size adjustment notices
+            overlap, size = check_patch_size(arr, 0, OCM_PATCH_SIZE, OCM_PATCH_OVERLAP)
+        trackers.append((torch.zeros((4, *arr.shape[1:]), dtype=dtype, device=device),
+                         torch.zeros(arr.shape[1:], dtype=dtype, device=device)))
+        seen = set()
+        for index in make_patch_indexes(array_width=arr.shape[2], array_height=arr.shape[1],
+                                        patch_size=size, patch_overlap=overlap):
+            patch, index = get_patch(arr, index, 0)
+            if patch is None or index in seen:
+                continue
+            seen.add(index)
+            groups.setdefault((size, overlap), []).append((s, index, patch))
+
+    chunk = max(cfg.batch_size, len(arrays))
+    for (size, overlap), patches in groups.items():
+        gradient = create_gradient_mask(size, overlap, device=device, dtype=dtype)
+        for start in range(0, len(patches), chunk):
+            part = patches[start:start + chunk]
+            x = torch.as_tensor(np.stack([p for _, _, p in part]), dtype=torch.float32)
+            x = x.to(device=device, dtype=dtype)
+            with torch.no_grad():
+                preds = torch.mean(torch.stack([model(x) for model in models]), dim=0)
+            preds *= gradient[None, None, :, :]
+            for pred, (s, index, _) in zip(preds, part):
+                pred_tracker, grad_tracker = trackers[s]
+                pred_tracker[:, index[0]:index[1], index[2]:index[3]] += pred
+                grad_tracker[index[0]:index[1], index[2]:index[3]] += gradient
+
+    out = []
+    for arr, (pred_tracker, grad_tracker) in zip(arrays, trackers):
+        probs = torch.clip(torch.softmax(pred_tracker / grad_tracker, 0) + 0.001, 0.001, 0.999)
+        probs = torch.nan_to_num(probs, nan=0.0).float().numpy(force=True)
+        out.append(mask_prediction(arr, probs, 0)[0])
+    return out
+
+
+def _infer_group(preps: list[PreparedScene], cfg: DeviceConfig,
+                 ) -> tuple[list[np.ndarray | Exception], list[DeviceConfig], DeviceConfig]:
+    """Infer a group of prepared scenes, batching the ones that fit one patch.
+
+    Returns (results, used_cfgs, cfg) where results[i] is either the probs for
+    preps[i] or the exception it raised, and cfg is the config to carry into
+    the next group (it may have been downgraded by an OOM fallback).
+    """
+    results: list = [None] * len(preps)
+    used: list[DeviceConfig] = [cfg] * len(preps)
+
+    batchable = [i for i, p in enumerate(preps) if _fits_one_patch(p.rgn)]
+    if len(batchable) > 1 and not _scene_batch_supported():
+        log.warning("--scene-batch needs omnicloudmask %s (found %s); inferring per scene",
+                    OCM_BATCH_VERSION, getattr(ocm, "__version__", "unknown"))
+        batchable = []
+    if len(batchable) > 1:
+        try:
+            for i, probs in zip(batchable,
+                                _predict_batch([preps[i].rgn for i in batchable], cfg)):
+                results[i] = probs
+        except Exception as exc:
+            log.warning("batched inference of %d scenes failed (%s); "
+                        "falling back to per-scene", len(batchable), exc)
+
+    for i, prep in enumerate(preps):
+        if results[i] is not None:
+            continue
+        try:
+            results[i], used[i] = _predict_with_retry(prep.rgn, cfg)
+            cfg = used[i]
+        except Exception as exc:
+            results[i] = exc
+    return results, used, cfg
+
+
 # ---------------------------------------------------------------------------
 # 5-band assembly + nearest-neighbor upsample to native grid
 
@@ -321,28 +492,26 @@ def _assemble_stack(probs: np.ndarray, valid_overlay: np.ndarray) -> np.ndarray:
 
 
 def _upsample_stack_to_reference(
-    stack_path: Path, reference_path: Path, out_path: Path,
+    stack: np.ndarray, stack_profile: dict, ref_profile: dict,
 ) -> tuple[np.ndarray, dict]:
-    """Nearest-neighbor upsample a 5-band uint8 stack onto reference's grid.
+    """Nearest-neighbor upsample a 5-band uint8 stack onto the reference grid.
 
-    Returns (out_array, profile) describing the upsampled raster on disk.
+    Returns (out_array, profile) describing the upsampled raster.
     """
-    with rio.open(stack_path) as src, rio.open(reference_path) as ref:
-        n = src.count
-        out = np.full((n, ref.height, ref.width), 255, dtype="uint8")
-        for i in range(1, n + 1):
-            reproject(
-                source=rio.band(src, i),
-                destination=out[i - 1],
-                src_transform=src.transform,
-                src_crs=src.crs,
-                dst_transform=ref.transform,
-                dst_crs=ref.crs,
-                resampling=Resampling.nearest,
-                src_nodata=255,
-                dst_nodata=255,
-            )
-        profile = ref.profile.copy()
+    n = stack.shape[0]
+    out = np.full((n, ref_profile["height"], ref_profile["width"]), 255, dtype="uint8")
+    reproject(
+        source=stack,
+        destination=out,
+        src_transform=stack_profile["transform"],
+        src_crs=stack_profile["crs"],
+        dst_transform=ref_profile["transform"],
+        dst_crs=ref_profile["crs"],
+        resampling=Resampling.nearest,
+        src_nodata=255,
+        dst_nodata=255,
+    )
+    profile = dict(ref_profile)
     profile.update(count=n, dtype="uint8", nodata=255, compress="lzw")
     for k in ("photometric", "interleave", "blockxsize", "blockysize", "tiled"):
         profile.pop(k, None)
@@ -409,91 +578,297 @@ def _write_output(out_path: Path, data: np.ndarray, profile: dict, *,
 
 # ---------------------------------------------------------------------------
 # Per-scene pipeline
-
-
-def mask_one(input_path: Path, out_path: Path, *, device: str = "auto",
-             keep_tmp: bool = False) -> None:
-    """Run the full pipeline on a single scene; write a 5-band uint8 GeoTIFF."""
+#
+# The pipeline is split into three stages so the CPU-bound rasterio work can
+# run in worker processes while a single process owns the inference device:
+#   prepare  -- single scene read, band detection, UTM reprojection,
+#               saturation zeroing, 10 m resample and validity overlay (CPU)
+#   infer    -- OmniCloudMask forward pass (GPU/MPS/CPU)
+#   finalize -- 5-band assembly, native-grid upsample, single GeoTIFF write (CPU)
+# No intermediate rasters touch disk; each scene is read once and written once.
+
+
+@dataclass
+class PreparedScene:
+    """Model-ready inputs for one scene, as produced by `_prepare_scene`."""
+    input_path: Path
+    out_path: Path
+    band_order: list[int]
+    rgn: np.ndarray           # (3, H, W) Red/Green/NIR at the model grid
+    mask_profile: dict        # rasterio profile of the 10 m model-output grid
+    ref_profile: dict         # rasterio profile of the native input grid
+    valid_overlay: np.ndarray  # (H, W) uint8, 1=valid
+    seconds: float = 0.0      # wall time spent in _prepare_scene
+
+
+def _prepare_scene(input_path: Path, out_path: Path) -> PreparedScene:
+    """Run every pre-inference step for one scene (see stage notes above)."""
+    t0 = time.perf_counter()
     input_path = Path(input_path)
     out_path = Path(out_path)
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    tmp_parent = out_path.parent / "_tmp"
-    tmp_parent.mkdir(parents=True, exist_ok=True)
-    tmp_root = Path(tempfile.mkdtemp(prefix=f"ocm_{input_path.stem}_", dir=tmp_parent))
 
-    try:
-        band_order = detect_band_order(input_path)
-        working = ensure_utm(input_path, tmp_root)
-        sat0 = _saturate_zero_to_temp(working, tmp_root)
-
-        with rio.open(working) as src:
-            pixel_size = abs(src.transform.a)
-        resample_res: float | None = 10.0
-        if pixel_size >= 10.0:
-            log.warning("%s: native pixel size %.2fm >= 10m; pass-through (resample_res=None)",
-                        input_path, pixel_size)
-            resample_res = None
-
-        rgn, src_profile = ocm.load_multiband(
-            input_path=sat0, resample_res=resample_res, band_order=band_order
+    native, ref_profile = read_scene(input_path)
+    band_order = _band_order_for_count(native.shape[0], input_path)
+    working, working_profile = ensure_utm(native, ref_profile, label=input_path)
+    sat0 = zero_saturated(working, working.dtype)
+    del native, working
+
+    pixel_size = abs(working_profile["transform"].a)
+    resample_res: float | None = 10.0
+    if pixel_size >= 10.0:
+        log.warning("%s: native pixel size %.2fm >= 10m; pass-through (resample_res=None)",
+                    input_path, pixel_size)
+        resample_res = None
+
+    rgn = _load_model_input(sat0, working_profile, band_order, resample_res)
+
+    # Build the 10 m profile from the working profile. The model output has
+    # the same spatial shape as its input, so size it from rgn.
+    src_transform = working_profile["transform"]
+    if resample_res is None:
+        mask_transform = src_transform
+    else:
+        mask_transform = Affine(
+            resample_res, src_transform.b, src_transform.c,
+            src_transform.d, -resample_res, src_transform.f,
         )
+    mask_profile = dict(working_profile)
+    mask_profile.update(
+        count=5, dtype="uint8", nodata=255, compress="lzw",
+        width=int(rgn.shape[2]), height=int(rgn.shape[1]),
+        transform=mask_transform,
+    )
+    for k in ("photometric", "interleave", "blockxsize", "blockysize", "tiled"):
+        mask_profile.pop(k, None)
 
-        cfg = _resolve_device(device)
-        probs, used_cfg = _predict_with_retry(rgn, cfg)
-
-        # OmniCloudMask returns confidence as either (4, H, W) or (1, 4, H, W);
-        # normalize.
-        if probs.ndim == 4 and probs.shape[0] == 1:
-            probs = probs[0]
-        if probs.ndim != 3 or probs.shape[0] != 4:
-            raise RuntimeError(
-                f"unexpected confidence shape {probs.shape}; expected (4, H, W)")
-
-        # Build 10 m profile from the source profile (load_multiband's profile
-        # keeps the source dimensions, not the resampled ones).
-        src_transform = src_profile["transform"]
-        if resample_res is None:
-            mask_transform = src_transform
-        else:
-            mask_transform = Affine(
-                resample_res, src_transform.b, src_transform.c,
-                src_transform.d, -resample_res, src_transform.f,
-            )
-        mask_profile = src_profile.copy()
-        mask_profile.update(
-            count=5, dtype="uint8", nodata=255, compress="lzw",
-            width=int(probs.shape[2]), height=int(probs.shape[1]),
-            transform=mask_transform,
-        )
-        for k in ("photometric", "interleave", "blockxsize", "blockysize", "tiled"):
-            mask_profile.pop(k, None)
+    valid_overlay = _build_validity_overlay(sat0, working_profile, mask_profile)
 
-        valid_overlay = _build_validity_overlay(sat0, mask_profile)
-        stack10 = _assemble_stack(probs, valid_overlay)
+    return PreparedScene(
+        input_path=input_path, out_path=out_path, band_order=band_order,
+        rgn=rgn, mask_profile=mask_profile, ref_profile=ref_profile,
+        valid_overlay=valid_overlay, seconds=time.perf_counter() - t0,
+    )
 
-        # Persist the 10 m stack to a temp file so we can reproject all 5 bands
-        # in one pass via reproject(rio.band(...)) onto the native grid.
-        stack10_path = tmp_root / f"{input_path.stem}_stack10.tif"
-        with rio.open(stack10_path, "w", **mask_profile) as dst:
-            dst.write(stack10)
 
-        upsampled, out_profile = _upsample_stack_to_reference(
-            stack10_path, input_path, out_path,
-        )
+def _normalize_probs(probs: np.ndarray) -> np.ndarray:
+    """OmniCloudMask returns confidence as either (4, H, W) or (1, 4, H, W)."""
+    if probs.ndim == 4 and probs.shape[0] == 1:
+        probs = probs[0]
+    if probs.ndim != 3 or probs.shape[0] != 4:
+        raise RuntimeError(
+            f"unexpected confidence shape {probs.shape}; expected (4, H, W)")
+    return probs
+
+
+def _finalize_scene(prep: PreparedScene, probs: np.ndarray,
+                    used_cfg: DeviceConfig) -> float:
+    """Assemble, upsample and write one scene. Returns elapsed seconds."""
+    t0 = time.perf_counter()
+    stack10 = _assemble_stack(_normalize_probs(probs), prep.valid_overlay)
+    upsampled, out_profile = _upsample_stack_to_reference(
+        stack10, prep.mask_profile, prep.ref_profile,
+    )
 
-        ocm_version = getattr(ocm, "__version__", "unknown")
-        _write_output(
-            out_path, upsampled, out_profile,
-            source_path=input_path, band_order=band_order,
-            used_cfg=used_cfg, ocm_version=ocm_version,
-        )
-    finally:
-        if not keep_tmp:
-            shutil.rmtree(tmp_root, ignore_errors=True)
+    ocm_version = getattr(ocm, "__version__", "unknown")
+    _write_output(
+        prep.out_path, upsampled, out_profile,
+        source_path=prep.input_path, band_order=prep.band_order,
+        used_cfg=used_cfg, ocm_version=ocm_version,
+    )
+    return time.perf_counter() - t0
+
+
+def mask_one(input_path: Path, out_path: Path, *, device: str = "auto") -> None:
+    """Run the full pipeline on a single scene; write a 5-band uint8 GeoTIFF."""
+    prep = _prepare_scene(input_path, out_path)
+    cfg = _resolve_device(device)
+    probs, used_cfg = _predict_with_retry(prep.rgn, cfg)
+    _finalize_scene(prep, probs, used_cfg)
+
+
+# ---------------------------------------------------------------------------
+# Pipelined scheduler (--workers N)
+
+
+@dataclass
+class StageStats:
+    """Busy-time accumulator for one pipeline stage."""
+    name: str
+    count: int = 0
+    seconds: float = 0.0
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.seconds += seconds
+
+    def summary(self) -> str:
+        rate = self.count / self.seconds if self.seconds > 0 else float("nan")
+        return (f"{self.name:>8}: {self.count} scenes, {self.seconds:.1f}s busy, "
+                f"{rate:.2f} scenes/s per worker")
+
+
+def _new_stage_stats() -> dict[str, StageStats]:
+    return {name: StageStats(name) for name in ("prepare", "infer", "finalize")}
+
+
+@dataclass
+class _Tally:
+    """Done/errored scene counts of a run, mirrored on its progress bar."""
+    pbar: tqdm
+    done: int = 0
+    errored: int = 0
+
+    def ok(self) -> None:
+        self.done += 1
+        self._update()
+
+    def fail(self, scene: Path, out_path: Path, exc: Exception) -> None:
+        self.errored += 1
+        # Exceptions from worker processes carry the worker's traceback
+        # as their __cause__, which exc_info prints too.
+        log.error("failed: %s -> %s: %s", scene, out_path, exc, exc_info=exc)
+        self._update()
+
+    def _update(self) -> None:
+        self.pbar.update(1)
+        self.pbar.set_postfix(done=self.done, errored=self.errored)
+
+
+def _run_serial(jobs: list[tuple[Path, Path]], device: str, scene_batch: int,
+                stats: dict[str, StageStats], pbar: tqdm,
+                on_done: Callable[[Path, Path], None]) -> tuple[int, int]:
+    """Prepare, infer and finalize groups of `scene_batch` scenes in this process."""
+    tally = _Tally(pbar)
+    cfg = _resolve_device(device)
+
+    for start in range(0, len(jobs), scene_batch):
+        preps = []
+        for scene, out_path in jobs[start:start + scene_batch]:
+            try:
+                prep = _prepare_scene(scene, out_path)
+            except Exception as exc:
+                tally.fail(scene, out_path, exc)
+                continue
+            stats["prepare"].add(prep.seconds)
+            preps.append(prep)
+        if not preps:
+            continue
+
+        t0 = time.perf_counter()
+        results, used, cfg = _infer_group(preps, cfg)
+        elapsed = time.perf_counter() - t0
+        for prep, probs, used_cfg in zip(preps, results, used):
+            stats["infer"].add(elapsed / len(preps))
+            if isinstance(probs, Exception):
+                tally.fail(prep.input_path, prep.out_path, probs)
+                continue
             try:
-                tmp_parent.rmdir()
-            except OSError:
-                pass
+                stats["finalize"].add(_finalize_scene(prep, probs, used_cfg))
+            except Exception as exc:
+                tally.fail(prep.input_path, prep.out_path, exc)
+                continue
+            tally.ok()
+            on_done(prep.input_path, prep.out_path)
+    return tally.done, tally.errored
+
+
+def _run_pipelined(jobs: list[tuple[Path, Path]], device: str, workers: int,
+                   prefetch: int, scene_batch: int, stats: dict[str, StageStats],
+                   pbar: tqdm, on_done: Callable[[Path, Path], None]) -> tuple[int, int]:
+    """Overlap CPU prepare/finalize in `workers` processes with inference here.
+
+    At most max(prefetch, scene_batch) scenes are prepared ahead of the
+    inference loop, and finalize jobs are throttled to the same depth, so
+    memory stays bounded by roughly twice that many model-grid scenes. Workers
+    use the spawn start method so they never inherit an initialised CUDA/MPS
+    context.
+    """
+    tally = _Tally(pbar)
+    cfg = _resolve_device(device)
+    depth = max(prefetch, scene_batch)
+    ctx = multiprocessing.get_context("spawn")
+    jobs_iter = iter(jobs)
+    pending: deque = deque()   # (scene, out_path, prepare future)
+    writing: dict = {}         # finalize future -> (scene, out_path)
+
+    def submit_prepare() -> None:
+        for scene, out_path in jobs_iter:
+            pending.append((scene, out_path, pool.submit(_prepare_scene, scene, out_path)))
+            return
+
+    def collect(done) -> None:
+        for fut in done:
+            scene, out_path = writing.pop(fut)
+            try:
+                stats["finalize"].add(fut.result())
+            except Exception as exc:
+                tally.fail(scene, out_path, exc)
+                continue
+            tally.ok()
+            on_done(scene, out_path)
+
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as pool:
+        for _ in range(depth):
+            submit_prepare()
+
+        while pending:
+            # Take the next scene in order, then any already-prepared
+            # followers up to scene_batch, without stalling on slow ones.
+            preps = []
+            while pending and len(preps) < scene_batch:
+                if preps and not pending[0][2].done():
+                    break
+                scene, out_path, fut = pending.popleft()
+                submit_prepare()
+                try:
+                    prep = fut.result()
+                except Exception as exc:
+                    tally.fail(scene, out_path, exc)
+                    continue
+                stats["prepare"].add(prep.seconds)
+                preps.append(prep)
+            if not preps:
+                continue
+
+            t0 = time.perf_counter()
+            # Keep whatever config survived the OOM fallback chain rather than
+            # re-triggering the same OOM on every subsequent scene.
+            results, used, cfg = _infer_group(preps, cfg)
+            elapsed = time.perf_counter() - t0
+
+            for prep, probs, used_cfg in zip(preps, results, used):
+                stats["infer"].add(elapsed / len(preps))
+                if isinstance(probs, Exception):
+                    tally.fail(prep.input_path, prep.out_path, probs)
+                    continue
+                # The model-grid input is no longer needed; don't ship it back.
+                prep.rgn = np.empty((0, 0, 0), dtype=prep.rgn.dtype)
+                fut = pool.submit(_finalize_scene, prep, probs, used_cfg)
+                writing[fut] = (prep.input_path, prep.out_path)
+
+            while len(writing) >= depth:
+                done, _ = wait(writing, return_when=FIRST_COMPLETED)
+                collect(done)
+
+        collect(wait(writing).done)
+
+    return tally.done, tally.errored
+
+
+# ---------------------------------------------------------------------------
+# Rebuild manifest parameters
+
+
+def _manifest_params() -> dict:
+    """Everything besides input content that determines a mask's pixels."""
+    return {
+        "pipeline_version": PIPELINE_VERSION,
+        "ocm_version": getattr(ocm, "__version__", "unknown"),
+        "band_order_4band": PLANETSCOPE_4BAND_ORDER,
+        "band_order_8band": PLANETSCOPE_8BAND_ORDER,
+        "model_resolution_m": 10.0,
+        "class_order": CLASS_ORDER,
+    }
 
 
 # ---------------------------------------------------------------------------
@@ -528,10 +903,22 @@ def _output_path_for(input_path: Path, input_dir: Path, output_dir: Path) -> Pat
 @click.option("--device", type=click.Choice(DEVICE_CHOICES), default="auto",
               show_default=True)
 @click.option("--force", is_flag=True, default=False,
-              help="Regenerate masks that already exist (default: skip).")
+              help="Regenerate every mask, stale or not.")
+@click.option("--manifest", "manifest_path", type=click.Path(path_type=Path, dir_okay=False),
+              default=None,
+              help=f"Rebuild manifest (default: <output-dir>/{DEFAULT_MANIFEST_NAME}).")
+@click.option("--dry-run", is_flag=True, default=False,
+              help="Report how many masks are missing or stale, then exit.")
+@click.option("--workers", type=click.IntRange(min=0), default=0, show_default=True,
+              help="CPU worker processes for prepare/write stages; 0 runs serially.")
+@click.option("--prefetch", type=click.IntRange(min=1), default=4, show_default=True,
+              help="Scenes prepared ahead of inference when --workers > 0.")
+@click.option("--scene-batch", type=click.IntRange(min=1), default=1, show_default=True,
+              help="Pack up to this many small scenes into one inference batch.")
 @click.option("-v", "--verbose", is_flag=True, default=False)
 def main(input_dir: Path, output_dir: Path, pattern: str, device: str,
-         force: bool, verbose: bool) -> None:
+         force: bool, manifest_path: Path | None, dry_run: bool, workers: int,
+         prefetch: int, scene_batch: int, verbose: bool) -> None:
     logging.basicConfig(
         level=logging.DEBUG if verbose else logging.INFO,
         format="%(asctime)s %(levelname)s %(name)s %(message)s",
@@ -550,23 +937,44 @@ def main(input_dir: Path, output_dir: Path, pattern: str, device: str,
 
     click.echo(f"found {len(scenes)} scenes under {input_dir}")
 
-    n_done = n_skipped = n_errored = 0
-    pbar = tqdm(scenes, desc="masking", unit="scene")
-    for scene in pbar:
-        out_path = _output_path_for(scene, input_dir, output_dir)
-        if out_path.exists() and not force:
-            n_skipped += 1
-            pbar.set_postfix(done=n_done, skipped=n_skipped, errored=n_errored)
-            continue
-        try:
-            mask_one(scene, out_path, device=device)
-            n_done += 1
-        except Exception as exc:
-            n_errored += 1
-            log.exception("failed: %s -> %s: %s", scene, out_path, exc)
-        pbar.set_postfix(done=n_done, skipped=n_skipped, errored=n_errored)
-
-    click.echo(f"done: {n_done} written, {n_skipped} skipped, {n_errored} errored")
+    params = _manifest_params()
+    manifest_path = manifest_path or output_dir / DEFAULT_MANIFEST_NAME
+    with RebuildManifest(manifest_path, dry_run=dry_run) as manifest:
+        jobs = []
+        n_skipped = n_missing = 0
+        for scene in tqdm(scenes, desc="checking", unit="scene", leave=False):
+            out_path = _output_path_for(scene, input_dir, output_dir)
+            if not out_path.exists():
+                n_missing += 1
+            elif not force and not manifest.is_stale(out_path, {"input": scene}, params):
+                n_skipped += 1
+                continue
+            jobs.append((scene, out_path))
+
+        if dry_run:
+            click.echo(f"dry run: {len(jobs)} of {len(scenes)} masks would be rebuilt "
+                       f"({n_missing} missing, {len(jobs) - n_missing} stale)")
+            return
+
+        def on_done(scene: Path, out_path: Path) -> None:
+            manifest.record(out_path, {"input": scene}, params)
+
+        stats = _new_stage_stats()
+        t0 = time.perf_counter()
+        with tqdm(total=len(jobs), desc="masking", unit="scene") as pbar:
+            if workers > 0:
+                n_done, n_errored = _run_pipelined(jobs, device, workers, prefetch,
+                                                   scene_batch, stats, pbar, on_done)
+            else:
+                n_done, n_errored = _run_serial(jobs, device, scene_batch, stats,
+                                                pbar, on_done)
+        wall = time.perf_counter() - t0
+
+    click.echo(f"done: {n_done} written, {n_skipped} up to date, {n_errored} errored")
+    if jobs:
+        for stage in stats.values():
+            click.echo(stage.summary())
+        click.echo(f"    wall: {wall:.1f}s, {n_done / wall:.2f} scenes/s overall")
     if n_errored:
         sys.exit(2)
 
@@ -1,6 +1,5 @@
 #!/usr/bin/env python
 import os
-import json
 import click
 import numpy as np
 from tqdm import tqdm
@@ -9,32 +8,57 @@ from PIL import Image, ImageDraw
 import matplotlib.pyplot as plt
 from werkzeug.security import safe_join
 
+from affine import Affine
 from arosics import COREG
 from geoarray import GeoArray
 
+from crown_datacube import (
+    chip_subframe, crown_chips, open_datacube, scale_subframe, scene_offsets,
+)
+from crown_index import CrownIndex, grid_key, offset_window
 
-def load_offsets(globalregistration):
-    with open(globalregistration, 'r') as f:
-        results = json.load(f)
 
-    keys = [e['key'] for e in results]
-    offsets = np.array([
-        [e['x_offset'], e['y_offset']]
-        for e in results
-    ])
+def image_grid_key(img):
+    """crown_index.grid_key of a GeoArray."""
+    return grid_key(Affine.from_gdal(*img.geotransform), img.cols, img.rows)
 
-    return keys, offsets
 
+def pixel_polygon(geotransform, poly, offset):
+    """`poly` in image pixel coordinates, shifted by the coregistration offset."""
+    xscale = 1.0 / geotransform[1]
+    yscale = 1.0 / geotransform[5]
+    xoff = -xscale * geotransform[0]
+    yoff = -yscale * geotransform[3]
 
-def normalize(keys, offsets, reference_key):
-    if reference_key not in keys:
-        raise ValueError(f'Key {reference_key} not in offset list')
+    # Translate from map to image pixels
+    poly = poly.affine_transform([xscale, 0, 0, yscale, xoff, yoff])
 
-    i = keys.index(reference_key)
-    return (offsets - offsets[i])
+    # Apply co-registration shift
+    return poly.translate(xoff=-offset[0], yoff=-offset[1])
 
 
-def extract_window(imagedir, outputdir, key, poly, offset, radius, draw_poly=True, ndvi=False):
+def crown_topleft(img, poly, offset, radius, index=None, tag=None):
+    """Top-left (row, col) of the crown subframe, from the crown index when
+    it has the crown on this image's grid, else from the polygon. A crown
+    with several dated entries on the grid also falls back to the polygon."""
+    crown = None
+    if index is not None:
+        try:
+            crown = index.get(image_grid_key(img), tag)
+        except LookupError:
+            pass
+    if crown is not None:
+        return offset_window(crown, offset, radius)
+
+    topleft = pixel_polygon(img.geotransform, poly, offset).centroid.translate(xoff=-radius, yoff=-radius)
+    return (
+        int(np.round(topleft.y.iloc[0])),
+        int(np.round(topleft.x.iloc[0])),
+    )
+
+
+def extract_window(imagedir, outputdir, key, poly, offset, radius, draw_poly=True, ndvi=False,
+                   index=None, tag=None):
     if ndvi:
         key = key.replace('_rgb', '_ndvi')
 
@@ -43,52 +67,54 @@ def extract_window(imagedir, outputdir, key, poly, offset, radius, draw_poly=Tru
 
     img = GeoArray(imagefile)
 
-    xscale = 1.0 / img.geotransform[1]
-    yscale = 1.0 / img.geotransform[5]
-    xoff = -xscale * img.geotransform[0]
-    yoff = -yscale * img.geotransform[3]
-
-    # Translate from map to image pixels
-    poly = poly.affine_transform([xscale, 0, 0, yscale, xoff, yoff])
-
-    # Apply co-registration shift
-    poly = poly.translate(xoff=-offset[0], yoff=-offset[1])
-
     height = 2*radius + 1
     width = 2*radius + 1
 
-    topleft = poly.centroid.translate(xoff=-radius, yoff=-radius)
-    row, col = (
-        int(np.round(topleft.y.iloc[0])),
-        int(np.round(topleft.x.iloc[0])),
-    )
+    row, col = crown_topleft(img, poly, offset, radius, index, tag)
 
     if min(row, col) < 0:
         return
 
-    # Apply subframe shift
-    poly = poly.translate(xoff=-col, yoff=-row)
+    subframe = img[row:row+height, col:col+height]
+    save_subframe(subframe, outputfile, img.geotransform, poly, offset, row, col,
+                  draw_poly=draw_poly, ndvi=ndvi)
 
-    subframe = np.array(img[row:row+height, col:col+height], dtype=float)
-    maxval = 1.0 if ndvi else np.max(subframe)
-    if maxval == 0:
-        return
 
-    subframe *= (255 / maxval)
-    subframe = subframe.astype(np.uint8)
+def save_subframe(subframe, outputfile, geotransform, poly, offset, row, col,
+                  draw_poly=True, ndvi=False):
+    subframe = scale_subframe(subframe, ndvi)
+    if subframe is None:
+        return
 
     im = Image.fromarray(subframe)
     draw = ImageDraw.Draw(im)
 
-    points = poly.iloc[0]
-    points = list(poly.iloc[0].exterior.coords)
-
     if draw_poly:
+        # Apply subframe shift
+        poly = pixel_polygon(geotransform, poly, offset).translate(xoff=-col, yoff=-row)
+        points = list(poly.iloc[0].exterior.coords)
         draw.polygon(points, outline='red')
 
     im.save(outputfile)
 
 
+def extract_datacube(ds, outputdir, crownid, poly, draw_poly=True, ndvi=False):
+    """Write the sequence PNGs of one crown from a crown_datacube.py store."""
+    seq = crown_chips(ds, crownid).load()
+    for t in tqdm(range(seq.sizes['time'])):
+        frame = seq.isel(time=t)
+        subframe = chip_subframe(frame)
+        if subframe is None:
+            continue
+        offset = (float(frame['offset_x']), float(frame['offset_y']))
+        key = str(frame['key'].values)
+        if ndvi:
+            key = key.replace('_rgb', '_ndvi')
+        outputfile = safe_join(outputdir, key + '.png')
+        save_subframe(subframe, outputfile, frame['geotransform'].values, poly, offset,
+                      int(frame['row']), int(frame['col']), draw_poly=draw_poly, ndvi=ndvi)
+
+
 @click.command()
 @click.argument('droneregistration')
 @click.argument('globalregistration')
@@ -99,7 +125,13 @@ def extract_window(imagedir, outputdir, key, poly, offset, radius, draw_poly=Tru
 @click.option('-r', '--radius', type=int, default=25)
 @click.option('-d', '--drawpoly', is_flag=True)
 @click.option('-n', '--ndvi', is_flag=True)
-def main(droneregistration, globalregistration, shapefile, imagedir, outputdir, crownid, radius, drawpoly, ndvi):
+@click.option('--crown-index', default=None, type=click.Path(exists=True),
+              help='Parquet crown index (crown_index.py) with precomputed crown centroids.')
+@click.option('--datacube', default=None, type=click.Path(exists=True),
+              help='Read the windows from a crown_datacube.py store (built with the same '
+                   'registrations, radius and --ndvi) instead of the scenes in IMAGEDIR.')
+def main(droneregistration, globalregistration, shapefile, imagedir, outputdir, crownid, radius, drawpoly, ndvi,
+         crown_index, datacube):
 
     crowns = gpd.read_file(shapefile)
 
@@ -109,21 +141,19 @@ def main(droneregistration, globalregistration, shapefile, imagedir, outputdir,
 
     poly = focal_crown['geometry']
 
-    keys, offsets = load_offsets(globalregistration)
+    if datacube is not None:
+        extract_datacube(open_datacube(datacube), outputdir, crownid, poly,
+                         draw_poly=drawpoly, ndvi=ndvi)
+        return
 
-    with open(droneregistration, 'r') as f:
-        drone = json.load(f)
+    index = CrownIndex(crown_index) if crown_index else None
 
-    offsets = normalize(keys, offsets, drone['planet_map'])
-    drone_offset = np.array([
-        drone['coreg_info']['corrected_shifts_px']['x'],
-        drone['coreg_info']['corrected_shifts_px']['y'],
-    ])
+    keys, offsets = scene_offsets(droneregistration, globalregistration)
 
-    for key, offset in tqdm(list(zip(keys, offsets))):
-        total_offset = offset + drone_offset
+    for key, total_offset in tqdm(list(zip(keys, offsets))):
         try:
-            extract_window(imagedir, outputdir, key, poly, total_offset, radius, draw_poly=drawpoly, ndvi=ndvi)
+            extract_window(imagedir, outputdir, key, poly, total_offset, radius, draw_poly=drawpoly, ndvi=ndvi,
+                           index=index, tag=crownid)
         except (ValueError, FileNotFoundError):
             continue
 
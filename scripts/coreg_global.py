@@ -4,9 +4,11 @@ import json
 import click
 import numpy as np
 import pandas as pd
+import scipy.sparse as sp
 from glob import glob
 from tqdm import tqdm
-import matplotlib.pyplot as plt
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import spsolve
 from werkzeug.security import safe_join
 
 from planet_coreg import stem
@@ -29,7 +31,14 @@ def load_offsets(coregfile):
     }
 
 
-def offsets_to_matrix(offsets, filterkeys=None):
+def offsets_to_edges(offsets, filterkeys=None):
+    """Sparse edge list of pairwise shifts.
+
+    Returns (keys, src, tgt, dxy): sorted image keys, and per measured pair
+    the index of the source and target image and the (x, y) shift, i.e.
+    offset[src] - offset[tgt] ~= dxy. With `filterkeys`, keys are exactly
+    those images (some may have no edges) and other pairs are dropped.
+    """
     if filterkeys is None:
         keys = set([])
         for src, tgt in offsets.keys():
@@ -38,35 +47,128 @@ def offsets_to_matrix(offsets, filterkeys=None):
     else:
         keys = sorted(filterkeys)
 
-    n = len(keys)
+    index = {k: i for i, k in enumerate(keys)}
+    pairs = [
+        (index[k1], index[k2], d)
+        for (k1, k2), d in offsets.items()
+        if k1 != k2 and k1 in index and k2 in index
+    ]
+    src = np.array([p[0] for p in pairs], dtype=np.int64)
+    tgt = np.array([p[1] for p in pairs], dtype=np.int64)
+    dxy = np.array([p[2] for p in pairs], dtype=float).reshape(-1, 2)
+
+    return keys, src, tgt, dxy
 
+
+def edges_to_matrix(n, src, tgt, dxy):
+    """Dense (n, n, 2) NaN-filled matrix of the edge list, for plotting."""
     xy = np.full((n, n, 2), np.nan)
-    for i, k1 in tqdm(list(enumerate(keys)), 'Converting'):
-        for j, k2 in enumerate(keys):
-            key = (k1, k2)
-            if k1 == k2 or key not in offsets:
-                continue
-            else:
-                xy[i, j, :] = offsets[key]
+    xy[src, tgt] = dxy
+    return xy
+
 
-    return keys, xy
+def offsets_to_matrix(offsets, filterkeys=None):
+    keys, src, tgt, dxy = offsets_to_edges(offsets, filterkeys)
+    return keys, edges_to_matrix(len(keys), src, tgt, dxy)
 
 
-def load_offset_matrix(coregfiles, keys=None):
+def load_offset_edges(coregfiles, keys=None):
 
     offsets = {}
     for f in tqdm(coregfiles, 'Loading'):
         offsets.update(load_offsets(f))
 
-    return offsets_to_matrix(offsets, filterkeys=keys)
+    return offsets_to_edges(offsets, filterkeys=keys)
 
 
-def iterate(offset, xy):
-    for i, dxy in enumerate(offset):
-        diff = xy[i, :] + offset
-        offset[i, :] = np.nanmedian(diff, axis=0)
-    offset -= np.nanmean(offset, axis=0)
-    return offset
+def load_offset_matrix(coregfiles, keys=None):
+    keys, src, tgt, dxy = load_offset_edges(coregfiles, keys)
+    return keys, edges_to_matrix(len(keys), src, tgt, dxy)
+
+
+def edge_residuals(offset, src, tgt, dxy):
+    """Per-edge misfit dxy - (offset[src] - offset[tgt]), shape (m, 2)."""
+    return dxy - (offset[src] - offset[tgt])
+
+
+def _huber_weights(residual, k):
+    """IRLS weights for the Huber loss, threshold k robust sigmas (MAD)."""
+    a = np.abs(residual)
+    sigma = 1.4826 * np.median(a)
+    if sigma == 0:
+        return np.ones_like(a)
+    return np.minimum(1.0, k * sigma / np.maximum(a, 1e-12))
+
+
+def solve_offsets(n, src, tgt, dxy, maxiter=100, tolerance=1e-6,
+                  huber_k=1.345):
+    """Robust global offsets from pairwise shifts.
+
+    Minimises sum_e huber(offset[src_e] - offset[tgt_e] - dxy_e) separately
+    for x and y by iteratively reweighted least squares: each iteration is
+    one sparse solve of the weighted graph Laplacian per axis, and stops when
+    the RMS change drops below `tolerance` (usually within ten iterations).
+    One image per connected component is held fixed during the solve, then
+    each component is shifted to zero mean; images without any pair are NaN.
+
+    Returns (offset (n, 2), iterations, delta).
+    """
+    offset = np.full((n, 2), np.nan)
+    if len(src) == 0:
+        return offset, 0, 0.0
+
+    adjacency = sp.coo_matrix(
+        (np.ones(len(src)), (src, tgt)), shape=(n, n)).tocsr()
+    ncomp, labels = connected_components(adjacency, directed=False)
+    connected = np.zeros(n, dtype=bool)
+    connected[src] = True
+    connected[tgt] = True
+
+    # Hold the first image of every component fixed; solve for the rest
+    anchors = np.zeros(n, dtype=bool)
+    first = {}
+    for i in np.flatnonzero(connected):
+        first.setdefault(labels[i], i)
+    anchors[list(first.values())] = True
+    free = connected & ~anchors
+    col = np.full(n, -1, dtype=np.int64)
+    col[free] = np.arange(free.sum())
+
+    # Signed incidence matrix restricted to the free images
+    m = len(src)
+    rows = np.concatenate([np.arange(m), np.arange(m)])
+    cols = np.concatenate([col[src], col[tgt]])
+    vals = np.concatenate([np.ones(m), -np.ones(m)])
+    keep = cols >= 0
+    incidence = sp.csr_matrix(
+        (vals[keep], (rows[keep], cols[keep])), shape=(m, int(free.sum())))
+
+    weights = np.ones((m, 2))
+    solution = np.zeros((n, 2))
+    delta = np.inf
+    iteration = 0
+    for iteration in range(1, maxiter + 1):
+        prev = solution.copy()
+        for axis in range(2):
+            w = weights[:, axis]
+            wa = incidence.T.multiply(w).tocsr()
+            lhs = (wa @ incidence).tocsc()
+            rhs = wa @ dxy[:, axis]
+            solution[free, axis] = spsolve(lhs, rhs) if free.any() else 0.0
+        residual = edge_residuals(solution, src, tgt, dxy)
+        weights = np.column_stack([
+            _huber_weights(residual[:, axis], huber_k) for axis in range(2)
+        ])
+        delta = np.sqrt(np.mean(np.square(prev[connected] - solution[connected])))
+        if delta < tolerance:
+            break
+
+    for c in set(labels[connected]):
+        members = connected & (labels == c)
+        solution[members] -= solution[members].mean(axis=0)
+    offset[connected] = solution[connected]
+
+    return offset, iteration, float(delta)
 
 
 def filterkeys(cloudfile, minclear):
@@ -84,24 +186,23 @@ def filterkeys(cloudfile, minclear):
 @click.option('-t', '--tolerance', type=float, default=1e-6)
 @click.option('-c', '--cloudfile', default=None)
 @click.option('-l', '--minclear', type=float, default=0.9)
-def main(coregdir, outputfile, maxiter, tolerance, cloudfile, minclear):
+@click.option('-k', '--huber-k', type=float, default=1.345, show_default=True,
+              help='Huber threshold in robust standard deviations.')
+def main(coregdir, outputfile, maxiter, tolerance, cloudfile, minclear,
+         huber_k):
 
     files = sorted(glob(safe_join(coregdir, '*.json')))
 
     filtered = filterkeys(cloudfile, minclear)
 
-    keys, xy = load_offset_matrix(files, keys=filtered)
-
-    offset = np.zeros((len(xy), 2))
+    keys, src, tgt, dxy = load_offset_edges(files, keys=filtered)
 
-    it = tqdm(list(range(maxiter)), 'Optimizing')
-    for i in it:
-        prev = np.array(offset)
-        offset = iterate(offset, xy)
-        delta = np.sqrt(np.nanmean(np.square(prev - offset)))
-        if delta < tolerance:
-            it.close()
-            break
+    offset, iterations, delta = solve_offsets(
+        len(keys), src, tgt, dxy, maxiter=maxiter, tolerance=tolerance,
+        huber_k=huber_k,
+    )
+    print(f'{len(keys)} images, {len(src)} pairs: '
+          f'{iterations} iterations (delta={delta:.2e})')
 
     output = [
         {
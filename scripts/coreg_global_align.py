@@ -11,10 +11,7 @@ from py_tools_ds.geo.coord_trafo import imXY2mapXY
 import arosics.geometry as GEO
 from werkzeug.security import safe_join
 
-from coreg_global import (
-    load_offsets, offsets_to_matrix,
-    load_offset_matrix, iterate,
-)
+from coreg_global import load_offset_edges, solve_offsets
 
 
 def spoof_shift(self, offset):
@@ -35,15 +32,11 @@ def main(coregdir, imagedir, outputdir):
 
     files = sorted(glob(safe_join(coregdir, '*.json')))
 
-    keys, xy = load_offset_matrix(files)
-
-    offset = np.zeros((len(xy), 2))
-
-    for i in range(50):
-        prev = np.array(offset)
-        offset = iterate(offset, xy)
-        print(np.sqrt(np.nanmean(np.square(prev - offset))))
+    keys, src, tgt, dxy = load_offset_edges(files)
 
+    offset, iterations, delta = solve_offsets(
+        len(keys), src, tgt, dxy, maxiter=50)
+    print(f'{iterations} iterations (delta={delta:.2e})')
 
     for k, dxy in tqdm(list(zip(keys, offset)), 'Shifting'):
         if np.any(np.isnan(dxy)): continue
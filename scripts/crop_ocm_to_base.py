@@ -13,8 +13,13 @@ is a pixel-aligned subset of the margin extent. The crop is therefore a plain
 integer-offset window read (no resampling), preserving band descriptions,
 scales, and tags from the margin mask.
 
+Crops are rebuilt only when missing or stale with respect to the content of
+both the base cutout and the margin mask, as tracked in the rebuild manifest
+(`<output-dir>/manifest.sqlite`, see rebuild_manifest.py).
+
 Typical usage:
     python scripts/crop_ocm_to_base.py
+    python scripts/crop_ocm_to_base.py --dry-run
     python scripts/crop_ocm_to_base.py --force
 """
 from __future__ import annotations
@@ -27,11 +32,17 @@ import rasterio as rio
 from rasterio.windows import Window
 from tqdm import tqdm
 
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from rebuild_manifest import DEFAULT_MANIFEST_NAME, RebuildManifest  # noqa: E402
+
 DEFAULT_BASE_DIR = Path("/Volumes/Earth03/flower/ava/planet/4band")
 DEFAULT_OCM_DIR = Path("/Volumes/Earth03/flower/ava/planet_margin/ocm")
 DEFAULT_OUTPUT_DIR = Path("/Volumes/Earth03/flower/ava/planet/ocm")
 DEFAULT_GLOB = "*_4band.tif"
 
+# Bump when the crop logic changes the pixels or tags it writes.
+CROP_PARAMS = {"crop_version": 1, "fill_value": 255}
+
 
 def _margin_ocm_for(base_path: Path, base_dir: Path, ocm_dir: Path) -> Path:
     """Map <base>/<year>/<prefix>_4band.tif -> <ocm>/<year>/<prefix>_ocm.tif."""
@@ -107,9 +118,14 @@ def crop_one(base_path: Path, margin_ocm_path: Path, out_path: Path) -> None:
               default=DEFAULT_OUTPUT_DIR, show_default=True)
 @click.option("--glob", "pattern", default=DEFAULT_GLOB, show_default=True)
 @click.option("--force", is_flag=True, default=False,
-              help="Overwrite existing cropped masks (default: skip).")
+              help="Re-crop every mask, stale or not.")
+@click.option("--manifest", "manifest_path", type=click.Path(path_type=Path, dir_okay=False),
+              default=None,
+              help=f"Rebuild manifest (default: <output-dir>/{DEFAULT_MANIFEST_NAME}).")
+@click.option("--dry-run", is_flag=True, default=False,
+              help="Report how many crops are missing or stale, then exit.")
 def main(base_dir: Path, ocm_dir: Path, output_dir: Path, pattern: str,
-         force: bool) -> None:
+         force: bool, manifest_path: Path | None, dry_run: bool) -> None:
     if not base_dir.exists():
         click.echo(f"base-dir does not exist: {base_dir}", err=True)
         sys.exit(1)
@@ -124,31 +140,41 @@ def main(base_dir: Path, ocm_dir: Path, output_dir: Path, pattern: str,
         sys.exit(1)
     click.echo(f"found {len(scenes)} base cutouts under {base_dir}")
 
-    n_done = n_skipped = n_missing = n_errored = 0
-    pbar = tqdm(scenes, desc="cropping", unit="scene")
-    for scene in pbar:
-        out_path = _output_for(scene, base_dir, output_dir)
-        if out_path.exists() and not force:
-            n_skipped += 1
-            pbar.set_postfix(done=n_done, skipped=n_skipped,
-                             missing=n_missing, errored=n_errored)
-            continue
-        margin_ocm = _margin_ocm_for(scene, base_dir, ocm_dir)
-        if not margin_ocm.exists():
-            n_missing += 1
-            pbar.set_postfix(done=n_done, skipped=n_skipped,
-                             missing=n_missing, errored=n_errored)
-            continue
-        try:
-            crop_one(scene, margin_ocm, out_path)
-            n_done += 1
-        except Exception as exc:  # noqa: BLE001
-            n_errored += 1
-            click.echo(f"failed: {scene} -> {out_path}: {exc}", err=True)
-        pbar.set_postfix(done=n_done, skipped=n_skipped,
-                         missing=n_missing, errored=n_errored)
-
-    click.echo(f"done: {n_done} written, {n_skipped} skipped, "
+    manifest_path = manifest_path or output_dir / DEFAULT_MANIFEST_NAME
+    with RebuildManifest(manifest_path, dry_run=dry_run) as manifest:
+        jobs = []
+        n_skipped = n_missing = 0
+        for scene in scenes:
+            out_path = _output_for(scene, base_dir, output_dir)
+            margin_ocm = _margin_ocm_for(scene, base_dir, ocm_dir)
+            if not margin_ocm.exists():
+                n_missing += 1
+                continue
+            inputs = {"base": scene, "margin_ocm": margin_ocm}
+            if not force and not manifest.is_stale(out_path, inputs, CROP_PARAMS):
+                n_skipped += 1
+                continue
+            jobs.append((scene, margin_ocm, out_path))
+
+        if dry_run:
+            click.echo(f"dry run: {len(jobs)} of {len(scenes)} crops would be rebuilt "
+                       f"({n_skipped} up to date, {n_missing} missing margin-ocm)")
+            return
+
+        n_done = n_errored = 0
+        pbar = tqdm(jobs, desc="cropping", unit="scene")
+        for scene, margin_ocm, out_path in pbar:
+            try:
+                crop_one(scene, margin_ocm, out_path)
+                manifest.record(out_path, {"base": scene, "margin_ocm": margin_ocm},
+                                CROP_PARAMS)
+                n_done += 1
+            except Exception as exc:  # noqa: BLE001
+                n_errored += 1
+                click.echo(f"failed: {scene} -> {out_path}: {exc}", err=True)
+            pbar.set_postfix(done=n_done, errored=n_errored)
+
+    click.echo(f"done: {n_done} written, {n_skipped} up to date, "
                f"{n_missing} missing margin-ocm, {n_errored} errored")
     if n_errored:
         sys.exit(2)
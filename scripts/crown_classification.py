@@ -1,6 +1,11 @@
 #Import libraries/modules
 import os
+os.environ.setdefault("PYTORCH_ENABLE_MPS_FALLBACK", "1")  # must precede torch import
 import re
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
 import click
 import torch
 import rasterio
@@ -8,92 +13,19 @@ import numpy as np
 from PIL import Image
 from tqdm import tqdm
 import geopandas as gpd
+import pandas as pd
+import rasterio.shutil
 import torch.nn.functional as F
 from transformers import SegformerImageProcessor
 from rasterio.windows import Window
 from rasterio.features import rasterize
+from rasterstats import zonal_stats
 import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 
-
-def extract_centered_window(src, polygon, min_size=512, pixel_buffer=100):
-    """
-    Extract a raster window fully containing the polygon, with:
-      • at least min_size x min_size pixels
-      • at least pixel_buffer pixels around the polygon
-      • centered on the polygon when expanding to min_size
-
-    Parameters
-    ----------
-    src : rasterio.io.DatasetReader
-        Open rasterio dataset.
-    polygon : shapely.geometry.Polygon
-        Polygon in the same CRS as the raster.
-    min_size : int
-        Minimum window size (pixels) on each side.
-    pixel_buffer : int
-        Extra pixels to include around the polygon.
-
-    Returns
-    -------
-    window : rasterio.windows.Window
-        The computed window.
-    data : np.ndarray
-        The extracted array `src.read(window=window)`.
-    """
-
-    # --- 1. Get polygon bounds in world coordinates ---
-    minx, miny, maxx, maxy = polygon.bounds
-
-    # --- 2. Convert world coordinates → pixel indices ---
-    # rasterio.transform.rowcol uses (x, y)
-    top_row, left_col = src.index(minx, maxy)
-    bottom_row, right_col = src.index(maxx, miny)
-
-    # Normalize row/col ordering
-    row_min = min(top_row, bottom_row)
-    row_max = max(top_row, bottom_row)
-    col_min = min(left_col, right_col)
-    col_max = max(left_col, right_col)
-
-    # --- 3. Apply pixel buffer ---
-    row_min -= pixel_buffer
-    row_max += pixel_buffer
-    col_min -= pixel_buffer
-    col_max += pixel_buffer
-
-    # --- 4. Compute size; expand to meet min_size (centered) ---
-    height = row_max - row_min + 1
-    width  = col_max - col_min + 1
-
-    # Expand height
-    if height < min_size:
-        pad = (min_size - height) // 2
-        row_min -= pad
-        row_max += (min_size - height - pad)
-
-    # Expand width
-    if width < min_size:
-        pad = (min_size - width) // 2
-        col_min -= pad
-        col_max += (min_size - width - pad)
-
-    # --- 5. Clamp window to raster bounds ---
-    row_min = max(row_min, 0)
-    col_min = max(col_min, 0)
-    row_max = min(row_max, src.height - 1)
-    col_max = min(col_max, src.width - 1)
-
-    # Final window parameters
-    h = row_max - row_min + 1
-    w = col_max - col_min + 1
-
-    window = Window(col_off=col_min, row_off=row_min, width=w, height=h)
-
-    # --- 6. Read and return ---
-    data = src.read(window=window)
-
-    return window, Image.fromarray(np.transpose(data, (1, 2, 0))[..., :3])
+from crown_index import CrownIndex, dataset_grid_key, extract_centered_window
+from merge_classifications import gaussian_weight_mask
+from util import select_device
 
 
 def polygon_mask(src, window, polygon):
@@ -122,12 +54,17 @@ def polygon_mask(src, window, polygon):
     return mask
 
 
-def preprocess(img, size=512):
-
-    processor = SegformerImageProcessor(
+def make_processor(size=512):
+    return SegformerImageProcessor(
         do_resize=True, size=size, do_normalize=True,
     )
 
+
+def preprocess(img, size=512, processor=None):
+
+    if processor is None:
+        processor = make_processor(size)
+
     encoded_inputs = processor(
         images=img,
         size=size,
@@ -152,6 +89,34 @@ def apply_model(model, x, resize):
     return conf
 
 
+def apply_model_batch(model, x, resizes, device, bf16=False,
+                      channels_last=False):
+    """Crown confidence maps for a batch of preprocessed windows.
+
+    x is (B, 3, size, size); resizes holds the (H, W) to interpolate each
+    window's logits back to, and may be shorter than B when the batch was
+    padded to a fixed size. Returns a list of float32 arrays.
+    """
+    x = x.to(device)
+    if channels_last:
+        x = x.contiguous(memory_format=torch.channels_last)
+
+    with torch.inference_mode(), torch.autocast(
+        device_type=device.type, dtype=torch.bfloat16, enabled=bf16,
+    ):
+        logits = model(x).logits
+
+    confs = []
+    for k, resize in enumerate(resizes):
+        upsampled = F.interpolate(
+            logits[k:k + 1].float(), size=resize,
+            mode="bilinear", align_corners=False,
+        )
+        confs.append(torch.sigmoid(upsampled[0, 1]).cpu().numpy())
+
+    return confs
+
+
 def plot_results(img, mask, conf):
     fig, axs = plt.subplots(ncols=3, figsize=(16, 6))
 
@@ -190,6 +155,13 @@ def plot_results(img, mask, conf):
     return fig
 
 
+class RasterGrid(NamedTuple):
+    """Profile and transform of a source raster, captured once so that
+    writer threads never touch the open dataset."""
+    profile: dict
+    transform: rasterio.Affine
+
+
 def save_window_geotiff(output_path, array, src, window):
     """
     Save a windowed array (H×W or C×H×W) as a GeoTIFF using
@@ -202,8 +174,8 @@ def save_window_geotiff(output_path, array, src, window):
     array : np.ndarray
         Single-band or multi-band array. Shape must be:
             (H, W) or (bands, H, W)
-    src : rasterio.io.DatasetReader
-        The open source raster.
+    src : rasterio.io.DatasetReader or RasterGrid
+        The open source raster, or its captured profile and transform.
     window : rasterio.windows.Window
         Window corresponding to the array area in the source raster.
     """
@@ -232,16 +204,262 @@ def save_window_geotiff(output_path, array, src, window):
         dst.write(array)
 
 
+class CrownJob(NamedTuple):
+    output_path: str
+    polygon: object
+    crown: object = None    # CrownIndex entry, if an index was given
+
+
+class _ReaderDatasets:
+    """One dataset handle per reader thread, opened on first use. All of
+    them are closed on exit, so enter it before the reader pool: the pool
+    shuts down (and its threads stop reading) first."""
+
+    def __init__(self, image_file):
+        self.image_file = image_file
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._opened = []
+
+    def get(self):
+        src = getattr(self._local, 'src', None)
+        if src is None:
+            src = self._local.src = rasterio.open(self.image_file)
+            with self._lock:
+                self._opened.append(src)
+        return src
+
+    def close(self):
+        with self._lock:
+            opened, self._opened = self._opened, []
+        for src in opened:
+            src.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _read_crown(datasets, processor, size, job):
+    """Window and preprocessed tensor for one crown (runs in a reader
+    thread; each thread keeps its own dataset handle)."""
+    src = datasets.get()
+    window, img = extract_centered_window(src, job.polygon, min_size=size, crown=job.crown)
+    x = preprocess(img, size, processor)[0]
+    # Flip dimensions from PIL image size
+    return job, window, img.size[::-1], x
+
+
+def _prefetch(pool, fn, items, depth):
+    """pool.map that keeps at most `depth` items in flight, in order."""
+    items = iter(items)
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(fn, item))
+        if len(pending) >= depth:
+            break
+    while pending:
+        result = pending.popleft().result()
+        item = next(items, None)
+        if item is not None:
+            pending.append(pool.submit(fn, item))
+        yield result
+
+
+def _batches(results, batch_size):
+    batch = []
+    for result in results:
+        batch.append(result)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# -- whole-mosaic mode ---------------------------------------------------------
+
+def tile_offsets(length, tile_size, stride):
+    """Tile starts covering [0, length); the last tile is flush with the end."""
+    if length <= tile_size:
+        return [0]
+    offsets = list(range(0, length - tile_size, stride))
+    offsets.append(length - tile_size)
+    return offsets
+
+
+def _read_tile(datasets, processor, size, window):
+    """Preprocessed tensor and validity mask for one mosaic tile, or None if
+    the tile is entirely outside the mosaic's footprint."""
+    src = datasets.get()
+    # Only mosaics smaller than a tile need reads past the edge
+    boundless = (window.col_off + window.width > src.width
+                 or window.row_off + window.height > src.height)
+    valid = src.dataset_mask(window=window, boundless=boundless) > 0
+    if not valid.any():
+        return window, valid, None
+    data = src.read([1, 2, 3], window=window, boundless=boundless)
+    img = Image.fromarray(np.transpose(data, (1, 2, 0)))
+    return window, valid, preprocess(img, size, processor)[0]
+
+
+def classify_mosaic(model, image_file, output_file, device, tile_size=512,
+                    overlap=256, batch_size=8, bf16=False, channels_last=False,
+                    io_workers=4, size=512):
+    """Confidence for the whole orthomosaic from overlapping tiles.
+
+    Each tile goes through the model once. Tiles are blended with the
+    Gaussian weights merge_classifications.py uses for crown windows
+    (sigma = tile / 4). Pixels outside the mosaic's mask are NaN. Rows are
+    accumulated in a buffer one tile high and streamed to a tiled GeoTIFF as
+    soon as no later tile touches them, then copied to a COG.
+    """
+    stride = tile_size - overlap
+    weights = gaussian_weight_mask(tile_size, tile_size, tile_size / 4.)
+    processor = make_processor(size)
+
+    with rasterio.open(image_file) as src:
+        height, width = src.height, src.width
+        profile = src.profile.copy()
+
+    profile.update({
+        'driver': 'GTiff', 'count': 1, 'dtype': 'float32', 'nodata': np.nan,
+        'tiled': True, 'blockxsize': 512, 'blockysize': 512,
+        'compress': 'deflate', 'predictor': 3, 'BIGTIFF': 'IF_SAFER',
+    })
+    profile.pop('photometric', None)
+
+    rows = tile_offsets(height, tile_size, stride)
+    cols = tile_offsets(width, tile_size, stride)
+    windows = [Window(c, r, tile_size, tile_size) for r in rows for c in cols]
+
+    buf_sum = np.zeros((tile_size, width), dtype=np.float32)
+    buf_weight = np.zeros((tile_size, width), dtype=np.float32)
+    buf_top = 0
+
+    def flush(until):
+        # Write buffered rows [buf_top, until) and shift them out
+        nonlocal buf_top
+        n = until - buf_top
+        if n <= 0:
+            return
+        conf = np.full((n, width), np.nan, dtype=np.float32)
+        np.divide(buf_sum[:n], buf_weight[:n], out=conf, where=buf_weight[:n] > 0)
+        dst.write(conf, 1, window=Window(0, buf_top, width, n))
+        buf_sum[:-n] = buf_sum[n:]
+        buf_weight[:-n] = buf_weight[n:]
+        buf_sum[-n:] = 0
+        buf_weight[-n:] = 0
+        buf_top = until
+
+    def accumulate(window, valid, conf):
+        r0 = int(window.row_off) - buf_top
+        c0 = int(window.col_off)
+        h = min(tile_size, height - int(window.row_off))
+        w = min(tile_size, width - c0)
+        wt = np.where(valid, weights, 0)[:h, :w]
+        buf_sum[r0:r0 + h, c0:c0 + w] += (conf[:h, :w] * wt)
+        buf_weight[r0:r0 + h, c0:c0 + w] += wt
+
+    datasets = _ReaderDatasets(image_file)
+
+    def read(window):
+        return _read_tile(datasets, processor, size, window)
+
+    def run(batch):
+        x = torch.stack([b[2] for b in batch])
+        if len(batch) < batch_size:
+            pad = x.new_zeros((batch_size - len(batch), *x.shape[1:]))
+            x = torch.cat([x, pad])
+        confs = apply_model_batch(
+            model, x, [(tile_size, tile_size)] * len(batch), device, bf16,
+            channels_last,
+        )
+        for (window, valid, _), conf in zip(batch, confs):
+            accumulate(window, valid, conf)
+
+    tmp_file = f'{output_file}.tmp.tif'
+    depth = 2 * batch_size + io_workers
+    with rasterio.open(tmp_file, 'w', **profile) as dst, datasets, \
+            ThreadPoolExecutor(io_workers, thread_name_prefix='read') as readers, \
+            tqdm(total=len(windows), desc='Tiles') as pbar:
+        batch = []
+        current_row = rows[0]
+        for window, valid, x in _prefetch(readers, read, windows, depth):
+            row = int(window.row_off)
+            if row != current_row:
+                # No later tile starts above this row: finish the previous
+                # tile row and write out everything above it
+                if batch:
+                    run(batch)
+                    batch = []
+                flush(row)
+                current_row = row
+            if x is not None:
+                batch.append((window, valid, x))
+                if len(batch) == batch_size:
+                    run(batch)
+                    batch = []
+            pbar.update(1)
+        if batch:
+            run(batch)
+        flush(height)
+
+    rasterio.shutil.copy(tmp_file, output_file, driver='COG',
+                         compress='deflate', predictor=3, blocksize=512,
+                         BIGTIFF='IF_SAFER')
+    os.remove(tmp_file)
+
+
+def crown_scores(mosaic_file, crowns):
+    """Per-crown confidence statistics from the confidence mosaic."""
+    stats = zonal_stats(
+        crowns.geometry, mosaic_file,
+        stats=['mean', 'max', 'count'], nodata=np.nan,
+        add_stats={'frac_above_half': lambda a: float((a > 0.5).mean()) if a.count() else np.nan},
+    )
+    scores = pd.DataFrame(stats, index=crowns.index)
+    scores.insert(0, 'tag', crowns['tag'])
+    return scores
+
+
 @click.command()
 @click.argument('modelfile')
 @click.argument('image_file')
 @click.argument('shapefile_path')
 @click.argument('output_dir')
-def main(modelfile, image_file, shapefile_path, output_dir):
-
+@click.option('-b', '--batch-size', default=8, type=click.IntRange(min=1),
+              show_default=True, help='Crown windows per forward pass.')
+@click.option('--device', default='auto', show_default=True,
+              help='auto, cuda, mps or cpu.')
+@click.option('--bf16', is_flag=True, help='Run the model under bfloat16 autocast.')
+@click.option('--channels-last', is_flag=True,
+              help='Use channels_last memory format for model and inputs.')
+@click.option('--io-workers', default=4, type=click.IntRange(min=1),
+              show_default=True,
+              help='Threads for reading windows and for writing GeoTIFFs.')
+@click.option('--mosaic', is_flag=True,
+              help='Classify the whole orthomosaic in overlapping tiles and '
+                   'write one confidence COG plus per-crown scores, instead '
+                   'of one GeoTIFF per crown window.')
+@click.option('--tile-size', default=512, type=click.IntRange(min=64),
+              show_default=True, help='Mosaic tile size in image pixels.')
+@click.option('--overlap', default=256, type=click.IntRange(min=0),
+              show_default=True, help='Overlap between mosaic tiles in pixels.')
+@click.option('--crown-index', default=None, type=click.Path(exists=True),
+              help='Parquet crown index (crown_index.py) with precomputed '
+                   'crown windows for this image grid.')
+def main(modelfile, image_file, shapefile_path, output_dir, batch_size, device,
+         bf16, channels_last, io_workers, mosaic, tile_size, overlap, crown_index):
+
+    device = select_device(device)
     model = torch.load(modelfile, weights_only=False, map_location=torch.device('cpu'))
     model.eval()
-    model.to('cpu')
+    model.to(device)
+    if channels_last:
+        model.to(memory_format=torch.channels_last)
 
     shp = gpd.read_file(shapefile_path)
 
@@ -257,23 +475,73 @@ def main(modelfile, image_file, shapefile_path, output_dir):
     shp = shp[shp['date'].dt.strftime('%Y_%m_%d') == date_token]
     print(f"Date {date_token}: {len(shp)} matching polygons")
 
-    with rasterio.open(image_file) as src:
-        for i, row in tqdm(shp.iterrows(), total=len(shp)):
-            tag = row['tag']
-            output_path = os.path.join(output_dir, f'{i:05d}_{tag}.tif')
-            if os.path.exists(output_path): continue
-
-            polygon = row['geometry']
-            w, img = extract_centered_window(src, polygon)
-            mask = polygon_mask(src, w, polygon)
-            x = preprocess(img)
-
-            # Flip dimensions from PIL image size
-            resize = img.size[::-1]
+    if mosaic:
+        if overlap >= tile_size:
+            raise click.BadParameter('must be smaller than --tile-size',
+                                     param_hint='--overlap')
+        stem = os.path.splitext(os.path.basename(image_file))[0]
+        mosaic_file = os.path.join(output_dir, f'{stem}_confidence.tif')
+        if os.path.exists(mosaic_file):
+            print(f'{mosaic_file} already exists')
+        else:
+            classify_mosaic(
+                model, image_file, mosaic_file, device, tile_size, overlap,
+                batch_size, bf16, channels_last, io_workers,
+            )
+        scores_file = os.path.join(output_dir, f'{stem}_crown_scores.csv')
+        crown_scores(mosaic_file, shp).to_csv(scores_file, index_label='index')
+        print(f'Wrote {mosaic_file} and {scores_file}')
+        return
 
-            conf = apply_model(model, x, resize)
-
-            save_window_geotiff(output_path, conf, src, w)
+    with rasterio.open(image_file) as src:
+        grid = RasterGrid(src.profile, src.transform)
+        grid_id = dataset_grid_key(src)
+
+    index = CrownIndex(crown_index) if crown_index else None
+    jobs = []
+    for i, row in shp.iterrows():
+        output_path = os.path.join(output_dir, f'{i:05d}_{row["tag"]}.tif')
+        if not os.path.exists(output_path):
+            crown = index.get(grid_id, row['tag'], date_token) if index else None
+            jobs.append(CrownJob(output_path, row['geometry'], crown))
+    print(f"{len(shp) - len(jobs)} already classified, {len(jobs)} to go")
+    if not jobs:
+        return
+
+    size = 512
+    processor = make_processor(size)
+    depth = 2 * batch_size + io_workers
+
+    datasets = _ReaderDatasets(image_file)
+
+    def read(job):
+        return _read_crown(datasets, processor, size, job)
+
+    with datasets, ThreadPoolExecutor(io_workers, thread_name_prefix='read') as readers, \
+            ThreadPoolExecutor(io_workers, thread_name_prefix='write') as writers, \
+            tqdm(total=len(jobs)) as pbar:
+        writes = deque()
+        for batch in _batches(_prefetch(readers, read, jobs, depth), batch_size):
+            x = torch.stack([b[3] for b in batch])
+            if len(batch) < batch_size:
+                # Pad the last batch so every forward pass has the same shape
+                pad = x.new_zeros((batch_size - len(batch), *x.shape[1:]))
+                x = torch.cat([x, pad])
+
+            confs = apply_model_batch(
+                model, x, [b[2] for b in batch], device, bf16, channels_last,
+            )
+
+            for (job, window, _, _), conf in zip(batch, confs):
+                writes.append(writers.submit(
+                    save_window_geotiff, job.output_path, conf, grid, window))
+            # Bound the confidence maps waiting to be written
+            while len(writes) > depth:
+                writes.popleft().result()
+            pbar.update(len(batch))
+
+        while writes:
+            writes.popleft().result()
 
 
 if __name__ == '__main__':
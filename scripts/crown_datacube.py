@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+"""Coregistered crown windows of every Planet scene in one Zarr datacube.
+
+coreg_crown_sequence.py, crown_ndvi_scores.py, image_embedding.py and
+generate_sequence_video.py used to work on thousands of small per-crown
+files, and opening them dominated the runtime on network volumes. This
+builder reads every scene once (scene-major, one windowed read covering all
+crowns). It cuts the same (2 * radius + 1)-pixel window around each crown
+centroid, with the global and drone coregistration shifts, that
+coreg_crown_sequence.extract_window cuts, and stores the windows as:
+
+    chips          (tag, time, band, y, x)  scene values; 0 outside the scene
+    row, col       (tag, time)              window origin in the scene
+    valid          (tag, time)              window origin inside the scene
+    clear_fraction (tag, time)              OCM clear pixels / OCM data pixels
+                                            in the window (NaN without --ocm-dir)
+    key            (time,)                  scene key in the global registration
+    offset_x/_y    (time,)                  total coregistration shift, px
+    geotransform   (time, 6)                scene GDAL geotransform
+    height, width  (time,)                  scene size, to crop edge windows
+    latin          (tag,)                   species, if the crown map has it
+
+Chunks are `tag_chunk` crowns x `time_chunk` scenes, written as scenes
+are appended along time, so the store grows (and resumes) by whole
+chunks. open_datacube() opens it lazily. crown_chips() selects one crown
+and an optional time range, and only the chunks it touches are read.
+
+    python scripts/crown_datacube.py <drone_coreg_json> <global_coreg_json> \\
+        <crownmap_shp> <planet_dir> crowns.zarr [--ndvi] [--ocm-dir DIR]
+"""
+import json
+import os
+import re
+from datetime import datetime
+
+import click
+import geopandas as gpd
+import numpy as np
+import rasterio
+import xarray as xr
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window
+from tqdm import tqdm
+from werkzeug.security import safe_join
+
+from crown_index import centroid_pixels
+
+PLANET_TIME = re.compile(r'(\d{8})(?:_(\d{6}))?')
+
+
+def load_offsets(globalregistration):
+    with open(globalregistration, 'r') as f:
+        results = json.load(f)
+
+    keys = [e['key'] for e in results]
+    offsets = np.array([
+        [e['x_offset'], e['y_offset']]
+        for e in results
+    ])
+
+    return keys, offsets
+
+
+def normalize(keys, offsets, reference_key):
+    if reference_key not in keys:
+        raise ValueError(f'Key {reference_key} not in offset list')
+
+    i = keys.index(reference_key)
+    return (offsets - offsets[i])
+
+
+def scene_offsets(droneregistration, globalregistration):
+    """Planet scene keys and their total (x, y) shift in pixels: the global
+    coregistration offset relative to the drone's reference scene, plus the
+    drone-to-Planet shift."""
+    keys, offsets = load_offsets(globalregistration)
+
+    with open(droneregistration, 'r') as f:
+        drone = json.load(f)
+
+    offsets = normalize(keys, offsets, drone['planet_map'])
+    drone_offset = np.array([
+        drone['coreg_info']['corrected_shifts_px']['x'],
+        drone['coreg_info']['corrected_shifts_px']['y'],
+    ])
+    return keys, offsets + drone_offset
+
+
+def planet_datetime(key):
+    """Acquisition time of a Planet scene key (YYYYMMDD[_HHMMSS]_...)."""
+    m = PLANET_TIME.match(os.path.basename(key))
+    if m is None:
+        raise ValueError(f'Could not parse a date from {key}')
+    return datetime.strptime(m.group(1) + (m.group(2) or '000000'), '%Y%m%d%H%M%S')
+
+
+def scale_subframe(subframe, ndvi=False):
+    """Crown subframe scaled to uint8 as in the sequence PNGs (NDVI * 255,
+    other products by their maximum), or None for an all-zero window."""
+    subframe = np.array(subframe, dtype=float)
+    maxval = 1.0 if ndvi else np.max(subframe)
+    if maxval == 0:
+        return None
+
+    subframe *= (255 / maxval)
+    return subframe.astype(np.uint8)
+
+
+# -- building -------------------------------------------------------------------
+
+def _ocm_path(ocm_dir, key):
+    stem = key
+    for suffix in ('_rgb', '_4band', '_ndvi'):
+        if stem.endswith(suffix):
+            stem = stem[:-len(suffix)]
+            break
+    path = os.path.join(ocm_dir, f'{stem}_ocm.tif')
+    return path if os.path.exists(path) else None
+
+
+def _read_block(src, r0, c0, r1, c1):
+    """Rows r0:r1, cols c0:c1 of `src` (clipped to the scene), all bands."""
+    r1, c1 = min(r1, src.height), min(c1, src.width)
+    return src.read(window=Window(c0, r0, c1 - c0, r1 - r0))
+
+
+def read_scene(imagefile, crowns, offset, radius, ocm_file=None):
+    """
+    Crown windows of one scene. Returns a dict of per-crown arrays
+    (chips, row, col, valid, clear_fraction) and per-scene values
+    (geotransform, height, width).
+    """
+    size = 2 * radius + 1
+    with rasterio.open(imagefile) as src:
+        cy, cx = centroid_pixels(crowns, src.transform)
+        row = np.round(cy - offset[1] - radius).astype(np.int32)
+        col = np.round(cx - offset[0] - radius).astype(np.int32)
+        valid = (row >= 0) & (col >= 0) & (row < src.height) & (col < src.width)
+
+        chips = np.zeros((len(crowns), src.count, size, size), dtype=src.dtypes[0])
+        clear = np.full(len(crowns), np.nan, dtype=np.float32)
+        scene = {'geotransform': np.array(src.transform.to_gdal()),
+                 'height': src.height, 'width': src.width}
+        if not valid.any():
+            return {'chips': chips, 'row': row, 'col': col, 'valid': valid,
+                    'clear_fraction': clear, **scene}
+
+        r0, c0 = int(row[valid].min()), int(col[valid].min())
+        r1, c1 = int(row[valid].max()) + size, int(col[valid].max()) + size
+        block = _read_block(src, r0, c0, r1, c1)
+
+        ocm = None
+        if ocm_file is not None:
+            with rasterio.open(ocm_file) as ocm_src:
+                # OCM masks are on the scene's native grid; warp otherwise
+                if (ocm_src.transform, ocm_src.shape) == (src.transform, src.shape):
+                    ocm = _read_block(ocm_src, r0, c0, r1, c1)[0]
+                else:
+                    with WarpedVRT(ocm_src, crs=src.crs, transform=src.transform,
+                                   width=src.width, height=src.height,
+                                   resampling=Resampling.nearest) as vrt:
+                        ocm = _read_block(vrt, r0, c0, r1, c1)[0]
+
+    for i in np.flatnonzero(valid):
+        ys = slice(row[i] - r0, row[i] - r0 + size)
+        xs = slice(col[i] - c0, col[i] - c0 + size)
+        window = block[:, ys, xs]
+        chips[i, :, :window.shape[1], :window.shape[2]] = window
+        if ocm is not None:
+            classes = ocm[ys, xs]
+            data = int((classes != 255).sum())
+            if data:
+                clear[i] = (classes == 0).sum() / data
+
+    return {'chips': chips, 'row': row, 'col': col, 'valid': valid,
+            'clear_fraction': clear, **scene}
+
+
+def _scene_batch(scenes, times, keys, offsets, tags, latin):
+    def stack(name):
+        return np.stack([s[name] for s in scenes], axis=1)
+
+    ds = xr.Dataset(
+        data_vars={
+            'chips': (('tag', 'time', 'band', 'y', 'x'), stack('chips')),
+            'row': (('tag', 'time'), stack('row')),
+            'col': (('tag', 'time'), stack('col')),
+            'valid': (('tag', 'time'), stack('valid')),
+            'clear_fraction': (('tag', 'time'), stack('clear_fraction')),
+            'key': ('time', np.array(keys, dtype=object)),
+            'offset_x': ('time', np.array([o[0] for o in offsets], dtype=np.float64)),
+            'offset_y': ('time', np.array([o[1] for o in offsets], dtype=np.float64)),
+            'geotransform': (('time', 'gt'), np.stack([s['geotransform'] for s in scenes])),
+            'height': ('time', np.array([s['height'] for s in scenes], dtype=np.int32)),
+            'width': ('time', np.array([s['width'] for s in scenes], dtype=np.int32)),
+        },
+        coords={
+            'tag': np.array(tags, dtype=object),
+            'time': np.array(times, dtype='datetime64[ns]'),
+        },
+    )
+    if latin is not None:
+        ds['latin'] = ('tag', np.array(latin, dtype=object))
+    return ds
+
+
+def build_datacube(store, imagedir, crowns, keys, offsets, radius=25, ndvi=False,
+                   ocm_dir=None, tag_chunk=64, time_chunk=8):
+    """
+    Append the crown windows of every scene key not yet in `store`, in time
+    order, `time_chunk` scenes per write. Missing scenes are skipped.
+    Returns the number of scenes added.
+    """
+    tags = crowns['tag'].astype(str).tolist()
+    latin = crowns['latin'].fillna('').astype(str).tolist() if 'latin' in crowns else None
+
+    done = set()
+    if os.path.exists(store):
+        existing = xr.open_zarr(store, chunks=None)
+        if existing['tag'].values.tolist() != tags:
+            raise ValueError(f'{store} was built for a different crown list')
+        done = set(existing['key'].values.tolist())
+
+    todo = []
+    for key, offset in zip(keys, offsets):
+        stem = key.replace('_rgb', '_ndvi') if ndvi else key
+        imagefile = safe_join(imagedir, stem + '.tif')
+        if key in done or not os.path.exists(imagefile):
+            continue
+        todo.append((planet_datetime(key), key, offset, imagefile))
+    todo.sort(key=lambda t: t[0])
+
+    for start in tqdm(range(0, len(todo), time_chunk), 'Writing chunks'):
+        batch = todo[start:start + time_chunk]
+        scenes = [
+            read_scene(imagefile, crowns, offset, radius,
+                       _ocm_path(ocm_dir, key) if ocm_dir else None)
+            for _, key, offset, imagefile in batch
+        ]
+        ds = _scene_batch(scenes, [t for t, *_ in batch], [k for _, k, _, _ in batch],
+                          [o for _, _, o, _ in batch], tags, latin)
+        if os.path.exists(store):
+            ds.drop_vars(['tag', 'latin'], errors='ignore').to_zarr(store, append_dim='time')
+        else:
+            chips = ds['chips'].shape
+            ds.to_zarr(store, mode='w', encoding={
+                'chips': {'chunks': (min(tag_chunk, chips[0]), time_chunk, *chips[2:])},
+                **{v: {'chunks': (min(tag_chunk, chips[0]), time_chunk)}
+                   for v in ('row', 'col', 'valid', 'clear_fraction')},
+            })
+    return len(todo)
+
+
+# -- reading --------------------------------------------------------------------
+
+def open_datacube(store):
+    """The datacube as a lazily loaded Dataset, sorted by time."""
+    ds = xr.open_zarr(store, chunks=None)
+    if not ds.indexes['time'].is_monotonic_increasing:
+        ds = ds.sortby('time')
+    return ds
+
+
+def crown_chips(ds, tag, start=None, end=None):
+    """(time, ...) sequence of one crown, optionally limited to a time range;
+    nothing is read until values are accessed."""
+    return ds.sel(tag=str(tag)).sel(time=slice(start, end))
+
+
+def chip_subframe(frame):
+    """
+    The window of one (tag, time) entry as an (y, x[, band]) array, cropped
+    at the scene's bottom and right edges as slicing the scene would be;
+    None if the window origin is outside the scene.
+    """
+    if not bool(frame['valid']):
+        return None
+    size = frame.sizes['y']
+    h = min(size, int(frame['height']) - int(frame['row']))
+    w = min(size, int(frame['width']) - int(frame['col']))
+    chip = np.moveaxis(frame['chips'].values[:, :h, :w], 0, -1)
+    return chip[..., 0] if chip.shape[-1] == 1 else chip
+
+
+@click.command()
+@click.argument('droneregistration')
+@click.argument('globalregistration')
+@click.argument('shapefile')
+@click.argument('imagedir')
+@click.argument('store')
+@click.option('-r', '--radius', type=int, default=25, show_default=True)
+@click.option('-n', '--ndvi', is_flag=True, help='Store the _ndvi products instead of _rgb.')
+@click.option('--ocm-dir', default=None, type=click.Path(exists=True),
+              help='OCM masks (<scene>_ocm.tif) for per-crown clear fractions.')
+@click.option('--tags', default=None, help='Comma-separated crown tags (default: all).')
+@click.option('--tag-chunk', default=64, show_default=True)
+@click.option('--time-chunk', default=8, show_default=True)
+def main(droneregistration, globalregistration, shapefile, imagedir, store, radius, ndvi,
+         ocm_dir, tags, tag_chunk, time_chunk):
+
+    crowns = gpd.read_file(shapefile)
+    crowns = crowns.dropna(subset=['geometry']).drop_duplicates('tag')
+    if tags is not None:
+        crowns = crowns[crowns['tag'].astype(str).isin(tags.split(','))]
+    crowns = crowns.sort_values('tag')
+
+    keys, offsets = scene_offsets(droneregistration, globalregistration)
+    added = build_datacube(store, imagedir, crowns, keys, offsets, radius, ndvi,
+                           ocm_dir, tag_chunk, time_chunk)
+    print(f'Added {added} scenes of {len(crowns)} crowns to {store}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,7 @@
 #Import libraries/modules
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 import click
 import geopandas as gpd
 import rasterio
@@ -7,6 +9,11 @@ import numpy as np
 from PIL import Image
 from tqdm import tqdm
 
+from rasterio.transform import rowcol
+from rasterio.windows import Window
+
+from crown_index import CrownIndex, crown_dates, dataset_grid_key
+
 #Change tag ID to whatever tree species you would like to extract
 tag_id = 'your_tag_id'
 
@@ -29,42 +36,59 @@ def get_tree_crown(geodataframe, tag_id):
         return None
     return tree_crowns.geometry.values[0]
 
+#Pixel windows of window_size around crown centres (scalars or arrays), kept
+#inside the image; `valid` is False where a window would fall outside it
+def centered_pixel_window(center_row, center_col, height, width, window_size=25):
+    center_row, center_col = np.asarray(center_row), np.asarray(center_col)
+    half_window = window_size // 2
+
+    row_start = np.maximum(center_row - half_window, 0)
+    row_end = np.minimum(center_row + half_window, height)
+    col_start = np.maximum(center_col - half_window, 0)
+    col_end = np.minimum(center_col + half_window, width)
+
+    valid = (
+        (col_end - col_start >= (window_size - 1)) &
+        (row_end - row_start >= (window_size - 1))
+    )
+
+    # Adjust window size if it exceeds image boundaries
+    short = row_end - row_start < window_size
+    row_start = np.where(short, np.maximum(0, row_end - window_size), row_start)
+    row_end = np.where(short, row_start + window_size, row_end)
+    short = col_end - col_start < window_size
+    col_start = np.where(short, np.maximum(0, col_end - window_size), col_start)
+    col_end = np.where(short, col_start + window_size, col_end)
+
+    # Ensure window is within image boundaries
+    over = row_end > height
+    row_end = np.where(over, height, row_end)
+    row_start = np.where(over, row_end - window_size, row_start)
+    over = col_end > width
+    col_end = np.where(over, width, col_end)
+    col_start = np.where(over, col_end - window_size, col_start)
+
+    return (row_start, row_end), (col_start, col_end), valid
+
 #Extract a 25x25 window around the tree crown
-def extract_window(image_path, tree_crown, window_size=25):
+def extract_window(image_path, tree_crown, window_size=25, index=None, tag_id=None, date=None):
     with rasterio.open(image_path) as src:
-        bounds = tree_crown.bounds
-        center_x, center_y = (bounds[0] + bounds[2]) / 2, (bounds[1] + bounds[3]) / 2
-
-        # Calculate pixel coordinates
-        center_row, center_col = src.index(center_x, center_y)
-        half_window = window_size // 2
-
-        row_start = max(center_row - half_window, 0)
-        row_end = min(center_row + half_window, src.height)
-        col_start = max(center_col - half_window, 0)
-        col_end = min(center_col + half_window, src.width)
-
-        if (
-            (col_end - col_start < (window_size - 1)) or
-            (row_end - row_start < (window_size - 1))
-        ):
-            raise ValueError('Outside bounds')
+        crown = index.get(src, tag_id, date) if index is not None else None
+        if crown is not None:
+            center_row, center_col = crown.center_row, crown.center_col
+        else:
+            bounds = tree_crown.bounds
+            center_x, center_y = (bounds[0] + bounds[2]) / 2, (bounds[1] + bounds[3]) / 2
+
+            # Calculate pixel coordinates
+            center_row, center_col = src.index(center_x, center_y)
 
-        # Adjust window size if it exceeds image boundaries
-        if row_end - row_start < window_size:
-            row_start = max(0, row_end - window_size)
-            row_end = row_start + window_size
-        if col_end - col_start < window_size:
-            col_start = max(0, col_end - window_size)
-            col_end = col_start + window_size
-
-        # Ensure window is within image boundaries
-        if row_end > src.height:
-            row_end = src.height
-            row_start = row_end - window_size
-        if col_end > src.width:
-            col_end = src.width
-            col_start = col_end - window_size
+        (row_start, row_end), (col_start, col_end), valid = centered_pixel_window(
+            center_row, center_col, src.height, src.width, window_size)
+        if not valid:
+            raise ValueError('Outside bounds')
+        row_start, row_end, col_start, col_end = (
+            int(v) for v in (row_start, row_end, col_start, col_end))
 
         window = src.read(window=((row_start, row_end), (col_start, col_end)))
         window_transform = src.window_transform(((row_start, row_end), (col_start, col_end)))
@@ -81,43 +105,89 @@ def save_window(window, output_folder, filename):
     image.save(output_path)
     return output_path
 
-#Process the images
-def process_images(image_folder, shapefile_path, tag_id, output_folder):
-    images = load_images_from_folder(image_folder)
-    
-    shapefile = load_shapefile(shapefile_path)
-    
-    tree_crown = get_tree_crown(shapefile, tag_id)
-    if tree_crown is None:
-        print(f"Tree crown with tag ID {tag_id} not found in shapefile.")
-        return
-    
-    for image_path in images:
-        try:
-            window, _ = extract_window(image_path, tree_crown)
-        except ValueError:
-            continue
-        filename = os.path.basename(image_path)
-        save_path = save_window(window, output_folder, filename)
+#Crown centres (bounds centre) of every crown on a scene's grid
+def crown_centers(src, crowns, index=None):
+    bounds = crowns.geometry.bounds
+    center_row, center_col = (np.asarray(v) for v in rowcol(
+        src.transform, ((bounds.minx + bounds.maxx) / 2).values,
+        ((bounds.miny + bounds.maxy) / 2).values))
+    if index is not None:
+        grid = dataset_grid_key(src)
+        for i, (tag_id, date) in enumerate(zip(crowns['tag'], crown_dates(crowns))):
+            crown = index.get(grid, tag_id, date)
+            if crown is not None:
+                center_row[i], center_col[i] = crown.center_row, crown.center_col
+    return center_row, center_col
+
+#Extract the chips of all crowns from one scene: one windowed read covering
+#every crown window, then array slicing. Returns the number of chips written.
+def extract_scene(image_path, crowns, output_folder, window_size=25, index=None,
+                  existing=None):
+    filename = os.path.basename(image_path)
+    todo = [existing is None or filename not in existing[t] for t in crowns['tag']]
+    crowns = crowns[todo]
+    if crowns.empty:
+        return 0
+
+    with rasterio.open(image_path) as src:
+        center_row, center_col = crown_centers(src, crowns, index)
+        (row_start, row_end), (col_start, col_end), valid = centered_pixel_window(
+            center_row, center_col, src.height, src.width, window_size)
+        if not valid.any():
+            return 0
+        row_start, row_end = row_start[valid], row_end[valid]
+        col_start, col_end = col_start[valid], col_end[valid]
+
+        r0, c0 = int(row_start.min()), int(col_start.min())
+        block = src.read(window=Window(c0, r0, int(col_end.max()) - c0, int(row_end.max()) - r0))
+
+    for tag_id, rs, re_, cs, ce in zip(crowns['tag'][valid], row_start, row_end, col_start, col_end):
+        window = block[:, rs - r0:re_ - r0, cs - c0:ce - c0]
+        save_window(window, os.path.join(output_folder, tag_id), filename)
+    return int(valid.sum())
 
 
 @click.command()
 @click.argument('image_folder')
 @click.argument('shapefile_path')
 @click.argument('output_folder')
-def main(image_folder, shapefile_path, output_folder):
+@click.option('--crown-index', default=None, type=click.Path(exists=True),
+              help='Parquet crown index (crown_index.py) with precomputed crown centres.')
+@click.option('--every', default=1, type=click.IntRange(min=1), show_default=True,
+              help='Extract every Nth tag only (the old default was 50).')
+@click.option('-w', '--workers', default=4, type=click.IntRange(min=1), show_default=True,
+              help='Scenes read and written concurrently.')
+@click.option('--window-size', default=25, type=click.IntRange(min=1), show_default=True)
+def main(image_folder, shapefile_path, output_folder, crown_index, every, workers, window_size):
 
     shp = load_shapefile(shapefile_path)
     tags = np.unique(shp['tag'])
-    tags = sorted([t for t in tags if int(t) > 0])
+    tags = sorted([t for t in tags if int(t) > 0])[::every]
+    index = CrownIndex(crown_index) if crown_index else None
 
-    for tag_id in tqdm(tags[::50], 'Extracting Crowns'):
+    # First polygon of each tag, as get_tree_crown picks it
+    crowns = shp[shp['tag'].isin(tags)].drop_duplicates('tag')
+
+    # Chips already written are skipped, so an interrupted run resumes
+    existing = {}
+    for tag_id in crowns['tag']:
         outdir = os.path.join(output_folder, tag_id)
-        if not os.path.exists(outdir):
-            os.makedirs(outdir)
-        else:
-            continue
-        process_images(image_folder, shapefile_path, tag_id, outdir)
+        os.makedirs(outdir, exist_ok=True)
+        existing[tag_id] = set(os.listdir(outdir))
+
+    images = sorted(load_images_from_folder(image_folder))
+
+    def extract(image_path):
+        return extract_scene(image_path, crowns, output_folder, window_size, index, existing)
+
+    start = time.perf_counter()
+    n_chips = 0
+    with ThreadPoolExecutor(workers) as pool:
+        for n in tqdm(pool.map(extract, images), 'Extracting Crowns', total=len(images)):
+            n_chips += n
+    elapsed = time.perf_counter() - start
+    print(f'{n_chips} chips of {len(crowns)} crowns from {len(images)} scenes '
+          f'in {elapsed:.1f} s ({n_chips / max(elapsed, 1e-9):.0f} chips/s)')
 
 ## Specify the paths
 #image_folder = 'your/file/path'
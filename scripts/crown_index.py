@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+"""Crown polygons precomputed as pixel windows per image grid.
+
+Crown scripts used to turn each polygon into pixel coordinates for every
+image they read: bounds -> src.index, centroid -> affine transform, and
+sometimes rasterize. This work repeats over 100k+ crown-date pairs, even
+though most images share a grid (one per orthomosaic, or one for all Planet
+scenes clipped to the plot). The index does it once per grid and stores one
+row per (grid, tag, date) in Parquet:
+
+    grid                      grid_key() of the image transform and shape
+    tag, date                 crown tag; 'YYYY_MM_DD' or '' for static crowns
+    row_min .. col_max        pixel bbox of the polygon bounds (inclusive, as
+                              src.index of the bounds corners)
+    center_row, center_col    src.index of the bounds centre
+    centroid_row, centroid_col
+                              polygon centroid in fractional pixel coordinates
+    mask                      polygon rasterized over the bbox
+                              (np.packbits), or None with --no-masks
+
+Readers look an entry up with CrownIndex.get() and then only do integer
+arithmetic and array slicing (centered_window, offset_window, crown_mask).
+The polygon is assumed to be in the image CRS, as every crown script already
+assumes, so the CRS is not part of the grid key.
+
+    python scripts/crown_index.py <crownmap_shp> crown_index.parquet <image files...>
+"""
+import hashlib
+import os
+import re
+
+import click
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+from PIL import Image
+from rasterio.features import rasterize
+from rasterio.transform import rowcol
+from rasterio.windows import Window
+from tqdm import tqdm
+
+# A whole 'YYYY_MM_DD' token, as in drone filenames. Planet scene names
+# (20230101_150000_12_2451_3B_...) contain digit runs that an unanchored
+# pattern would misread as a date ('0000_12_24').
+DATE_TOKEN = re.compile(r'(?<!\d)\d{4}_\d{2}_\d{2}(?!\d)')
+
+BBOX = ['row_min', 'row_max', 'col_min', 'col_max']
+
+
+def grid_key(transform, width, height):
+    """Stable id of an image grid (GDAL-order geotransform and size)."""
+    text = ','.join(f'{v:.9g}' for v in transform.to_gdal()) + f',{int(width)},{int(height)}'
+    return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+
+def dataset_grid_key(src):
+    return grid_key(src.transform, src.width, src.height)
+
+
+def image_date(path):
+    """'YYYY_MM_DD' token of an image filename, or '' if it has none."""
+    m = DATE_TOKEN.search(os.path.basename(path))
+    return m.group(0) if m else ''
+
+
+def crown_dates(crowns):
+    """Per-crown 'YYYY_MM_DD' strings ('' when the map has no date column)."""
+    if 'date' not in crowns:
+        return pd.Series('', index=crowns.index)
+    dates = crowns['date']
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        return dates.dt.strftime('%Y_%m_%d').fillna('')
+    return dates.fillna('').astype(str).str.replace('-', '_')
+
+
+# -- pixel arithmetic (shared by the index and the polygon fallbacks) ----------
+
+def polygon_pixel_bbox(transform, bounds):
+    """(row_min, row_max, col_min, col_max) of polygon bounds on a grid.
+
+    `bounds` may be one (minx, miny, maxx, maxy) tuple or four arrays.
+    """
+    minx, miny, maxx, maxy = bounds
+    top_row, left_col = rowcol(transform, minx, maxy)
+    bottom_row, right_col = rowcol(transform, maxx, miny)
+    top_row, left_col, bottom_row, right_col = (
+        np.asarray(v) for v in (top_row, left_col, bottom_row, right_col))
+    return (np.minimum(top_row, bottom_row), np.maximum(top_row, bottom_row),
+            np.minimum(left_col, right_col), np.maximum(left_col, right_col))
+
+
+def centroid_pixels(crowns, transform):
+    """Fractional (row, col) arrays of the crown centroids on a grid."""
+    centroids = crowns.geometry.centroid
+    inv = ~transform
+    cx, cy = centroids.x.values, centroids.y.values
+    return inv.d * cx + inv.e * cy + inv.f, inv.a * cx + inv.b * cy + inv.c
+
+
+def centered_window(bbox, height, width, min_size=512, pixel_buffer=100):
+    """
+    Window fully containing a pixel bbox, with at least `pixel_buffer`
+    pixels around it and at least min_size x min_size pixels (expanded
+    around its centre), clamped to a height x width raster.
+    """
+    row_min, row_max, col_min, col_max = (int(v) for v in bbox)
+
+    row_min -= pixel_buffer
+    row_max += pixel_buffer
+    col_min -= pixel_buffer
+    col_max += pixel_buffer
+
+    h = row_max - row_min + 1
+    w = col_max - col_min + 1
+    if h < min_size:
+        pad = (min_size - h) // 2
+        row_min -= pad
+        row_max += (min_size - h - pad)
+    if w < min_size:
+        pad = (min_size - w) // 2
+        col_min -= pad
+        col_max += (min_size - w - pad)
+
+    row_min = max(row_min, 0)
+    col_min = max(col_min, 0)
+    row_max = min(row_max, height - 1)
+    col_max = min(col_max, width - 1)
+
+    return Window(col_off=col_min, row_off=row_min,
+                  width=col_max - col_min + 1, height=row_max - row_min + 1)
+
+
+def extract_centered_window(src, polygon, min_size=512, pixel_buffer=100, crown=None):
+    """
+    Extract a raster window fully containing the polygon, with:
+      • at least min_size x min_size pixels
+      • at least pixel_buffer pixels around the polygon
+      • centered on the polygon when expanding to min_size
+
+    Parameters
+    ----------
+    src : rasterio.io.DatasetReader
+        Open rasterio dataset.
+    polygon : shapely.geometry.Polygon
+        Polygon in the same CRS as the raster. Ignored when `crown` is given.
+    min_size : int
+        Minimum window size (pixels) on each side.
+    pixel_buffer : int
+        Extra pixels to include around the polygon.
+    crown : CrownIndex entry, optional
+        Precomputed pixel bbox of the polygon on this grid.
+
+    Returns
+    -------
+    window : rasterio.windows.Window
+        The computed window.
+    img : PIL.Image
+        The first three bands of `src.read(window=window)`.
+    """
+    if crown is not None:
+        bbox = [getattr(crown, c) for c in BBOX]
+    else:
+        bbox = polygon_pixel_bbox(src.transform, polygon.bounds)
+    window = centered_window(bbox, src.height, src.width, min_size, pixel_buffer)
+    data = src.read(window=window)
+    return window, Image.fromarray(np.transpose(data, (1, 2, 0))[..., :3])
+
+
+def offset_window(crown, offset, radius):
+    """
+    (row, col) of the top-left corner of the (2 * radius + 1)-pixel square
+    centred on the crown centroid after a coregistration shift of `offset`
+    (x, y) pixels, as coreg_crown_sequence.extract_window computes it.
+    """
+    row = int(np.round(crown.centroid_row - offset[1] - radius))
+    col = int(np.round(crown.centroid_col - offset[0] - radius))
+    return row, col
+
+
+def crown_mask(crown):
+    """Boolean polygon mask over the crown's pixel bbox."""
+    if crown.mask is None:
+        raise ValueError('Crown index was built without masks')
+    h = crown.row_max - crown.row_min + 1
+    w = crown.col_max - crown.col_min + 1
+    bits = np.unpackbits(np.frombuffer(crown.mask, dtype=np.uint8), count=h * w)
+    return bits.reshape(h, w).astype(bool)
+
+
+# -- building -------------------------------------------------------------------
+
+def index_grid(crowns, transform, masks=True):
+    """Index rows (DataFrame) of every crown in `crowns` on one grid."""
+    bounds = crowns.geometry.bounds
+    row_min, row_max, col_min, col_max = polygon_pixel_bbox(
+        transform, (bounds.minx.values, bounds.miny.values,
+                    bounds.maxx.values, bounds.maxy.values))
+    center_row, center_col = rowcol(
+        transform, ((bounds.minx + bounds.maxx) / 2).values,
+        ((bounds.miny + bounds.maxy) / 2).values)
+
+    centroid_row, centroid_col = centroid_pixels(crowns, transform)
+
+    rows = pd.DataFrame({
+        'tag': crowns['tag'].astype(str).values,
+        'date': crown_dates(crowns).values,
+        'row_min': row_min.astype(np.int32),
+        'row_max': row_max.astype(np.int32),
+        'col_min': col_min.astype(np.int32),
+        'col_max': col_max.astype(np.int32),
+        'center_row': np.asarray(center_row, dtype=np.int32),
+        'center_col': np.asarray(center_col, dtype=np.int32),
+        'centroid_row': centroid_row,
+        'centroid_col': centroid_col,
+    })
+
+    packed = None
+    if masks:
+        packed = []
+        for geom, r0, r1, c0, c1 in zip(crowns.geometry, row_min, row_max, col_min, col_max):
+            window = Window(c0, r0, c1 - c0 + 1, r1 - r0 + 1)
+            mask = rasterize(
+                [(geom, 1)], out_shape=(int(window.height), int(window.width)),
+                transform=rasterio.windows.transform(window, transform),
+                fill=0, dtype=np.uint8, all_touched=False,
+            )
+            packed.append(np.packbits(mask, axis=None).tobytes())
+    rows['mask'] = packed
+    return rows
+
+
+def build_index(crowns, image_files, masks=True, existing=None):
+    """
+    Index `crowns` on the grid of every image. Images that share a grid are
+    indexed once. A dated crown map is restricted to the dates of that
+    grid's images, unless one of them has no date in its filename or none
+    of their dates is a date of the crown map (Planet scenes). Entries
+    already in `existing` are kept; only missing (grid, date)s are added.
+    """
+    grids = {}
+    for path in image_files:
+        with rasterio.open(path) as src:
+            key = dataset_grid_key(src)
+            transform = src.transform
+        grids.setdefault(key, (transform, set()))[1].add(image_date(path))
+
+    done = {}
+    if existing is not None:
+        for key, date in zip(existing['grid'], existing['date']):
+            done.setdefault(key, set()).add(date)
+    dates = crown_dates(crowns)
+    map_dates = set(dates)
+    parts = [existing] if existing is not None else []
+    for key, (transform, grid_dates) in tqdm(grids.items(), 'Indexing grids'):
+        if 'date' in crowns and '' not in grid_dates and grid_dates & map_dates:
+            selected = crowns[dates.isin(grid_dates - done.get(key, set())).values]
+        elif key in done:
+            continue
+        else:
+            selected = crowns
+        if selected.empty:
+            continue
+        rows = index_grid(selected, transform, masks)
+        rows.insert(0, 'grid', key)
+        parts.append(rows)
+
+    if not parts:
+        return pd.DataFrame(columns=['grid', 'tag', 'date', *BBOX])
+    return pd.concat(parts, ignore_index=True)
+
+
+class CrownIndex:
+    """Crown entries of a Parquet index, looked up by (grid, tag, date)."""
+
+    def __init__(self, path):
+        df = pd.read_parquet(path)
+        if 'mask' not in df:
+            df['mask'] = None
+        self._by_date = {}
+        self._by_tag = {}
+        for entry in df.itertuples(index=False, name='CrownEntry'):
+            self._by_date[(entry.grid, entry.tag, entry.date)] = entry
+            self._by_tag.setdefault((entry.grid, entry.tag), []).append(entry)
+
+    def __len__(self):
+        return len(self._by_date)
+
+    def get(self, grid, tag, date=None):
+        """
+        Entry of crown `tag` on `grid` (a grid_key, or an open dataset), or
+        None if it is not indexed. Without `date` the tag must have a single
+        entry on that grid.
+        """
+        if not isinstance(grid, str):
+            grid = dataset_grid_key(grid)
+        if date is not None:
+            return self._by_date.get((grid, str(tag), date))
+        entries = self._by_tag.get((grid, str(tag)), [])
+        if len(entries) > 1:
+            raise LookupError(f'{len(entries)} dated entries for crown {tag}; pass a date')
+        return entries[0] if entries else None
+
+
+@click.command()
+@click.argument('shapefile')
+@click.argument('index_file')
+@click.argument('image_files', nargs=-1, required=True)
+@click.option('--no-masks', is_flag=True, help='Do not store rasterized crown masks.')
+@click.option('--rebuild', is_flag=True, help='Reindex grids already in INDEX_FILE.')
+def main(shapefile, index_file, image_files, no_masks, rebuild):
+    crowns = gpd.read_file(shapefile)
+
+    existing = None
+    if os.path.exists(index_file) and not rebuild:
+        existing = pd.read_parquet(index_file)
+
+    index = build_index(crowns, image_files, masks=not no_masks, existing=existing)
+    tmp = f'{index_file}.{os.getpid()}.tmp'
+    index.to_parquet(tmp, index=False)
+    os.replace(tmp, index_file)
+    print(f'{len(index)} crown entries on {index["grid"].nunique()} grids -> {index_file}')
+
+
+if __name__ == '__main__':
+    main()
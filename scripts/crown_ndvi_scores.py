@@ -3,47 +3,52 @@ import os
 import json
 import click
 import numpy as np
+import rasterio
+import shapely
+import xarray as xr
 from tqdm import tqdm
 import geopandas as gpd
+from rasterio.windows import Window
+from shapely.affinity import affine_transform
 from werkzeug.security import safe_join
 
 from geoarray import GeoArray
-from coreg_crown_sequence import load_offsets, normalize
+from calculate_ndvi import CoefficientCache, open_ndvi, read_ndvi
+from coreg_crown_sequence import crown_topleft
+from crown_datacube import (
+    chip_subframe, crown_chips, open_datacube, planet_datetime, scene_offsets,
+)
+from crown_index import CrownIndex, centroid_pixels
 
+# Crowns gathered per fancy-indexing pass, to bound the (crowns, y, x) float64 stack
+CROWN_BATCH = 1024
 
-def extract_score(imagedir, key, poly, offset, radius):
+
+def ndvi_path(imagedir, key):
     ndvi_key = '_'.join(key.split('_')[:-1]) + '_ndvi'
-    imagefile = safe_join(imagedir, ndvi_key + '.tif')
+    return safe_join(imagedir, ndvi_key + '.tif')
 
-    img = GeoArray(imagefile)
 
-    xscale = 1.0 / img.geotransform[1]
-    yscale = 1.0 / img.geotransform[5]
-    xoff = -xscale * img.geotransform[0]
-    yoff = -yscale * img.geotransform[3]
+def scene_path(imagedir, key):
+    """AnalyticMS scene the NDVI raster of `key` is computed from (calc_all_ndvi.py)."""
+    return safe_join(imagedir, '_'.join(key.split('_')[:-1]) + '.tif')
 
-    # Translate from map to image pixels
-    poly = poly.affine_transform([xscale, 0, 0, yscale, xoff, yoff])
 
-    # Apply co-registration shift
-    poly = poly.translate(xoff=-offset[0], yoff=-offset[1])
+def extract_score(imagedir, key, poly, offset, radius, index=None, tag=None):
+    img = GeoArray(ndvi_path(imagedir, key))
 
     height = 2*radius + 1
-    width = 2*radius + 1
 
-    topleft = poly.centroid.translate(xoff=-radius, yoff=-radius)
-    row, col = (
-        int(np.round(topleft.y.iloc[0])),
-        int(np.round(topleft.x.iloc[0])),
-    )
+    row, col = crown_topleft(img, poly, offset, radius, index, tag)
 
     if min(row, col) < 0:
         return
 
-    # Apply subframe shift
-    poly = poly.translate(xoff=-col, yoff=-row)
+    return ndvi_score(img[row:row+height, col:col+height])
+
 
-    subframe = np.array(img[row:row+height, col:col+height], dtype=float)
+def ndvi_score(subframe):
+    subframe = np.array(subframe, dtype=float)
     subframe[subframe == 0] = np.nan
 
     if np.all(np.isnan(subframe)):
@@ -52,6 +57,167 @@ def extract_score(imagedir, key, poly, offset, radius):
     return np.nanmean(subframe)
 
 
+def datacube_scores(ds, crownid):
+    """Scores of one crown from a crown_datacube.py store built with --ndvi."""
+    seq = crown_chips(ds, crownid).load()
+    scores = {}
+    for t in range(seq.sizes['time']):
+        frame = seq.isel(time=t)
+        subframe = chip_subframe(frame)
+        if subframe is None:
+            continue
+        score = ndvi_score(subframe)
+        if score is None: continue
+        scores[str(frame['key'].values)] = score
+    return scores
+
+
+def crown_pixel_shapes(crowns, transform):
+    """
+    Crown polygons in pixel coordinates (x = col, y = row) relative to their
+    centroid, prepared for point tests, and the largest distance (whole
+    pixels) of any polygon from its centroid. Only the pixel size and
+    rotation of `transform` matter.
+    """
+    cy, cx = centroid_pixels(crowns, transform)
+    inv = ~transform
+    pixel = np.array([
+        affine_transform(geom, [inv.a, inv.b, inv.d, inv.e, inv.c - x, inv.f - y])
+        for geom, x, y in zip(crowns.geometry, cx, cy)
+    ])
+    shapely.prepare(pixel)
+    extent = np.abs(shapely.bounds(pixel)).max()
+    return pixel, int(np.ceil(extent)) + 1
+
+
+def scene_scores(src, crowns, offset, radius, shapes=None):
+    """
+    Mean NDVI of every crown's window in one scene (an open NDVI raster or
+    NDVIReader), as extract_score computes it per crown: one read of the
+    block covering all windows, and the windows gathered with fancy
+    indexing. Returns (scores, pixels);
+    crowns whose window starts outside the scene or holds no data are NaN.
+    With `shapes` (crown_pixel_shapes on this scene's grid) only the pixels
+    of the window whose centre lies inside the shifted crown polygon count,
+    as rasterize would select them.
+    """
+    size = 2 * radius + 1
+    n = len(crowns)
+    scores = np.full(n, np.nan)
+    pixels = np.zeros(n, dtype=np.int32)
+
+    cy, cx = centroid_pixels(crowns, src.transform)
+    ry = cy - offset[1] - radius
+    rx = cx - offset[0] - radius
+    row = np.round(ry).astype(np.int64)
+    col = np.round(rx).astype(np.int64)
+    valid = (row >= 0) & (col >= 0) & (row < src.height) & (col < src.width)
+    if not valid.any():
+        return scores, pixels
+
+    r0, c0 = int(row[valid].min()), int(col[valid].min())
+    r1 = min(int(row[valid].max()) + size, src.height)
+    c1 = min(int(col[valid].max()) + size, src.width)
+    data = read_ndvi(src, window=Window(c0, r0, c1 - c0, r1 - r0))
+
+    # Pad by a window so edge windows read NaN where extract_score's slice is cropped
+    block = np.full((data.shape[0] + size, data.shape[1] + size), np.nan)
+    block[:data.shape[0], :data.shape[1]] = data
+    block[block == 0] = np.nan
+
+    # Window pixels to gather; with polygons only those the crowns can reach
+    span = np.arange(size)
+    if shapes is not None:
+        shapes, extent = shapes
+        span = span[np.abs(span - radius) <= extent]
+
+    idx = np.flatnonzero(valid)
+    for start in range(0, len(idx), CROWN_BATCH):
+        batch = idx[start:start + CROWN_BATCH]
+        rows = (row[batch] - r0)[:, None] + span
+        cols = (col[batch] - c0)[:, None] + span
+        windows = block[rows[:, :, None], cols[:, None, :]]
+
+        inside = np.isfinite(windows)
+        if shapes is not None:
+            # Pixel centres relative to the shifted centroid
+            ys = span + 0.5 - radius - (ry[batch] - row[batch])[:, None]
+            xs = span + 0.5 - radius - (rx[batch] - col[batch])[:, None]
+            inside &= shapely.contains_xy(
+                shapes[batch][:, None, None], xs[:, None, :], ys[:, :, None])
+
+        count = inside.sum(axis=(1, 2))
+        total = np.where(inside, windows, 0).sum(axis=(1, 2))
+        pixels[batch] = count
+        scores[batch] = np.where(count > 0, total / np.maximum(count, 1), np.nan)
+
+    return scores, pixels
+
+
+def score_all_crowns(imagedir, crowns, keys, offsets, radius, polygon_mask=False, coefficients=None):
+    """
+    (tag, date) Dataset of the NDVI score of every crown in every scene:
+    ndvi, pixels (pixels averaged), and per-scene key and offset_x/_y.
+    With a CoefficientCache, NDVI is computed on read from the AnalyticMS
+    scenes instead of read from their NDVI rasters. Scenes without that
+    file, or without its metadata, are left out.
+    """
+    scenes = []
+    shape_cache = {}
+    for key, offset in tqdm(list(zip(keys, offsets)), 'Scoring scenes'):
+        imagefile = (ndvi_path if coefficients is None else scene_path)(imagedir, key)
+        if imagefile is None or not os.path.exists(imagefile):
+            continue
+
+        if coefficients is None:
+            src = rasterio.open(imagefile)
+        else:
+            try:
+                src = open_ndvi(imagefile, cache=coefficients)
+            except (FileNotFoundError, ValueError) as e:
+                tqdm.write(f'Skipping {key}: {e}')
+                continue
+        with src:
+            shapes = None
+            if polygon_mask:
+                transform = src.transform
+                grid = (transform.a, transform.b, transform.d, transform.e)
+                if grid not in shape_cache:
+                    shape_cache[grid] = crown_pixel_shapes(crowns, transform)
+                shapes = shape_cache[grid]
+
+            scores, pixels = scene_scores(src, crowns, offset, radius, shapes)
+        scenes.append((planet_datetime(key), key, offset, scores, pixels))
+
+    if not scenes:
+        source = 'NDVI raster' if coefficients is None else 'AnalyticMS scene with metadata'
+        raise FileNotFoundError(f'No {source} of the {len(keys)} registered scenes in {imagedir}')
+
+    scenes.sort(key=lambda s: s[0])
+    tags = crowns['tag'].astype(str).to_numpy(dtype=str)
+    if all(t.isdigit() for t in tags):
+        tags = tags.astype(int)
+
+    ds = xr.Dataset(
+        data_vars={
+            'ndvi': (('tag', 'date'), np.stack([s[3] for s in scenes], axis=1)),
+            'pixels': (('tag', 'date'), np.stack([s[4] for s in scenes], axis=1)),
+            'key': ('date', np.array([s[1] for s in scenes], dtype=str)),
+            'offset_x': ('date', np.array([s[2][0] for s in scenes], dtype=np.float64)),
+            'offset_y': ('date', np.array([s[2][1] for s in scenes], dtype=np.float64)),
+        },
+        coords={
+            'tag': tags,
+            'date': np.array([s[0] for s in scenes], dtype='datetime64[ns]'),
+        },
+    )
+    ds.attrs['radius'] = radius
+    ds.attrs['polygon_mask'] = int(polygon_mask)
+    if 'latin' in crowns:
+        ds['species'] = ('tag', crowns['latin'].astype(str).to_numpy(dtype=str))
+    return ds
+
+
 @click.command()
 @click.argument('droneregistration')
 @click.argument('globalregistration')
@@ -60,36 +226,56 @@ def extract_score(imagedir, key, poly, offset, radius):
 @click.argument('crownid')
 @click.argument('outputfile')
 @click.option('-r', '--radius', type=int, default=25)
-def main(droneregistration, globalregistration, shapefile, imagedir, crownid, outputfile, radius):
-
+@click.option('--polygon-mask', is_flag=True,
+              help="With CROWNID 'all': average only the pixels inside each crown polygon.")
+@click.option('--coefficients', default=None, type=click.Path(),
+              help="With CROWNID 'all': compute NDVI on read from the AnalyticMS scenes, with the "
+                   "reflectance coefficient table of calc_all_ndvi.py (extended in place).")
+@click.option('--crown-index', default=None, type=click.Path(exists=True),
+              help='Parquet crown index (crown_index.py) with precomputed crown centroids.')
+@click.option('--datacube', default=None, type=click.Path(exists=True),
+              help='Read the windows from a crown_datacube.py --ndvi store instead of the scenes in IMAGEDIR.')
+def main(droneregistration, globalregistration, shapefile, imagedir, crownid, outputfile, radius, polygon_mask,
+         coefficients, crown_index, datacube):
+    """
+    NDVI scores of crown CROWNID in every scene, as JSON. CROWNID 'all'
+    scores every crown in one pass over the scenes and writes a (tag, date)
+    NetCDF to OUTPUTFILE.
+    """
     crowns = gpd.read_file(shapefile)
 
+    if crownid == 'all':
+        if datacube is not None:
+            raise click.UsageError("CROWNID 'all' reads the scenes in IMAGEDIR, not --datacube")
+        crowns = crowns.dropna(subset=['geometry']).drop_duplicates('tag').sort_values('tag')
+        keys, offsets = scene_offsets(droneregistration, globalregistration)
+        cache = CoefficientCache(coefficients) if coefficients else None
+        ds = score_all_crowns(imagedir, crowns, keys, offsets, radius, polygon_mask, cache)
+        if cache is not None:
+            cache.save()
+        print(f'{ds.sizes["tag"]} crowns x {ds.sizes["date"]} scenes -> {outputfile}')
+        ds.to_netcdf(outputfile, format='NETCDF4')
+        return
+
     focal_crown = crowns.loc[crowns['tag'] == crownid]
     if len(focal_crown) != 1:
         raise ValueError(f'{len(focal_crown)} crowns found with id {crownid}')
 
     poly = focal_crown['geometry']
-
-    keys, offsets = load_offsets(globalregistration)
-
-    with open(droneregistration, 'r') as f:
-        drone = json.load(f)
-
-    offsets = normalize(keys, offsets, drone['planet_map'])
-    drone_offset = np.array([
-        drone['coreg_info']['corrected_shifts_px']['x'],
-        drone['coreg_info']['corrected_shifts_px']['y'],
-    ])
+    index = CrownIndex(crown_index) if crown_index else None
 
     scores = {}
-    for key, offset in tqdm(list(zip(keys, offsets))):
-        total_offset = offset + drone_offset
-        try:
-            score = extract_score(imagedir, key, poly, total_offset, radius)
-            if score is None: continue
-            scores[key] = score
-        except ValueError:
-            continue
+    if datacube is not None:
+        scores = datacube_scores(open_datacube(datacube), crownid)
+    else:
+        keys, offsets = scene_offsets(droneregistration, globalregistration)
+        for key, total_offset in tqdm(list(zip(keys, offsets))):
+            try:
+                score = extract_score(imagedir, key, poly, total_offset, radius, index=index, tag=crownid)
+                if score is None: continue
+                scores[key] = score
+            except ValueError:
+                continue
 
     with open(outputfile, 'w') as f:
         json.dump(scores, f, indent=2)
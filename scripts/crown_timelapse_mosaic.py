@@ -3,14 +3,14 @@ import os
 import re
 import math
 import click
-import numpy as np
 import xarray as xr
 import rasterio
 from shapely.geometry import Polygon, MultiPolygon
 from tqdm import tqdm
 import geopandas as gpd
 from PIL import Image, ImageDraw, ImageFont
-from rasterio.windows import Window
+
+from crown_index import CrownIndex, extract_centered_window
 
 DATE_PATTERN = re.compile(r'_(\d{4}_\d{2}_\d{2})_')
 
@@ -31,48 +31,6 @@ def get_date(path):
     return m.group(1)
 
 
-def extract_centered_window(src, polygon, min_size=512, pixel_buffer=100):
-    minx, miny, maxx, maxy = polygon.bounds
-
-    top_row, left_col = src.index(minx, maxy)
-    bottom_row, right_col = src.index(maxx, miny)
-
-    row_min = min(top_row, bottom_row) - pixel_buffer
-    row_max = max(top_row, bottom_row) + pixel_buffer
-    col_min = min(left_col, right_col) - pixel_buffer
-    col_max = max(left_col, right_col) + pixel_buffer
-
-    height = row_max - row_min + 1
-    width = col_max - col_min + 1
-
-    if height < min_size:
-        pad = (min_size - height) // 2
-        row_min -= pad
-        row_max += (min_size - height - pad)
-
-    if width < min_size:
-        pad = (min_size - width) // 2
-        col_min -= pad
-        col_max += (min_size - width - pad)
-
-    row_min = max(row_min, 0)
-    col_min = max(col_min, 0)
-    row_max = min(row_max, src.height - 1)
-    col_max = min(col_max, src.width - 1)
-
-    window = Window(
-        col_off=col_min,
-        row_off=row_min,
-        width=col_max - col_min + 1,
-        height=row_max - row_min + 1
-    )
-
-    data = src.read(window=window)
-    img = Image.fromarray(np.transpose(data, (1, 2, 0))[..., :3])
-
-    return window, img
-
-
 def draw_polygon_on_image(img, src, window, polygon,
                           outline=(255, 255, 0),
                           width=3):
@@ -188,7 +146,9 @@ def make_grid(images, ncols):
 @click.argument('tag')
 @click.argument('output')
 @click.option('--ncols', default=10, show_default=True)
-def main(crownfile, classification_nc, image_files, tag, output, ncols):
+@click.option('--crown-index', default=None, type=click.Path(exists=True),
+              help='Parquet crown index (crown_index.py) with precomputed crown windows.')
+def main(crownfile, classification_nc, image_files, tag, output, ncols, crown_index):
 
     crowns = gpd.read_file(crownfile)
     crowns = crowns[crowns["tag"] == tag]
@@ -199,23 +159,25 @@ def main(crownfile, classification_nc, image_files, tag, output, ncols):
     species = crowns.iloc[0].get("latin", "unknown")
 
     ds = xr.open_dataset(classification_nc)
+    index = CrownIndex(crown_index) if crown_index else None
 
     images = []
 
     for img_path in tqdm(sorted(image_files)):
-        date = get_date(img_path)
+        date_token = get_date(img_path)
 
-        row = crowns[crowns["date"] == date]
+        row = crowns[crowns["date"] == date_token]
         if row.empty:
             continue
 
-        date = date.replace('_', '-')
+        date = date_token.replace('_', '-')
 
         delicious = float(ds["deciduous_probability"].sel(tag=float(tag), date=date))
         flowering = float(ds["flowering_probability"].sel(tag=float(tag), date=date))
 
         with rasterio.open(img_path) as src:
-            window, img = extract_centered_window(src, row.geometry.values[0])
+            crown = index.get(src, tag, date_token) if index else None
+            window, img = extract_centered_window(src, row.geometry.values[0], crown=crown)
 
         img = draw_polygon_on_image(
             img,
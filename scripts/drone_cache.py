@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""Drone orthomosaics resampled once to Planet-scale resolutions.
+
+apply_drone_labels_coreg.py pairs every drone flight with all Planet scenes
+in its time window. Each pairing used to read the full centimetre-scale
+orthomosaic twice: once for coregistration and once for the drone QA PNG.
+This cache keeps, per drone mosaic, CRS and resolution, a pixel-averaged
+copy of its RGB bands as a tiled GeoTIFF:
+
+    <cachedir>/<drone stem>_<epsg>_<res>m.tif
+
+The grid is anchored to the mosaic's own footprint, so one file serves every
+Planet scene at that resolution (3 m for coregistration, Planet res /
+--drone-scale for the QA PNGs); each scene reprojects the small cached raster
+onto its own grid. A cached file records the size and mtime of its source
+mosaic and is rebuilt when they change.
+"""
+import os
+from pathlib import Path
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import calculate_default_transform
+
+CACHE_BANDS = 3
+BLOCK_SIZE = 512
+
+
+def _source_tags(dronefile):
+    st = os.stat(dronefile)
+    return {'source_size': str(st.st_size), 'source_mtime_ns': str(st.st_mtime_ns)}
+
+
+def _crs_label(crs):
+    epsg = crs.to_epsg()
+    return str(epsg) if epsg is not None else 'custom'
+
+
+def resample_mosaic(dronefile, outputfile, crs, res):
+    """Pixel-average the first CACHE_BANDS bands of `dronefile` onto a `res`
+    grid in `crs`, written block by block to a tiled GeoTIFF."""
+    outputfile = Path(outputfile)
+    with rasterio.open(dronefile) as src:
+        transform, width, height = calculate_default_transform(
+            src.crs, crs, src.width, src.height, *src.bounds, resolution=res)
+        count = min(CACHE_BANDS, src.count)
+        profile = {
+            'driver': 'GTiff', 'dtype': src.dtypes[0], 'count': count,
+            'width': width, 'height': height, 'crs': crs,
+            'transform': transform,
+            # Pixels outside the flight come out as 0 when the mosaic has
+            # an alpha band instead of a nodata value.
+            'nodata': src.nodata if src.nodata is not None else 0,
+            'tiled': True,
+            'blockxsize': BLOCK_SIZE, 'blockysize': BLOCK_SIZE,
+            'compress': 'deflate',
+        }
+        # The warped VRT honours the mosaic's nodata / alpha band, so pixels
+        # outside the flight do not bleed into the averages.
+        with WarpedVRT(src, crs=crs, transform=transform, width=width,
+                       height=height, resampling=Resampling.average) as vrt:
+            tmp = outputfile.with_name(f'{outputfile.name}.{os.getpid()}.tmp')
+            with rasterio.open(tmp, 'w', **profile) as dst:
+                dst.update_tags(**_source_tags(dronefile))
+                for _, window in dst.block_windows(1):
+                    dst.write(vrt.read(list(range(1, count + 1)), window=window),
+                              window=window)
+            os.replace(tmp, outputfile)
+    return outputfile
+
+
+class DroneMosaicCache:
+    """Resampled drone mosaics under `cachedir`, built on first use."""
+
+    def __init__(self, cachedir):
+        self.cachedir = Path(cachedir)
+        self.hits = self.misses = 0
+
+    def path(self, dronefile, crs, res):
+        # Planet res / drone_scale comes out of float division
+        res = float(np.round(res, 6))
+        return self.cachedir / (
+            f'{Path(dronefile).stem}_{_crs_label(crs)}_{res:g}m.tif')
+
+    def _is_current(self, cached, dronefile):
+        if not cached.exists():
+            return False
+        try:
+            with rasterio.open(cached) as src:
+                tags = src.tags()
+        except rasterio.errors.RasterioError:
+            return False
+        expected = _source_tags(dronefile)
+        return all(tags.get(k) == v for k, v in expected.items())
+
+    def get(self, dronefile, crs, res):
+        """Path of `dronefile` resampled to `res` in `crs`, building it if
+        missing or stale."""
+        cached = self.path(dronefile, crs, res)
+        if self._is_current(cached, dronefile):
+            self.hits += 1
+            return cached
+        self.misses += 1
+        self.cachedir.mkdir(parents=True, exist_ok=True)
+        return resample_mosaic(dronefile, cached, crs, res)
@@ -2,6 +2,7 @@ import json
 import click
 
 from arosics import COREG
+from phase_coreg import phase_coreg_info
 from planet_coreg import stem
 
 
@@ -9,15 +10,26 @@ from planet_coreg import stem
 @click.argument('dronefile')
 @click.argument('planetfile')
 @click.argument('outputfile')
-def main(dronefile, planetfile, outputfile):
-
-    coreg = COREG(
-        dronefile, planetfile, ws=(200, 200),
-        align_grids=True, max_shift=10,
-        ignore_errors=True, q=True,
-    )
-    coreg.calculate_spatial_shifts()
-    result = coreg.coreg_info
+@click.option('--arosics-only', is_flag=True,
+              help='Skip the phase-correlation fast path.')
+def main(dronefile, planetfile, outputfile, arosics_only):
+
+    result = None
+    if not arosics_only:
+        # Unconfident or failed fast path -> AROSICS
+        try:
+            result = phase_coreg_info(dronefile, planetfile,
+                                      ws=(200, 200), max_shift=10)
+        except Exception as e:
+            print(f'Phase correlation failed ({e}); running AROSICS')
+    if result is None:
+        coreg = COREG(
+            dronefile, planetfile, ws=(200, 200),
+            align_grids=True, max_shift=10,
+            ignore_errors=True, q=True,
+        )
+        coreg.calculate_spatial_shifts()
+        result = dict(coreg.coreg_info, method='arosics')
 
     output = {
         'coreg_info': result,
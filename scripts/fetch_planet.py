@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 import csv
+import json
+import os
 import yaml
 import click
 import asyncio
@@ -13,6 +15,11 @@ from planet import (
 
 PLANET_ORDER_LIMIT = 100
 
+# Final states; orders that ended in RESUBMIT_STATES are placed again on
+# the next run, the others are only downloaded.
+DOWNLOAD_STATES = ('success', 'partial')
+RESUBMIT_STATES = ('failed', 'cancelled')
+
 
 async def search(auth, config, year, month):
 
@@ -60,7 +67,7 @@ def read_missing_ids(csv_path):
         return [row[0] for row in reader if row and row[0]]
 
 
-async def submit_order(auth, config, items, order_name, outputdir):
+def build_order(config, items, order_name):
 
     item_type = config['item_type']
     product_bundle = config['product_bundle']
@@ -74,10 +81,15 @@ async def submit_order(auth, config, items, order_name, outputdir):
         item_type=item_type
     )]
 
-    request = order_request.build_request(
+    return order_request.build_request(
         name=order_name, products=products, tools=tools
     )
 
+
+async def submit_order(auth, config, items, order_name, outputdir):
+
+    request = build_order(config, items, order_name)
+
     async with Session(auth=auth) as sess:
         client = sess.client('orders')
 
@@ -114,7 +126,9 @@ async def fetch(auth, config, year, month, outputdir):
     await submit_order(auth, config, items, order_name, outputdir)
 
 
-async def fetch_missing(auth, config, ids, order_name_prefix, outputdir):
+def order_chunks(ids, order_name_prefix):
+    """Split `ids` into (order_name, items) pairs of at most
+    PLANET_ORDER_LIMIT items."""
 
     if len(ids) == 0:
         raise ValueError('No items to fetch!')
@@ -124,11 +138,19 @@ async def fetch_missing(auth, config, ids, order_name_prefix, outputdir):
         for i in range(0, len(ids), PLANET_ORDER_LIMIT)
     ]
 
-    for i, chunk in enumerate(chunks):
-        if len(chunks) == 1:
-            order_name = order_name_prefix
-        else:
-            order_name = f'{order_name_prefix}_{i + 1:02d}'
+    if len(chunks) == 1:
+        return [(order_name_prefix, chunks[0])]
+    return [
+        (f'{order_name_prefix}_{i + 1:02d}', chunk)
+        for i, chunk in enumerate(chunks)
+    ]
+
+
+async def fetch_missing(auth, config, ids, order_name_prefix, outputdir):
+
+    chunks = order_chunks(ids, order_name_prefix)
+
+    for i, (order_name, chunk) in enumerate(chunks):
         click.echo(
             f'Submitting order {order_name} '
             f'({len(chunk)} items, {i + 1}/{len(chunks)})'
@@ -136,6 +158,159 @@ async def fetch_missing(auth, config, ids, order_name_prefix, outputdir):
         await submit_order(auth, config, chunk, order_name, outputdir)
 
 
+class OrderStateFile:
+    """JSON record of a concurrent fetch, so an interrupted run resumes
+    without resubmitting (and paying for) orders that already exist.
+
+    One entry per order name:
+        items       scene IDs in the order
+        order_id    Planet order ID once created
+        state       last Orders API state ('pending' before submission)
+        downloaded  asset names (relative to outputdir) already on disk
+        complete    True once every asset of the order is downloaded
+        error       last error message, if the order failed locally
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.orders = {}
+        if self.path.exists():
+            with open(self.path, 'r') as f:
+                self.orders = json.load(f)['orders']
+
+    def entry(self, order_name, items):
+        entry = self.orders.get(order_name)
+        if entry is not None and entry['items'] != list(items):
+            raise click.ClickException(
+                f'{self.path} records different items for order '
+                f'{order_name}; use a new --order-name or --state-file.'
+            )
+        if entry is None or entry['state'] in RESUBMIT_STATES:
+            entry = {'items': list(items), 'order_id': None,
+                     'state': 'pending', 'downloaded': [], 'complete': False,
+                     'error': None}
+            self.orders[order_name] = entry
+        return entry
+
+    def save(self):
+        # Write-then-rename so a crash never leaves a truncated state file
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'orders': self.orders}, f, indent=2)
+        os.replace(tmp, self.path)
+
+
+async def run_order(client, config, order_name, entry, state_file, outputdir,
+                    download_limit, poll_delay):
+    """Submit (unless already submitted), wait for and download one order.
+
+    Assets are downloaded individually under the shared `download_limit`
+    semaphore, so downloads from different orders run in parallel.
+    """
+    if entry['order_id'] is None:
+        order = await client.create_order(
+            build_order(config, entry['items'], order_name))
+        entry['order_id'] = order['id']
+        entry['state'] = order['state']
+        state_file.save()
+        click.echo(f'{order_name}: created {order["id"]} '
+                   f'({len(entry["items"])} items)')
+
+    def report(state):
+        if state != entry['state']:
+            entry['state'] = state
+            state_file.save()
+            click.echo(f'{order_name}: {state}')
+
+    await client.wait(entry['order_id'], delay=poll_delay, max_attempts=0,
+                      callback=report)
+    if entry['state'] not in DOWNLOAD_STATES:
+        return
+
+    order = await client.get_order(entry['order_id'])
+    done = set(entry['downloaded'])
+    results = [
+        r for r in order['_links'].get('results') or []
+        if r and r['name'] not in done
+    ]
+
+    async def download(result):
+        name = Path(result['name'])
+        async with download_limit:
+            await client.download_asset(
+                result['location'], filename=name.name,
+                directory=outputdir / name.parent, overwrite=True,
+                progress_bar=False,
+            )
+        entry['downloaded'].append(result['name'])
+        state_file.save()
+
+    await asyncio.gather(*(download(r) for r in results))
+    entry['complete'] = True
+    state_file.save()
+    click.echo(f'{order_name}: downloaded {len(entry["downloaded"])} assets')
+
+
+async def fetch_missing_concurrent(client, config, ids, order_name_prefix,
+                                   outputdir, state_path, max_downloads=4,
+                                   poll_delay=30):
+    """Concurrent counterpart of fetch_missing.
+
+    All chunks are submitted up front, polled concurrently, and completed
+    orders are downloaded in parallel with at most `max_downloads` assets in
+    flight. Progress is kept in `state_path` (see OrderStateFile); rerunning
+    the same command resumes from it. `client` is an Orders API client, so a
+    fake can be passed for testing. Returns {order_name: error} for orders
+    that did not finish.
+    """
+    state_file = OrderStateFile(state_path)
+    chunks = order_chunks(ids, order_name_prefix)
+    entries = {name: state_file.entry(name, items) for name, items in chunks}
+    state_file.save()
+
+    pending = {
+        name: entry for name, entry in entries.items()
+        if not entry['complete']
+    }
+    click.echo(f'{len(entries) - len(pending)} of {len(entries)} orders '
+               f'already downloaded; running {len(pending)}')
+
+    download_limit = asyncio.Semaphore(max_downloads)
+    names = list(pending)
+    outcomes = await asyncio.gather(
+        *(run_order(client, config, name, pending[name], state_file,
+                    outputdir, download_limit, poll_delay)
+          for name in names),
+        return_exceptions=True,
+    )
+
+    errors = {}
+    for name, outcome in zip(names, outcomes):
+        entry = pending[name]
+        if isinstance(outcome, Exception):
+            entry['error'] = f'{type(outcome).__name__}: {outcome}'
+        elif entry['state'] not in DOWNLOAD_STATES:
+            entry['error'] = f'order ended {entry["state"]}'
+        else:
+            entry['error'] = None
+            continue
+        errors[name] = entry['error']
+    state_file.save()
+    return errors
+
+
+async def fetch_missing_pipeline(auth, config, ids, order_name_prefix,
+                                 outputdir, state_path, max_downloads,
+                                 poll_delay, orders_url=None):
+
+    async with Session(auth=auth) as sess:
+        client = sess.client('orders', base_url=orders_url)
+        return await fetch_missing_concurrent(
+            client, config, ids, order_name_prefix, outputdir, state_path,
+            max_downloads=max_downloads, poll_delay=poll_delay,
+        )
+
+
 @click.command()
 @click.argument('configfile', type=click.Path(
     path_type=Path, exists=True
@@ -151,7 +326,21 @@ async def fetch_missing(auth, config, ids, order_name_prefix, outputdir):
 @click.option('--order-name', type=str, default=None,
               help='Order name (or prefix when batched). '
                    'Required with --missing-csv.')
-def main(configfile, outputdir, year, month, missing_csv, order_name):
+@click.option('--concurrent', is_flag=True,
+              help='With --missing-csv: submit all orders up front, poll them '
+                   'concurrently and download in parallel, resumably.')
+@click.option('--max-downloads', type=click.IntRange(min=1), default=4,
+              show_default=True, help='Assets downloaded at once (--concurrent).')
+@click.option('--poll-delay', type=click.IntRange(min=1), default=30,
+              show_default=True,
+              help='Seconds between status polls per order (--concurrent).')
+@click.option('--state-file', type=click.Path(path_type=Path), default=None,
+              help='Resume state for --concurrent '
+                   '[default: OUTPUTDIR/<order-name>.orders.json].')
+@click.option('--orders-url', type=str, default=None,
+              help='Orders API base URL, e.g. a local fake for testing.')
+def main(configfile, outputdir, year, month, missing_csv, order_name,
+         concurrent, max_downloads, poll_delay, state_file, orders_url):
 
     with open(configfile, 'r') as f:
         config = yaml.safe_load(f)
@@ -164,7 +353,22 @@ def main(configfile, outputdir, year, month, missing_csv, order_name):
                 '--order-name is required when --missing-csv is given.'
             )
         ids = read_missing_ids(missing_csv)
-        asyncio.run(fetch_missing(auth, config, ids, order_name, outputdir))
+        if concurrent:
+            if state_file is None:
+                state_file = outputdir / f'{order_name}.orders.json'
+            errors = asyncio.run(fetch_missing_pipeline(
+                auth, config, ids, order_name, outputdir, state_file,
+                max_downloads, poll_delay, orders_url,
+            ))
+            for name, error in errors.items():
+                click.echo(f'{name}: {error}', err=True)
+            if errors:
+                raise click.ClickException(
+                    f'{len(errors)} orders did not complete; '
+                    f'rerun to resume from {state_file}'
+                )
+        else:
+            asyncio.run(fetch_missing(auth, config, ids, order_name, outputdir))
     else:
         if year is None or month is None:
             raise click.UsageError(
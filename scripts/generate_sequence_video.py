@@ -10,6 +10,8 @@ from PIL import Image, ImageDraw
 from tempfile import TemporaryDirectory
 from werkzeug.security import safe_join
 
+from crown_datacube import chip_subframe, crown_chips, open_datacube, scale_subframe
+
 
 def parse_info(filename):
     base = os.path.basename(filename)
@@ -109,16 +111,50 @@ def generate_video(images, config, outputfile, info_parser=parse_info):
         shutil.move(tmpmov, outputfile)
 
 
+def write_datacube_frames(store, sequence_id, outputdir):
+    """
+    Save the chips of one crown in a crown_datacube.py store as PNG frames
+    named like the sequence images (genus_species_id_YYYY_MM_DD.png), so
+    parse_info reads them. Scenes from the same day share a frame.
+    """
+    seq = crown_chips(open_datacube(store), sequence_id).load()
+    latin = str(seq['latin'].values) if 'latin' in seq else ''
+    genus, species = (latin.split() + ['unknown', 'unknown'])[:2]
+
+    images = {}
+    for t in range(seq.sizes['time']):
+        frame = seq.isel(time=t)
+        chip = chip_subframe(frame)
+        if chip is None:
+            continue
+        chip = scale_subframe(chip)
+        if chip is None:
+            continue
+        date = datetime.fromisoformat(str(frame['time'].values)[:10])
+        name = f'{genus}_{species}_{sequence_id}_{date:%Y_%m_%d}.png'
+        Image.fromarray(chip).save(safe_join(outputdir, name))
+        images[name] = safe_join(outputdir, name)
+    return list(images.values())
+
+
 @click.command()
 @click.argument('inputdir')
 @click.argument('sequence_id', type=int)
 @click.argument('configfile')
 @click.argument('outputfile')
-def main(inputdir, sequence_id, configfile, outputfile):
+@click.option('--datacube', is_flag=True,
+              help='INPUTDIR is a crown_datacube.py store instead of a folder of sequence images.')
+def main(inputdir, sequence_id, configfile, outputfile, datacube):
 
     with open(configfile, 'r') as f:
         config = yaml.safe_load(f)
 
+    if datacube:
+        with TemporaryDirectory() as framedir:
+            images = write_datacube_frames(inputdir, sequence_id, framedir)
+            generate_video(images, config, outputfile)
+        return
+
     ext = config['input_ext']
 
     images = glob(safe_join(inputdir, f'*_{sequence_id}_*_*_*.{ext}'))
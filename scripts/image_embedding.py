@@ -6,6 +6,7 @@ import os
 os.environ.setdefault("PYTORCH_ENABLE_MPS_FALLBACK", "1")  # must precede torch import
 import click
 import torch
+import numpy as np
 import torchvision.transforms as T
 from PIL import Image
 import os
@@ -13,6 +14,7 @@ import json
 from tqdm import tqdm
 from glob import glob
 
+from crown_datacube import chip_subframe, crown_chips, open_datacube
 from util import select_device
 
 
@@ -20,7 +22,13 @@ def load_image(img_path: str) -> torch.Tensor:
     """
     Load an image and return a tensor that can be used as an input to DINOv2.
     """
-    img = Image.open(img_path).convert('RGB')
+    return image_tensor(Image.open(img_path).convert('RGB'))
+
+
+def image_tensor(img: Image.Image) -> torch.Tensor:
+    """
+    Turn an RGB image into a tensor that can be used as an input to DINOv2.
+    """
 
     # Define the transformation
     transform_image = T.Compose([
@@ -40,13 +48,38 @@ def compute_embeddings(model, device, input_dir, output_file) -> dict:
 
     files = glob(os.path.join(input_dir, '*.tif'))
 
+    images = (
+        (os.path.splitext(os.path.basename(img_path))[0], load_image(img_path))
+        for img_path in files
+    )
+    return embed_images(model, device, images, output_file, len(files))
+
+
+def compute_datacube_embeddings(model, device, ds, tag_id, output_file) -> dict:
+    """
+    Same as compute_embeddings, for the chips of one crown in a
+    crown_datacube.py store, keyed by scene key.
+    """
+    seq = crown_chips(ds, tag_id).load()
+
+    def images():
+        for t in range(seq.sizes['time']):
+            frame = seq.isel(time=t)
+            chip = chip_subframe(frame)
+            if chip is None:
+                continue
+            img = Image.fromarray(chip[..., :3].astype(np.uint8)).convert('RGB')
+            yield str(frame['key'].values), image_tensor(img)
+
+    return embed_images(model, device, images(), output_file, int(seq['valid'].sum()))
+
+
+def embed_images(model, device, images, output_file, total=None) -> dict:
     all_embeddings = {}
-    
+
     with torch.no_grad():
-        for img_path in tqdm(files, desc="Processing files"):
-            image_id = os.path.splitext(os.path.basename(img_path))[0]
-            img_tensor = load_image(img_path).to(device)
-            embeddings = model(img_tensor)
+        for image_id, img_tensor in tqdm(images, desc="Processing files", total=total):
+            embeddings = model(img_tensor.to(device))
             all_embeddings[image_id] = embeddings[0].cpu().numpy().tolist()
 
     with open(output_file, "w") as f:
@@ -58,15 +91,25 @@ def compute_embeddings(model, device, input_dir, output_file) -> dict:
 @click.command()
 @click.argument('crown_folder')
 @click.argument('output_folder')
-def main(crown_folder, output_folder):
-
-    subdirs = glob(os.path.join(crown_folder, '*'))
+@click.option('--datacube', is_flag=True,
+              help='CROWN_FOLDER is a crown_datacube.py store instead of per-tag chip folders.')
+def main(crown_folder, output_folder, datacube):
 
     # Load the model
     dinov2_vits14 = torch.hub.load("facebookresearch/dinov2", "dinov2_vits14")
     device = select_device()
     dinov2_vits14.to(device)
 
+    if datacube:
+        ds = open_datacube(crown_folder)
+        for tag_id in tqdm(ds['tag'].values, 'Extracting Features'):
+            output_file = os.path.join(output_folder, f'{tag_id}.json')
+            if os.path.exists(output_file): continue
+            compute_datacube_embeddings(dinov2_vits14, device, ds, tag_id, output_file)
+        return
+
+    subdirs = glob(os.path.join(crown_folder, '*'))
+
     for subdir in tqdm(subdirs, 'Extracting Features'):
         tag_id = os.path.basename(subdir)
         output_file = os.path.join(output_folder, f'{tag_id}.json')
@@ -1,12 +1,18 @@
 #!/usr/bin/env python
 import os
+import tempfile
+from functools import lru_cache
 import click
-import rioxarray
 import numpy as np
-import xarray as xr
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.warp import reproject, transform_bounds
+from rasterio.windows import Window, from_bounds
 from tqdm import tqdm
 from glob import glob
 
+BLOCK_SIZE = 512
+
 
 def gaussian_weight_mask(height, width, sigma):
     """
@@ -42,71 +48,163 @@ def gaussian_weight_mask(height, width, sigma):
     return weights.astype(np.float32)
 
 
-def mosaic_average_rioxarray(original_path, tile_paths, output_path, dtype=np.float32):
+def tile_offset(tile_transform, transform, tol=1e-3):
     """
-    Mosaic thousands of tiles by streaming them one-by-one and averaging overlapping pixels.
-    
-    Each tile is aligned to the original grid using .rio.reproject_match.
+    Integer (row, col) of a tile's upper-left pixel on the `transform` grid,
+    or None if the tile is not a grid-aligned crop of that grid (different
+    pixel size or rotation, or an origin off the pixel corners by more than
+    `tol` pixels).
     """
-    
-    # 1. Open original raster to define target grid
-    original = rioxarray.open_rasterio(original_path).sel(band=[1, 2, 3])
-    original = original.rio.write_nodata(None, inplace=False)
-    original.attrs.pop("_FillValue", None)
-    bands, height, width = original.shape
-    
-    # 2. Allocate sum and count arrays
-    sum_array = np.zeros((1, height, width), dtype=np.float64)
-    count_array = np.zeros((1, height, width), dtype=np.float32)
-    
-    # 3. Process each tile one by one
-    for tile_path in tqdm(tile_paths, 'Loading'):
-        tile = rioxarray.open_rasterio(tile_path)
-        tile = tile.rio.write_nodata(None, inplace=False)
-        tile.attrs.pop("_FillValue", None)
-        
-        # Align to original raster grid
-        tile_aligned = tile.rio.reproject_match(original)
-        
-        # Convert to float32 and mask nodata
-        tile_aligned = tile_aligned.astype(np.float32).where(tile_aligned.notnull())
-        
-        # Convert to numpy for accumulation
-        tile_data = tile_aligned.data  # still a numpy array
-        
-        h, w = tile.data[0].shape
-        sigma = w / 4.
-        weights = gaussian_weight_mask(h, w, sigma)
-        
-        # Mask of valid (non-NaN) pixels
-        valid = ~np.isnan(tile_data)
-        
-        # Accumulate
-        sum_array[valid] += tile_data[valid] * weights.ravel()
-        count_array[valid] += weights.ravel()
-    
-    # 4. Compute final average
-    avg_array = np.zeros_like(sum_array, dtype=dtype)
-    nonzero = count_array > 0
-    avg_array[nonzero] = (sum_array[nonzero] / count_array[nonzero]).astype(dtype)
-    avg_array[~nonzero] = np.nan  # or 0 if you prefer
-    
-    # 5. Save result as GeoTIFF
-    avg_da = xr.DataArray(
-        avg_array,
-        dims=original.dims,
-        coords={"y": original.y, "x": original.x, "band": [1]},
-        attrs=original.attrs
-    )
-    avg_da.rio.write_crs(original.rio.crs, inplace=True)
-    avg_da.rio.to_raster(output_path, dtype=dtype)
+    if not np.allclose([tile_transform.a, tile_transform.b, tile_transform.d, tile_transform.e],
+                       [transform.a, transform.b, transform.d, transform.e],
+                       rtol=1e-6, atol=0):
+        return None
+    col, row = ~transform * (tile_transform.c, tile_transform.f)
+    row_i, col_i = int(round(row)), int(round(col))
+    if abs(row - row_i) > tol or abs(col - col_i) > tol:
+        return None
+    return row_i, col_i
+
+
+class TiledAccumulator:
+    """
+    Weighted sum and total weight of a (height, width) raster, held in two
+    float32 memmaps laid out as block x block tiles. A classification tile
+    then touches a few contiguous blocks instead of one strip per row of the
+    full orthomosaic, and the page cache only needs the blocks in use.
+    """
+
+    def __init__(self, height, width, tmpdir, block=BLOCK_SIZE):
+        self.height, self.width, self.block = height, width, block
+        self.nby = -(-height // block)
+        self.nbx = -(-width // block)
+        shape = (self.nby, self.nbx, block, block)
+        self.sum = np.memmap(os.path.join(tmpdir, 'sum.f32'), dtype=np.float32,
+                             mode='w+', shape=shape)
+        self.weight = np.memmap(os.path.join(tmpdir, 'weight.f32'), dtype=np.float32,
+                                mode='w+', shape=shape)
+
+    def add(self, row_off, col_off, values, weights):
+        """
+        Accumulate `values * weights` and `weights` over the window at
+        (row_off, col_off). NaN values get no weight; parts of the window
+        outside the raster are dropped.
+        """
+        h, w = values.shape
+        r0, c0 = max(row_off, 0), max(col_off, 0)
+        r1, c1 = min(row_off + h, self.height), min(col_off + w, self.width)
+        if r0 >= r1 or c0 >= c1:
+            return
+        values = values[r0 - row_off:r1 - row_off, c0 - col_off:c1 - col_off]
+        weights = weights[r0 - row_off:r1 - row_off, c0 - col_off:c1 - col_off]
+        valid = ~np.isnan(values)
+        weights = np.where(valid, weights, 0).astype(np.float32)
+        weighted = np.where(valid, values * weights, 0).astype(np.float32)
+
+        b = self.block
+        for by in range(r0 // b, (r1 - 1) // b + 1):
+            y0, y1 = max(r0, by * b), min(r1, (by + 1) * b)
+            for bx in range(c0 // b, (c1 - 1) // b + 1):
+                x0, x1 = max(c0, bx * b), min(c1, (bx + 1) * b)
+                src = (slice(y0 - r0, y1 - r0), slice(x0 - c0, x1 - c0))
+                dst = (by, bx, slice(y0 - by * b, y1 - by * b), slice(x0 - bx * b, x1 - bx * b))
+                self.sum[dst] += weighted[src]
+                self.weight[dst] += weights[src]
+
+    def blocks(self, dtype=np.float32):
+        """
+        Yield (window, average) per block, NaN where no tile contributed.
+        """
+        b = self.block
+        for by in range(self.nby):
+            for bx in range(self.nbx):
+                h = min(b, self.height - by * b)
+                w = min(b, self.width - bx * b)
+                total = np.asarray(self.sum[by, bx, :h, :w])
+                weight = np.asarray(self.weight[by, bx, :h, :w])
+                avg = np.full((h, w), np.nan, dtype=dtype)
+                nonzero = weight > 0
+                avg[nonzero] = (total[nonzero] / weight[nonzero]).astype(dtype)
+                yield Window(bx * b, by * b, w, h), avg
+
+
+@lru_cache(maxsize=None)
+def tile_weights(height, width):
+    """
+    Gaussian weight mask of a tile shape (sigma = width / 4), computed once
+    per shape.
+    """
+    weights = gaussian_weight_mask(height, width, width / 4.)
+    weights.flags.writeable = False
+    return weights
+
+
+def _read_aligned(tile_path, transform, crs):
+    """
+    Read a classification tile as (row_off, col_off, values, weights) on the
+    `transform` grid. Grid-aligned crops are read as is; any other tile is
+    resampled (nearest) onto the grid window covering its bounds.
+    """
+    with rasterio.open(tile_path) as tile:
+        data = tile.read(1).astype(np.float32)
+        weights = tile_weights(*data.shape)
+        offset = tile_offset(tile.transform, transform) if tile.crs == crs else None
+        if offset is not None:
+            return (*offset, data, weights)
+
+        bounds = transform_bounds(tile.crs, crs, *tile.bounds) if tile.crs != crs else tile.bounds
+        window = from_bounds(*bounds, transform=transform).round_offsets().round_lengths()
+        dst_transform = rasterio.windows.transform(window, transform)
+        values = np.full((window.height, window.width), np.nan, dtype=np.float32)
+        dst_weights = np.zeros((window.height, window.width), dtype=np.float32)
+        for src, dst, nodata in ((data, values, np.nan), (weights, dst_weights, 0)):
+            reproject(src, dst, src_transform=tile.transform, src_crs=tile.crs,
+                      dst_transform=dst_transform, dst_crs=crs,
+                      src_nodata=nodata, dst_nodata=nodata,
+                      resampling=Resampling.nearest)
+        return window.row_off, window.col_off, values, dst_weights
+
+
+def mosaic_average(original_path, tile_paths, output_path, dtype=np.float32, tmpdir=None):
+    """
+    Mosaic thousands of tiles by streaming them one-by-one and taking the
+    Gaussian-weighted average of overlapping pixels.
+
+    Tiles are crops of the original grid, so each one is added at its
+    integer pixel offset and only its own window is touched. The weighted
+    sum and weight live in float32 tiled memmaps under `tmpdir` (default:
+    next to the output), so memory does not grow with the orthomosaic.
+    """
+    with rasterio.open(original_path) as original:
+        profile = {
+            'driver': 'GTiff', 'dtype': dtype, 'count': 1,
+            'width': original.width, 'height': original.height,
+            'crs': original.crs, 'transform': original.transform,
+            'tiled': True, 'blockxsize': BLOCK_SIZE, 'blockysize': BLOCK_SIZE,
+            'compress': 'deflate',
+        }
+
+    if tmpdir is None:
+        tmpdir = os.path.dirname(os.path.abspath(output_path))
+    with tempfile.TemporaryDirectory(dir=tmpdir, prefix='merge_') as scratch:
+        acc = TiledAccumulator(profile['height'], profile['width'], scratch)
+        for tile_path in tqdm(tile_paths, 'Loading'):
+            acc.add(*_read_aligned(tile_path, profile['transform'], profile['crs']))
+
+        tmp = f'{output_path}.{os.getpid()}.tmp'
+        with rasterio.open(tmp, 'w', **profile) as dst:
+            for window, avg in acc.blocks(dtype):
+                dst.write(avg, 1, window=window)
+        os.replace(tmp, output_path)
 
 
 @click.command()
 @click.argument('image_file')
 @click.argument('classifications_dir')
 @click.argument('output_file')
-def main(image_file, classifications_dir, output_file):
+@click.option('--tmpdir', default=None,
+              help='Directory for the float32 accumulation memmaps (default: next to OUTPUT_FILE).')
+def main(image_file, classifications_dir, output_file, tmpdir):
 
     if os.path.exists(output_file):
         print('Output file already exists')
@@ -117,10 +215,11 @@ def main(image_file, classifications_dir, output_file):
 
     tile_paths = sorted(glob(os.path.join(classifications_dir, "*.tif")))
 
-    mosaic_average_rioxarray(
+    mosaic_average(
         original_path=image_file,
         tile_paths=tile_paths,
         output_path=output_file,
+        tmpdir=tmpdir,
     )
 
 
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+"""Pick a small, well-connected set of Planet pairs to coregister.
+
+coreg_global.solve_offsets only needs a connected pair graph with some
+redundancy, not all n^2 pairs. The planned graph is the union of:
+
+    temporal neighbours   each image with the k images either side in time,
+                          which keeps the graph connected and captures
+                          slowly drifting offsets
+    hubs                  the clearest image (bci_clear_fraction.py CSV) in
+                          each of `--hubs` equal-count time bins, all linked
+                          to each other
+    hub spokes            every image linked to its `--hubs-per-image`
+                          nearest hubs in time, so no image is more than two
+                          pairs from any other through the hub backbone
+
+The result is written as a `reference,target` CSV that
+`planet_coreg_pairs.py --pairs-file` and `planet_coreg.py --pairs-file`
+accept.
+
+The accuracy cost is estimated from the graph alone. With unit, independent
+noise on every pair, the least-squares offsets have covariance L^+ (the
+pseudo-inverse of the graph Laplacian, zero-mean gauge). The report compares
+the per-image standard deviation of the planned graph with that of the full
+graph planet_coreg.py would compute (every ordered pair). Pair counts give
+the CPU saving directly.
+"""
+import csv
+from glob import glob
+from pathlib import Path
+
+import click
+import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import connected_components
+from werkzeug.security import safe_join
+
+from planet_coreg import stem
+from planet_coreg_pairs import acquisition_time, plan_pairs
+from util import load_config
+
+# Dense L^+ is O(n^3); above this the uncertainty report is skipped
+MAX_UNCERTAINTY_IMAGES = 6000
+
+
+def load_clear_fraction(csvfile):
+    """{image_name: fraction_clear} from a bci_clear_fraction.py CSV."""
+    with open(csvfile, newline='') as f:
+        return {
+            row['image_name']: float(row['fraction_clear'])
+            for row in csv.DictReader(f)
+        }
+
+
+def match_clear_fraction(keys, fractions):
+    """Clear fraction per key (NaN if unknown). Keys may carry a suffix
+    after the scene ID, e.g. `<scene>_rgb`."""
+    clear = np.full(len(keys), np.nan)
+    for i, key in enumerate(keys):
+        parts = key.split('_')
+        for end in range(len(parts), 0, -1):
+            name = '_'.join(parts[:end])
+            if name in fractions:
+                clear[i] = fractions[name]
+                break
+    return clear
+
+
+def _time_order(keys):
+    times = [acquisition_time(k) for k in keys]
+    if all(t is not None for t in times):
+        return sorted(range(len(keys)), key=lambda i: (times[i], keys[i]))
+    return sorted(range(len(keys)), key=lambda i: keys[i])
+
+
+def choose_hubs(keys, clear, n_hubs):
+    """Index of the clearest image in each of `n_hubs` equal-count time
+    bins. Images without a clear fraction are never hubs."""
+    order = np.array(_time_order(keys))
+    hubs = []
+    for chunk in np.array_split(order, min(n_hubs, len(order))):
+        scores = clear[chunk]
+        if len(chunk) == 0 or np.all(np.isnan(scores)):
+            continue
+        hubs.append(int(chunk[np.nanargmax(scores)]))
+    return hubs
+
+
+def plan_sparse_pairs(keys, clear, neighbours=2, n_hubs=16, hubs_per_image=2):
+    """(reference, target) index pairs for the sparse graph; each unordered
+    pair once, earlier image as reference."""
+    order = _time_order(keys)
+    rank = np.empty(len(keys), dtype=np.int64)
+    rank[order] = np.arange(len(keys))
+
+    edges = set()
+
+    def add(i, j):
+        if i != j:
+            edges.add((i, j) if rank[i] < rank[j] else (j, i))
+
+    for i, j in plan_pairs(keys, 'knn', neighbours):
+        add(i, j)
+
+    hubs = choose_hubs(keys, clear, n_hubs) if n_hubs else []
+    for a, h1 in enumerate(hubs):
+        for h2 in hubs[a + 1:]:
+            add(h1, h2)
+
+    if hubs:
+        hub_rank = rank[hubs]
+        for i in range(len(keys)):
+            nearest = np.argsort(np.abs(hub_rank - rank[i]), kind='stable')
+            for h in nearest[:hubs_per_image]:
+                add(i, hubs[h])
+
+    return sorted(edges, key=lambda e: (rank[e[0]], rank[e[1]]))
+
+
+def laplacian(n, pairs):
+    src = np.array([p[0] for p in pairs], dtype=np.int64)
+    tgt = np.array([p[1] for p in pairs], dtype=np.int64)
+    adjacency = sp.coo_matrix(
+        (np.ones(len(pairs)), (src, tgt)), shape=(n, n)).tocsr()
+    adjacency = adjacency + adjacency.T
+    degree = np.asarray(adjacency.sum(axis=1)).ravel()
+    return sp.diags(degree) - adjacency, adjacency
+
+
+def offset_std(n, pairs):
+    """Per-image offset standard deviation for unit pair noise (zero-mean
+    gauge), or None if the graph is disconnected."""
+    lap, adjacency = laplacian(n, pairs)
+    ncomp, _ = connected_components(adjacency, directed=False)
+    if ncomp > 1:
+        return None
+    # (L + J/n)^-1 = L^+ + J/n for a connected graph
+    dense = lap.toarray() + 1.0 / n
+    return np.sqrt(np.diag(np.linalg.inv(dense)) - 1.0 / n)
+
+
+def full_graph_std(n):
+    """Offset std for every ordered pair (two edges per image pair): the
+    Laplacian is 2(nI - J), so L^+ has diagonal (n - 1) / (2 n^2)."""
+    return np.sqrt((n - 1) / (2.0 * n * n))
+
+
+def write_pairs(outputfile, keys, pairs):
+    outputfile = Path(outputfile)
+    outputfile.parent.mkdir(parents=True, exist_ok=True)
+    with open(outputfile, 'w', newline='') as f:
+        w = csv.writer(f)
+        w.writerow(['reference', 'target'])
+        for i, j in pairs:
+            w.writerow([keys[i], keys[j]])
+
+
+@click.command()
+@click.argument('imagedir')
+@click.argument('configfile')
+@click.argument('clearfile', type=click.Path(path_type=Path, exists=True))
+@click.argument('outputfile', type=click.Path(path_type=Path))
+@click.option('-k', '--neighbours', type=click.IntRange(min=1), default=2,
+              show_default=True, help='Temporal neighbours on each side.')
+@click.option('--hubs', type=click.IntRange(min=0), default=16,
+              show_default=True, help='Hub images (one per time bin).')
+@click.option('--hubs-per-image', type=click.IntRange(min=0), default=2,
+              show_default=True, help='Nearest hubs each image is paired with.')
+@click.option('-l', '--minclear', type=float, default=0.0, show_default=True,
+              help='Leave out images with a lower clear fraction.')
+def main(imagedir, configfile, clearfile, outputfile, neighbours, hubs,
+         hubs_per_image, minclear):
+
+    config = load_config(configfile)
+    files = sorted(glob(safe_join(imagedir, config['glob_pattern'])))
+    keys = [stem(f) for f in files]
+
+    clear = match_clear_fraction(keys, load_clear_fraction(clearfile))
+    print(f'{len(keys)} images, {np.isnan(clear).sum()} without a clear fraction')
+    if minclear > 0:
+        keep = ~(clear < minclear)
+        keys = [k for k, m in zip(keys, keep) if m]
+        clear = clear[keep]
+        print(f'{len(keys)} images with clear fraction >= {minclear}')
+
+    n = len(keys)
+    pairs = plan_sparse_pairs(keys, clear, neighbours, hubs, hubs_per_image)
+    write_pairs(outputfile, keys, pairs)
+
+    full = n * (n - 1)
+    print(f'{len(pairs)} pairs planned vs {full} for the full graph '
+          f'({full / max(len(pairs), 1):.1f}x fewer coregistrations)')
+
+    if n > MAX_UNCERTAINTY_IMAGES:
+        print(f'Skipping uncertainty estimate for {n} images')
+        return
+    std = offset_std(n, pairs)
+    if std is None:
+        print('WARNING: planned graph is disconnected; offsets of separate '
+              'components are not comparable')
+        return
+    full_std = full_graph_std(n)
+    print('Offset std in units of the per-pair shift error: '
+          f'planned median {np.median(std):.3f}, '
+          f'95th pct {np.percentile(std, 95):.3f}, '
+          f'max {std.max():.3f} (worst: {keys[int(np.argmax(std))]}); '
+          f'full graph {full_std:.3f}')
+    print(f'Uncertainty growth vs full graph: median '
+          f'{np.median(std) / full_std:.1f}x (assumes independent pair '
+          f'errors, which flatters the full graph)')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 import os
+import csv
 import json
 import click
 import warnings
@@ -19,6 +20,12 @@ def stem(path, suffix=None):
     )[0] + ('' if suffix is None else suffix)
 
 
+def read_pairs(pairsfile):
+    """[(reference, target)] stems from a plan_coreg_pairs.py CSV."""
+    with open(pairsfile, newline='') as f:
+        return [(row['reference'], row['target']) for row in csv.DictReader(f)]
+
+
 def coreg(ref, tgt, coreg_args):
     with warnings.catch_warnings():
         warnings.filterwarnings(
@@ -41,7 +48,10 @@ def coreg(ref, tgt, coreg_args):
 @click.argument('outputdir')
 @click.argument('configfile')
 @click.argument('referenceindex', type=int)
-def main(imagedir, outputdir, configfile, referenceindex):
+@click.option('--pairs-file', type=click.Path(exists=True), default=None,
+              help='Only coregister targets planned for this reference '
+                   '(plan_coreg_pairs.py output).')
+def main(imagedir, outputdir, configfile, referenceindex, pairs_file):
 
     config = load_config(configfile)
     coreg_args = config.get('coreg_args', {})
@@ -62,6 +72,13 @@ def main(imagedir, outputdir, configfile, referenceindex):
         print('Already completed')
         return
 
+    if pairs_file is not None:
+        targets = {
+            t for r, t in read_pairs(pairs_file)
+            if r == stem(reference_file)
+        }
+        files = [f for f in files if stem(f) in targets]
+
     results = {}
 
     for target_file in tqdm(files):
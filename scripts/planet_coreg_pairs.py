@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+"""Coregister a whole set of Planet image pairs in one run.
+
+planet_coreg.py handles one reference against every target, so the full graph
+needs n invocations, each re-reading every target from disk. This driver
+plans the pair set once:
+
+    all        every pair of images
+    knn        each image with the k images either side of it in acquisition
+               time
+    spanning   consecutive images in time (a chain spanning all images)
+    file       the reference,target list from plan_coreg_pairs.py
+               (--pairs-file)
+
+It splits the pairs, in reference order (acquisition time for Planet
+stems), into one contiguous run per worker process. Each worker keeps
+recently decoded GeoArrays in memory and works through its run in order, so
+an image is decoded about once for all the pairs near it in time rather
+than once per pair. Results go into a single SQLite shift store, one chunk
+of pairs at a time. Rerunning the command skips pairs already stored with the same
+coreg_args.
+
+`--export DIR` writes the store back out as the per-reference
+`<reference>.json` files planet_coreg.py produces, so coreg_global.py and the
+plotting scripts read it unchanged.
+"""
+import json
+import os
+import re
+import sqlite3
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import ExitStack
+from datetime import datetime
+from functools import lru_cache
+from glob import glob
+from pathlib import Path
+
+import click
+import numpy as np
+from geoarray import GeoArray
+from tqdm import tqdm
+from werkzeug.security import safe_join
+
+from planet_coreg import coreg, read_pairs, stem
+from rebuild_manifest import params_digest
+from util import load_config
+
+PAIR_MODES = ('all', 'knn', 'spanning')
+_SCENE_DT_RE = re.compile(r'^(\d{8})_(\d{6})')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS shifts (
+    reference  TEXT NOT NULL,
+    target     TEXT NOT NULL,
+    params     TEXT NOT NULL,
+    success    INTEGER NOT NULL,
+    info       TEXT NOT NULL,
+    PRIMARY KEY (reference, target)
+);
+"""
+
+
+def acquisition_time(key):
+    """Acquisition time parsed from a Planet scene stem, or None."""
+    m = _SCENE_DT_RE.match(key)
+    if not m:
+        return None
+    return datetime.strptime(m.group(1) + m.group(2), '%Y%m%d%H%M%S')
+
+
+def plan_pairs(keys, mode='knn', k=4, both_directions=False):
+    """(reference, target) index pairs over `keys` for the given mode.
+
+    Images are ordered by acquisition time (keys that do not parse keep
+    their sorted position). Each unordered pair is listed once, earlier image
+    as reference, unless `both_directions` is set.
+    """
+    times = [acquisition_time(key) for key in keys]
+    if all(t is not None for t in times):
+        order = sorted(range(len(keys)), key=lambda i: (times[i], keys[i]))
+    else:
+        order = sorted(range(len(keys)), key=lambda i: keys[i])
+    n = len(order)
+
+    if mode == 'all':
+        span = n - 1
+    elif mode == 'knn':
+        span = k
+    elif mode == 'spanning':
+        span = 1
+    else:
+        raise ValueError(f'Unknown pair mode {mode!r}')
+
+    pairs = []
+    for a in range(n):
+        for b in range(a + 1, min(n, a + span + 1)):
+            pairs.append((order[a], order[b]))
+    if both_directions:
+        pairs += [(j, i) for i, j in pairs]
+    return pairs
+
+
+class ShiftStore:
+    """SQLite table of pairwise coreg_info, keyed by (reference, target)."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(self.path)
+        self._conn.executescript(_SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._conn.commit()
+        self._conn.close()
+
+    def done(self, params):
+        """Pairs already stored for this parameter digest."""
+        rows = self._conn.execute(
+            "SELECT reference, target FROM shifts WHERE params = ?", (params,))
+        return set(rows)
+
+    def put(self, reference, target, params, info):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO shifts VALUES (?, ?, ?, ?, ?)",
+            (reference, target, params, int(bool(info.get('success'))),
+             json.dumps(info, default=_json_default)))
+
+    def commit(self):
+        self._conn.commit()
+
+    def by_reference(self, params):
+        """{reference: {target: coreg_info}} for one parameter digest."""
+        results = defaultdict(dict)
+        rows = self._conn.execute(
+            "SELECT reference, target, info FROM shifts WHERE params = ? "
+            "ORDER BY reference, target", (params,))
+        for reference, target, info in rows:
+            results[reference][target] = json.loads(info)
+        return results
+
+
+def _json_default(obj):
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(f'{type(obj).__name__} is not JSON serializable')
+
+
+# -- worker side -------------------------------------------------------------
+
+_worker = {}
+
+
+def _read_geoarray(path):
+    image = GeoArray(path)
+    image.to_mem()
+    return image
+
+
+def _init_worker(coreg_args, cache_size):
+    _worker['coreg_args'] = coreg_args
+    _worker['load'] = lru_cache(maxsize=cache_size)(_read_geoarray)
+
+
+def _coreg_task(task):
+    load = _worker['load']
+    return [
+        (stem(reference_file), stem(target_file),
+         coreg(load(reference_file), load(target_file), _worker['coreg_args']))
+        for reference_file, target_file in task
+    ]
+
+
+def _runs(pairs, files, n_runs, chunk_size):
+    """
+    Pairs sorted by reference and target, split into at most `n_runs`
+    contiguous runs, each a list of tasks of `chunk_size` (reference_file,
+    target_file) pairs. All tasks of a run go to one worker, in order.
+    """
+    ordered = sorted(pairs, key=lambda p: (files[p[0]], files[p[1]]))
+    if not ordered:
+        return []
+    run_size = -(-len(ordered) // n_runs)
+    runs = []
+    for r in range(0, len(ordered), run_size):
+        run = [(files[i], files[j]) for i, j in ordered[r:r + run_size]]
+        runs.append([run[c:c + chunk_size] for c in range(0, len(run), chunk_size)])
+    return runs
+
+
+def export_json(store, params, outputdir):
+    """Write per-reference JSON files in planet_coreg.py's layout."""
+    outputdir = Path(outputdir)
+    outputdir.mkdir(parents=True, exist_ok=True)
+    results = store.by_reference(params)
+    for reference, targets in results.items():
+        with open(safe_join(outputdir, reference + '.json'), 'w') as f:
+            json.dump(targets, f, indent=2)
+    return len(results)
+
+
+@click.command()
+@click.argument('imagedir')
+@click.argument('storefile', type=click.Path(path_type=Path))
+@click.argument('configfile')
+@click.option('--pairs', 'mode', type=click.Choice(PAIR_MODES), default='knn',
+              show_default=True, help='Which image pairs to coregister.')
+@click.option('--pairs-file', type=click.Path(path_type=Path, exists=True),
+              default=None,
+              help='Planned pairs CSV (plan_coreg_pairs.py); overrides --pairs.')
+@click.option('-k', '--neighbours', type=click.IntRange(min=1), default=4,
+              show_default=True, help='Temporal neighbours on each side (knn).')
+@click.option('--both-directions', is_flag=True,
+              help='Also coregister each pair with reference and target '
+                   'swapped (planet_coreg.py did this for all pairs).')
+@click.option('--workers', type=click.IntRange(min=1),
+              default=max(1, (os.cpu_count() or 2) - 1), show_default=True)
+@click.option('--chunk-size', type=click.IntRange(min=1), default=16,
+              show_default=True, help='Pairs per task; results are stored after each.')
+@click.option('--cache-size', type=click.IntRange(min=1), default=32,
+              show_default=True, help='Decoded images kept per worker.')
+@click.option('--export', 'exportdir', type=click.Path(path_type=Path),
+              default=None,
+              help='Also write per-reference JSON files for coreg_global.py.')
+def main(imagedir, storefile, configfile, mode, pairs_file, neighbours,
+         both_directions, workers, chunk_size, cache_size, exportdir):
+
+    config = load_config(configfile)
+    coreg_args = config.get('coreg_args', {})
+    params = params_digest(coreg_args)
+
+    files = sorted(glob(safe_join(imagedir, config['glob_pattern'])))
+    keys = [stem(f) for f in files]
+    if pairs_file is not None:
+        mode = 'file'
+        index = {k: i for i, k in enumerate(keys)}
+        planned = read_pairs(pairs_file)
+        missing = {k for pair in planned for k in pair if k not in index}
+        if missing:
+            raise click.ClickException(
+                f'{len(missing)} planned images not found in {imagedir}, '
+                f'e.g. {sorted(missing)[0]}')
+        pairs = [(index[r], index[t]) for r, t in planned]
+        if both_directions:
+            pairs += [(j, i) for i, j in pairs]
+    else:
+        pairs = plan_pairs(keys, mode, neighbours, both_directions)
+
+    with ShiftStore(storefile) as store:
+        done = store.done(params)
+        pending = [(i, j) for i, j in pairs if (keys[i], keys[j]) not in done]
+        print(f'{len(files)} images, {len(pairs)} pairs ({mode}); '
+              f'{len(pairs) - len(pending)} already stored')
+
+        runs = _runs(pending, files, workers, chunk_size)
+        n_ok = 0
+        if runs:
+            # One single-process pool per run, so a run's tasks share the
+            # worker's image cache
+            with ExitStack() as stack, \
+                    tqdm(total=len(pending), desc='Coregistering') as pbar:
+                pools = [
+                    stack.enter_context(ProcessPoolExecutor(
+                        max_workers=1, initializer=_init_worker,
+                        initargs=(coreg_args, cache_size)))
+                    for _ in runs
+                ]
+                futures = [
+                    pool.submit(_coreg_task, task)
+                    for pool, run in zip(pools, runs) for task in run
+                ]
+                for fut in as_completed(futures):
+                    results = fut.result()
+                    for reference, target, info in results:
+                        store.put(reference, target, params, info)
+                        n_ok += bool(info.get('success'))
+                    store.commit()
+                    pbar.update(len(results))
+            print(f'{n_ok}/{len(pending)} new pairs succeeded')
+
+        if exportdir is not None:
+            n = export_json(store, params, exportdir)
+            print(f'Wrote {n} reference files to {exportdir}')
+
+
+if __name__ == '__main__':
+    main()
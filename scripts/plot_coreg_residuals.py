@@ -5,11 +5,12 @@ import click
 import numpy as np
 import warnings
 from glob import glob
-from tqdm import tqdm
 import matplotlib.pyplot as plt
 from werkzeug.security import safe_join
 
-from coreg_global import load_offset_matrix, iterate, filterkeys
+from coreg_global import (
+    load_offset_edges, edges_to_matrix, solve_offsets, filterkeys,
+)
 
 
 def compute_residuals(xy, offset):
@@ -30,18 +31,11 @@ def compute_residuals(xy, offset):
     magnitude : ndarray, shape (n, n)
         Magnitude of residual vectors
     """
-    n = len(offset)
-    residual = np.full((n, n, 2), np.nan)
-
-    for i in range(n):
-        for j in range(n):
-            if i == j or np.isnan(xy[i, j, 0]):
-                continue
-
-            # Remaining offset after applying global shifts
-            # xy[i,j] + offset[j] ≈ offset[i] in optimal solution
-            # So remaining offset = xy[i,j] - (offset[i] - offset[j])
-            residual[i, j] = xy[i, j] + (offset[j] - offset[i])
+    # Remaining offset after applying global shifts
+    # xy[i,j] + offset[j] ≈ offset[i] in optimal solution
+    # So remaining offset = xy[i,j] - (offset[i] - offset[j])
+    residual = xy + (offset[np.newaxis, :, :] - offset[:, np.newaxis, :])
+    np.einsum('iik->ik', residual)[...] = np.nan
 
     # Compute magnitude
     magnitude = np.sqrt(np.sum(residual**2, axis=2))
@@ -162,15 +156,16 @@ def plot_residual_heatmap(magnitude, keys, outputfile, figsize=12, dpi=150, vmax
 @click.option('-l', '--minclear', type=float, default=0.9, help='Minimum clear percentage')
 @click.option('-m', '--maxiter', type=int, default=100, help='Maximum iterations')
 @click.option('-t', '--tolerance', type=float, default=1e-6, help='Convergence tolerance')
+@click.option('-k', '--huber-k', type=float, default=1.345, help='Huber threshold in robust standard deviations')
 @click.option('--figsize', type=float, default=12, help='Figure size in inches')
 @click.option('--dpi', type=int, default=150, help='Figure DPI')
 @click.option('--vmax', type=float, default=None, help='Max colorbar value in meters')
 @click.option('--pixel-scale', type=float, default=3.0, help='Meters per pixel (default: 3.0)')
-def main(coregdir, outputfile, cloudfile, minclear, maxiter, tolerance, figsize, dpi, vmax, pixel_scale):
+def main(coregdir, outputfile, cloudfile, minclear, maxiter, tolerance, huber_k, figsize, dpi, vmax, pixel_scale):
     """
     Visualize residual alignment errors after global coregistration.
 
-    Loads pairwise coregistration results, runs iterative global alignment,
+    Loads pairwise coregistration results, runs the robust global alignment,
     and creates a heatmap showing residual errors for each image pair.
     """
     # Load pairwise coregistration files
@@ -182,12 +177,12 @@ def main(coregdir, outputfile, cloudfile, minclear, maxiter, tolerance, figsize,
     # Filter by cloud coverage if provided
     filtered = filterkeys(cloudfile, minclear)
 
-    # Load offset matrix
+    # Load pairwise offsets as an edge list
     print(f"Loading {len(files)} coregistration files...")
-    keys, xy = load_offset_matrix(files, keys=filtered)
+    keys, src, tgt, dxy = load_offset_edges(files, keys=filtered)
 
     # Check for sufficient data
-    valid_count = np.sum(~np.isnan(xy[:, :, 0]))
+    valid_count = len(src)
     if valid_count < 10:
         raise ValueError(f"Insufficient valid pairwise offsets: {valid_count}")
 
@@ -196,24 +191,19 @@ def main(coregdir, outputfile, cloudfile, minclear, maxiter, tolerance, figsize,
 
     print(f"Loaded {len(keys)} images with {valid_count} valid pairwise offsets")
 
-    # Run iterative optimization
-    offset = np.zeros((len(xy), 2))
-
-    it = tqdm(list(range(maxiter)), 'Optimizing')
-    for i in it:
-        prev = np.array(offset)
-        offset = iterate(offset, xy)
-        delta = np.sqrt(np.nanmean(np.square(prev - offset)))
-        it.set_postfix({'delta': f'{delta:.2e}'})
-        if delta < tolerance:
-            it.close()
-            print(f"Converged after {i+1} iterations (delta={delta:.2e})")
-            break
+    # Robust (IRLS / Huber) global solve
+    offset, iterations, delta = solve_offsets(
+        len(keys), src, tgt, dxy, maxiter=maxiter, tolerance=tolerance,
+        huber_k=huber_k,
+    )
+    if delta < tolerance:
+        print(f"Converged after {iterations} iterations (delta={delta:.2e})")
     else:
         warnings.warn(f"Did not converge after {maxiter} iterations (delta={delta:.2e})")
 
     # Compute residuals
     print("Computing residuals...")
+    xy = edges_to_matrix(len(keys), src, tgt, dxy)
     residual, magnitude = compute_residuals(xy, offset)
 
     # Check for all NaN residuals
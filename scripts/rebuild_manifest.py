@@ -0,0 +1,175 @@
+"""Content-addressed rebuild manifest for derived rasters.
+
+Records, per output file, a digest of every input file's *content* and of the
+parameters that produced it (model version, band order, clip region, ...).
+A rerun then rebuilds only outputs whose inputs or parameters changed, instead
+of trusting `out_path.exists()` or rebuilding everything with --force.
+
+The manifest is a single SQLite file, normally `<output-root>/manifest.sqlite`:
+
+    file_hashes(path, size, mtime_ns, digest)
+        Content digest cache. A file is re-hashed only when its size or
+        mtime changes, so the steady-state cost of a rerun is one stat()
+        per input.
+    outputs(output, inputs_digest, params_digest, inputs, params, updated_utc)
+        One row per output file.
+
+Outputs that already exist on disk but predate the manifest are adopted as
+fresh the first time they are seen, so switching a tree over to the manifest
+does not trigger a full rebuild.
+
+Typical use from a build script:
+
+    with RebuildManifest(output_dir / "manifest.sqlite") as manifest:
+        if manifest.is_stale(out_path, {"input": in_path}, params):
+            build(in_path, out_path)
+            manifest.record(out_path, {"input": in_path}, params)
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sqlite3
+from datetime import datetime, timezone
+from pathlib import Path
+
+DEFAULT_MANIFEST_NAME = "manifest.sqlite"
+HASH_CHUNK_BYTES = 4 << 20
+COMMIT_EVERY = 50  # writes between commits, so a crashed run keeps its progress
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS file_hashes (
+    path      TEXT PRIMARY KEY,
+    size      INTEGER NOT NULL,
+    mtime_ns  INTEGER NOT NULL,
+    digest    TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS outputs (
+    output         TEXT PRIMARY KEY,
+    inputs_digest  TEXT NOT NULL,
+    params_digest  TEXT NOT NULL,
+    inputs         TEXT NOT NULL,
+    params         TEXT NOT NULL,
+    updated_utc    TEXT NOT NULL
+);
+"""
+
+
+def content_digest(path: Path) -> str:
+    """BLAKE2b-160 of the file's bytes, read in large chunks."""
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_BYTES):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def params_digest(params: dict) -> str:
+    """Stable digest of a JSON-serialisable parameter dict."""
+    blob = json.dumps(params, sort_keys=True, default=str).encode()
+    return hashlib.blake2b(blob, digest_size=20).hexdigest()
+
+
+class RebuildManifest:
+    """SQLite-backed record of which inputs and parameters built each output.
+
+    With dry_run=True nothing is written back (no adoption, no hash caching),
+    so the manifest can be queried to report what a real run would rebuild.
+    """
+
+    def __init__(self, db_path: Path, *, dry_run: bool = False):
+        self.db_path = Path(db_path)
+        self.dry_run = dry_run
+        if not dry_run:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        if dry_run and not self.db_path.exists():
+            self._conn = sqlite3.connect(":memory:")
+        else:
+            self._conn = sqlite3.connect(self.db_path)
+        self._conn.executescript(_SCHEMA)
+        self._pending_writes = 0
+
+    def __enter__(self) -> "RebuildManifest":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        if not self.dry_run:
+            self._conn.commit()
+        self._conn.close()
+
+    def commit(self) -> None:
+        if not self.dry_run:
+            self._conn.commit()
+            self._pending_writes = 0
+
+    def _wrote(self) -> None:
+        self._pending_writes += 1
+        if self._pending_writes >= COMMIT_EVERY:
+            self.commit()
+
+    # -- content hashing -----------------------------------------------------
+
+    def file_digest(self, path: Path) -> str:
+        """Content digest of `path`, served from cache while size/mtime match."""
+        key = str(Path(path).resolve())
+        st = os.stat(key)
+        row = self._conn.execute(
+            "SELECT size, mtime_ns, digest FROM file_hashes WHERE path = ?",
+            (key,)).fetchone()
+        if row and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+            return row[2]
+        digest = content_digest(Path(key))
+        if not self.dry_run:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?)",
+                (key, st.st_size, st.st_mtime_ns, digest))
+            self._wrote()
+        return digest
+
+    def _inputs_digest(self, inputs: dict[str, Path]) -> tuple[str, dict]:
+        digests = {role: self.file_digest(p) for role, p in sorted(inputs.items())}
+        return params_digest(digests), digests
+
+    # -- outputs -------------------------------------------------------------
+
+    def is_stale(self, output: Path, inputs: dict[str, Path], params: dict) -> bool:
+        """True if `output` is missing or was built from different content/params.
+
+        `inputs` maps a role name ("input", "margin_ocm", ...) to a file path.
+        An existing output with no manifest row is adopted as fresh.
+        """
+        output = Path(output)
+        if not (output.exists() and output.stat().st_size > 0):
+            return True
+        row = self._conn.execute(
+            "SELECT inputs_digest, params_digest FROM outputs WHERE output = ?",
+            (str(output.resolve()),)).fetchone()
+        if row is None:
+            self.record(output, inputs, params)
+            return False
+        inputs_dig, _ = self._inputs_digest(inputs)
+        return (row[0], row[1]) != (inputs_dig, params_digest(params))
+
+    def record(self, output: Path, inputs: dict[str, Path], params: dict) -> None:
+        """Mark `output` as freshly built from `inputs` with `params`."""
+        if self.dry_run:
+            return
+        inputs_dig, digests = self._inputs_digest(inputs)
+        self._conn.execute(
+            "INSERT OR REPLACE INTO outputs VALUES (?, ?, ?, ?, ?, ?)",
+            (str(Path(output).resolve()), inputs_dig, params_digest(params),
+             json.dumps({role: [str(inputs[role]), d] for role, d in digests.items()}),
+             json.dumps(params, sort_keys=True, default=str),
+             datetime.now(timezone.utc).isoformat(timespec="seconds")))
+        self._wrote()
+
+    def forget(self, output: Path) -> None:
+        """Drop the record for `output` (e.g. after a failed rebuild)."""
+        if not self.dry_run:
+            self._conn.execute("DELETE FROM outputs WHERE output = ?",
+                               (str(Path(output).resolve()),))
+            self._wrote()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+"""Percentile contrast stretch for Planet quicklooks, computed from histograms.
+
+Planet AnalyticMS rasters are uint16, so the 2/98 percentiles of a band can be
+read off a 65536-bin histogram (one np.bincount pass, no sort and no float32
+copy of the band) and the stretch itself becomes a 65536-entry uint8 lookup
+table. Both steps reproduce the previous np.percentile + float arithmetic
+exactly:
+
+    percentiles_from_histogram  -> same values as np.percentile(..., 'linear')
+    stretch_lut                 -> same bytes as
+                                   np.clip((b - lo) * (255 / (hi - lo)), 0, 255)
+                                   .astype(np.uint8) on the float32 band
+
+Histograms add, so large rasters are rendered block by block: one pass
+accumulates per-band histograms, a second pass maps each block through the
+lookup tables and writes it.
+
+As a script, renders every `<input_dir>/<YYYY>/*_4band.tif` into
+`<output_dir>/<YYYY>/*_rgb.tif`:
+
+    python scripts/rgb_stretch.py data/planet_clipped_50ha/4band \\
+        data/planet_clipped_50ha/rgb --workers 8
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import click
+import numpy as np
+import rasterio
+from tqdm import tqdm
+
+DEFAULT_PERCENTILES = (2.0, 98.0)
+# Planet AnalyticMS band order is [Blue, Green, Red, NIR] (1,2,3,4).
+RGB_BANDS = (3, 2, 1)
+
+
+def _check_integer(values):
+    if values.dtype not in (np.uint8, np.uint16):
+        raise TypeError(
+            f"Unsupported dtype {values.dtype}. Expected uint8 or uint16."
+        )
+
+
+def band_histogram(values, valid=None):
+    """Counts of each integer value in `values` (restricted to `valid`).
+
+    Always 65536 bins so histograms from different blocks or dtypes add.
+    """
+    _check_integer(values)
+    if valid is not None:
+        values = values[valid]
+    return np.bincount(values.ravel(), minlength=65536).astype(np.int64)
+
+
+def percentiles_from_histogram(hist, percentiles=DEFAULT_PERCENTILES,
+                               dtype=np.float32):
+    """np.percentile (linear method) of the sample described by `hist`.
+
+    `dtype` is the dtype np.percentile would have seen the sample in
+    (float32 for the band stretches, the raw integer dtype for
+    percentile_stretch_global); the interpolation is evaluated in that dtype
+    exactly as numpy's _lerp does, so results match bit for bit.
+    Returns a tuple of numpy scalars, or None for an empty histogram.
+    """
+    cumulative = np.cumsum(hist)
+    n = int(cumulative[-1])
+    if n == 0:
+        return None
+
+    quantiles = np.true_divide(np.asarray(percentiles, dtype=np.float64), 100)
+    virtual = (n - 1) * quantiles
+    previous = np.floor(virtual)
+    following = previous + 1
+    at_end = virtual >= n - 1
+    previous[at_end] = n - 1
+    following[at_end] = n - 1
+    gamma = virtual - previous
+
+    # The k-th smallest sample is the first value whose cumulative count
+    # exceeds k.
+    lo = np.searchsorted(cumulative, previous.astype(np.int64), side='right')
+    hi = np.searchsorted(cumulative, following.astype(np.int64), side='right')
+    a = lo.astype(dtype)
+    b = hi.astype(dtype)
+    diff = b - a
+    result = a + diff * gamma
+    np.subtract(b, diff * (1 - gamma), out=result, where=gamma >= 0.5,
+                casting='unsafe')
+    return tuple(result)
+
+
+def stretch_lut(lo, hi):
+    """uint8 lookup table for the linear lo..hi -> 0..255 stretch of a
+    float32 band, indexed by the raw uint16 value."""
+    b = np.arange(65536, dtype=np.float32)
+    return np.clip((b - lo) * (255.0 / (hi - lo)), 0, 255).astype(np.uint8)
+
+
+def stretch_band(band, stat_mask, out_mask, percentiles=DEFAULT_PERCENTILES):
+    """Per-band percentile stretch of an integer band to uint8.
+
+    Percentiles come from pixels in `stat_mask`; the stretch is applied where
+    `out_mask` is set and everything else is 0. Returns all zeros if no
+    pixel qualifies or the percentiles coincide.
+    """
+    out = np.zeros(band.shape, dtype=np.uint8)
+    pct = percentiles_from_histogram(band_histogram(band, stat_mask), percentiles)
+    if pct is None:
+        return out
+    lo, hi = pct[0], pct[-1]
+    if hi <= lo:
+        return out
+    np.copyto(out, stretch_lut(lo, hi)[band], where=out_mask)
+    return out
+
+
+def _block_validity(src, band, window):
+    valid = src.dataset_mask(window=window) > 0
+    if src.nodata is not None:
+        valid &= band != src.nodata
+    return valid
+
+
+def render_rgb_file(four_band_path, out_path, percentiles=DEFAULT_PERCENTILES):
+    """Render a 4-band Planet GeoTIFF to a uint8 RGB GeoTIFF, block by block.
+
+    Per-band stretch over pixels that are inside the dataset mask and not
+    nodata; other pixels are written as 0. Returns 'ok' or 'error'.
+    """
+    out_path = Path(out_path)
+    with rasterio.open(four_band_path) as src:
+        if src.count < 4 or src.dtypes[0] not in ('uint8', 'uint16'):
+            return 'error'
+        windows = [w for _, w in src.block_windows(1)]
+
+        hists = np.zeros((len(RGB_BANDS), 65536), dtype=np.int64)
+        for window in windows:
+            for i, bidx in enumerate(RGB_BANDS):
+                band = src.read(bidx, window=window)
+                hists[i] += band_histogram(
+                    band, _block_validity(src, band, window))
+
+        luts = []
+        for hist in hists:
+            pct = percentiles_from_histogram(hist, percentiles)
+            if pct is None or pct[-1] <= pct[0]:
+                luts.append(None)
+            else:
+                luts.append(stretch_lut(pct[0], pct[-1]))
+
+        out_path.parent.mkdir(parents=True, exist_ok=True)
+        with rasterio.open(
+            out_path, 'w', driver='GTiff', dtype='uint8', count=3,
+            height=src.height, width=src.width, crs=src.crs,
+            transform=src.transform, photometric='RGB',
+        ) as dst:
+            for window in windows:
+                for i, bidx in enumerate(RGB_BANDS):
+                    out = np.zeros((window.height, window.width), dtype=np.uint8)
+                    if luts[i] is not None:
+                        band = src.read(bidx, window=window)
+                        np.copyto(out, luts[i][band],
+                                  where=_block_validity(src, band, window))
+                    dst.write(out, i + 1, window=window)
+    return 'ok'
+
+
+def _render_job(job):
+    src, dst = job
+    try:
+        return render_rgb_file(src, dst)
+    except rasterio.errors.RasterioError:
+        return 'error'
+
+
+@click.command()
+@click.argument('input_dir', type=click.Path(path_type=Path, exists=True,
+                                             file_okay=False))
+@click.argument('output_dir', type=click.Path(path_type=Path, file_okay=False))
+@click.option('--pattern', default='*_4band.tif', show_default=True,
+              help='Glob matched inside each year directory.')
+@click.option('--year', 'years', multiple=True,
+              help='Only render these year directories (repeatable).')
+@click.option('--workers', type=click.IntRange(min=1),
+              default=max(1, (os.cpu_count() or 2) - 1), show_default=True)
+@click.option('--force', is_flag=True, help='Re-render existing quicklooks.')
+def main(input_dir, output_dir, pattern, years, workers, force):
+    """Render RGB quicklooks for whole year directories of 4-band scenes."""
+    jobs = []
+    for year_dir in sorted(p for p in input_dir.iterdir() if p.is_dir()):
+        if years and year_dir.name not in years:
+            continue
+        for src in sorted(year_dir.glob(pattern)):
+            name = src.name.replace('_4band', '_rgb')
+            if name == src.name:
+                name = f'{src.stem}_rgb.tif'
+            dst = output_dir / year_dir.name / name
+            if force or not dst.exists():
+                jobs.append((src, dst))
+
+    if not jobs:
+        print('Nothing to render.')
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        statuses = list(tqdm(
+            pool.map(_render_job, jobs,
+                     chunksize=max(1, len(jobs) // (8 * workers))),
+            'Rendering quicklooks', total=len(jobs),
+        ))
+
+    n_ok = statuses.count('ok')
+    print(f'{n_ok} rendered, {len(statuses) - n_ok} errors')
+
+
+if __name__ == '__main__':
+    main()
@@ -99,8 +99,12 @@ def main():
         assert_ok(isinstance(records, list), "coreg_log.json is a JSON list")
 
         for entry in records:
-            for key in ("scene", "label", "coreg_ok", "clear_fraction"):
+            for key in ("scene", "label", "coreg_ok", "coreg_method", "clear_fraction"):
                 assert_ok(key in entry, f"record has '{key}' key: {entry}")
+            assert_ok(
+                entry["coreg_method"] in ("phase_correlation", "arosics"),
+                f"coreg_method is a known estimator for {entry['scene']}: {entry['coreg_method']}",
+            )
             cf = entry["clear_fraction"]
             if cf is not None:
                 assert_ok(
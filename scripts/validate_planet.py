@@ -1,8 +1,12 @@
 #!/usr/bin/env python
 import os
 import json
+import time
 import click
 import hashlib
+import threading
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 from pathlib import Path
 from typing import NamedTuple
@@ -11,6 +15,13 @@ from werkzeug.security import safe_join
 
 MANIFEST_FILE = 'manifest.json'
 MARKER = '.validated'
+# Per-order record of files already hashed, keyed on size and mtime, so a
+# re-run after a partial failure or a new download only hashes what changed.
+CACHE_FILE = '.validated_files.json'
+# Save an order's cache at least this often while it is being hashed, so an
+# interrupted run over a large order keeps most of its progress
+CACHE_SAVE_SECONDS = 30
+READ_CHUNK_BYTES = 8 << 20
 
 
 class Validation(NamedTuple):
@@ -18,15 +29,114 @@ class Validation(NamedTuple):
     reason: str = ""
 
 
-def file_digest(filename):
-    with open(filename, "rb") as f:
-        file_hash = hashlib.md5()
-        while chunk := f.read(8192):
-            file_hash.update(chunk)
+class HashStats:
+    """Bytes, files and seconds spent hashing, per worker thread."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.workers = defaultdict(lambda: [0, 0, 0.0])
+
+    def add(self, nbytes, seconds):
+        with self._lock:
+            w = self.workers[threading.current_thread().name]
+            w[0] += nbytes
+            w[1] += 1
+            w[2] += seconds
+
+    def report(self):
+        total_bytes = sum(w[0] for w in self.workers.values())
+        if not total_bytes:
+            return
+        print('\nHashing throughput:')
+        for name, (nbytes, nfiles, seconds) in sorted(self.workers.items()):
+            rate = nbytes / seconds / 2**20 if seconds else 0.0
+            print(f'  {name}: {nfiles} files, {nbytes / 2**30:.2f} GiB, '
+                  f'{rate:.0f} MiB/s')
+
+
+def file_digest(filename, stats=None):
+    """MD5 of a file, read in large chunks into one reused buffer.
+
+    hashlib and the reads both release the GIL, so threads scale.
+    """
+    start = time.perf_counter()
+    buf = bytearray(READ_CHUNK_BYTES)
+    view = memoryview(buf)
+    nbytes = 0
+    file_hash = hashlib.md5()
+    with open(filename, "rb", buffering=0) as f:
+        while n := f.readinto(buf):
+            file_hash.update(view[:n])
+            nbytes += n
+    if stats is not None:
+        stats.add(nbytes, time.perf_counter() - start)
     return file_hash.hexdigest()
 
 
-def validate(orderdir, subdir):
+class VerificationCache:
+    """{relative path: [size, mtime_ns, md5]} stored beside the order."""
+
+    def __init__(self, order_path):
+        self.path = Path(safe_join(order_path, CACHE_FILE))
+        self.entries = {}
+        self.dirty = False
+        self.saved_at = time.monotonic()
+        if self.path.exists():
+            try:
+                with open(self.path, 'r') as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                self.entries = {}
+
+    def get(self, rel, st):
+        entry = self.entries.get(rel)
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return entry[2]
+        return None
+
+    def put(self, rel, st, digest):
+        self.entries[rel] = [st.st_size, st.st_mtime_ns, digest]
+        self.dirty = True
+
+    def save(self):
+        if not self.dirty:
+            return
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.path)
+        self.dirty = False
+        self.saved_at = time.monotonic()
+
+    def save_if_older(self, seconds):
+        if time.monotonic() - self.saved_at >= seconds:
+            self.save()
+
+
+class _Order:
+    """Bookkeeping for one order while its files are being hashed."""
+
+    def __init__(self, order_path, files):
+        self.order_path = order_path
+        self.files = files
+        self.cache = VerificationCache(order_path)
+        self.digests = {}
+        self.pending = 0
+
+    def result(self):
+        bad = [
+            f['path'] for f in self.files
+            if self.digests.get(f['path']) != f['digests']['md5']
+        ]
+        if bad:
+            more = f' (and {len(bad) - 1} more)' if len(bad) > 1 else ''
+            return Validation(False, f'File md5sum mismatch: {bad[0]}{more}')
+        Path(safe_join(self.order_path, MARKER)).touch()
+        return Validation()
+
+
+def _prepare(orderdir, subdir):
+    """Validation for orders decided without hashing, else an _Order."""
     order_path = safe_join(orderdir, subdir)
 
     marker_file = safe_join(order_path, MARKER)
@@ -41,38 +151,107 @@ def validate(orderdir, subdir):
         manifest = json.load(f)
 
     file_list = manifest['files']
-    for f in tqdm(file_list, f'Checking {subdir}', leave=False):
+    for f in file_list:
         path = safe_join(order_path, f['path'])
         if not os.path.exists(path):
             return Validation(False, f"Missing file: {f['path']}")
 
-    for f in tqdm(file_list, f'Validating {subdir}', leave=False):
-        path = safe_join(order_path, f['path'])
-        expected_digest = f['digests']['md5']
-        actual_digest = file_digest(path)
-        if expected_digest != actual_digest:
-            return Validation(False, f"File md5sum mismatch: {f['path']}")
+    return _Order(order_path, file_list)
 
-    # Mark valid
-    Path(marker_file).touch()
 
-    return Validation()
+def validate_orders(orderdir, subdirs, workers=1, stats=None):
+    """Validate several orders, hashing all their files on one thread pool.
+
+    Files whose size and mtime match the order's verification cache are not
+    re-read. Each order's cache is saved every CACHE_SAVE_SECONDS while it
+    is hashed, when the run stops (also on an interrupt or error), and with
+    its marker, if valid, as soon as its last file is hashed.
+    Returns {subdir: Validation}.
+    """
+    results = {}
+    orders = {}
+    for subdir in subdirs:
+        prepared = _prepare(orderdir, subdir)
+        if isinstance(prepared, Validation):
+            results[subdir] = prepared
+        else:
+            orders[subdir] = prepared
+
+    jobs = []
+    for subdir, order in orders.items():
+        for f in order.files:
+            path = safe_join(order.order_path, f['path'])
+            st = os.stat(path)
+            cached = order.cache.get(f['path'], st)
+            if cached is not None:
+                order.digests[f['path']] = cached
+            else:
+                jobs.append((subdir, f['path'], path, st))
+                order.pending += 1
+
+    for subdir, order in orders.items():
+        if order.pending == 0:
+            results[subdir] = order.result()
+
+    total_bytes = sum(st.st_size for *_, st in jobs)
+    with ThreadPoolExecutor(max_workers=workers,
+                            thread_name_prefix='hash') as pool, \
+            tqdm(total=total_bytes, desc='Hashing', unit='B',
+                 unit_scale=True, unit_divisor=1024) as pbar:
+        futures = {
+            pool.submit(file_digest, path, stats): (subdir, rel, st)
+            for subdir, rel, path, st in jobs
+        }
+        try:
+            for fut in as_completed(futures):
+                subdir, rel, st = futures[fut]
+                order = orders[subdir]
+                digest = fut.result()
+                order.digests[rel] = digest
+                order.cache.put(rel, st, digest)
+                order.pending -= 1
+                pbar.update(st.st_size)
+                if order.pending == 0:
+                    order.cache.save()
+                    results[subdir] = order.result()
+                else:
+                    order.cache.save_if_older(CACHE_SAVE_SECONDS)
+        finally:
+            for fut in futures:
+                fut.cancel()
+            for order in orders.values():
+                order.cache.save()
+
+    return {s: results[s] for s in subdirs}
+
+
+def validate(orderdir, subdir, workers=1):
+    return validate_orders(orderdir, [subdir], workers)[subdir]
 
 
 @click.command()
 @click.argument('orderdir', type=click.Path(
     path_type=Path, exists=True
 ))
-def main(orderdir):
+@click.option('--workers', type=click.IntRange(min=1),
+              default=min(16, os.cpu_count() or 1), show_default=True,
+              help='Hashing threads shared by all orders.')
+def main(orderdir, workers):
 
     subdirs = [
         d for d in os.listdir(orderdir)
         if os.path.isdir(safe_join(orderdir, d))
     ]
 
-    results = {}
-    for subdir in tqdm(subdirs, 'Validating Orders'):
-        results[subdir] = validate(orderdir, subdir)
+    stats = HashStats()
+    start = time.perf_counter()
+    results = validate_orders(orderdir, subdirs, workers, stats)
+    elapsed = time.perf_counter() - start
+    stats.report()
+    hashed = sum(w[0] for w in stats.workers.values())
+    if hashed:
+        print(f'  total: {hashed / 2**30:.2f} GiB in {elapsed:.1f} s '
+              f'({hashed / elapsed / 2**20:.0f} MiB/s)')
 
     if all(v.valid for v in results.values()):
         print('\nValidation complete: all orders are valid!')